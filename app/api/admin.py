@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import func
 from typing import List
@@ -6,7 +6,17 @@ from pydantic import BaseModel
 
 from ..database import get_db
 from ..models import RegenerationRequest, Book
-from ..services import get_book_orchestrator
+from ..services import enqueue_job, get_queue_stats
+from ..services.rate_limiter import get_rate_limiter_stats
+from ..services.adaptive_concurrency import get_adaptive_limiter_stats
+from ..services.pipeline import get_stage_timeout_stats
+from ..services.hedging import get_hedging_stats
+from ..services.provider_health import get_cover_routing_stats
+from ..services.story_cache import get_story_cache_stats
+from ..services.story_schemas import get_story_parse_stats
+from ..services.progress import progress_registry, status_poller
+from ..services.cancellation import cancel_book_jobs
+from ..services.ledger import get_book_ledger
 from ..config import settings
 
 router = APIRouter(prefix="/api/admin", tags=["admin"])
@@ -67,7 +77,6 @@ async def list_regeneration_requests(
 async def approve_regeneration(
     request_id: int,
     data: ApproveRequest,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db)
 ):
     """
@@ -93,12 +102,12 @@ async def approve_regeneration(
     regen_request.processed_at = func.now()
     db.commit()
     
-    # Ejecutar regeneración en background
-    orchestrator = get_book_orchestrator()
-    background_tasks.add_task(
-        orchestrator.regenerate_single_page,
+    # Encolar regeneración
+    enqueue_job(
+        db,
         regen_request.book_id,
-        regen_request.page_number
+        'regenerate_page',
+        payload={"page_number": regen_request.page_number}
     )
     
     print(f"✅ Regeneración aprobada: Página {regen_request.page_number} del libro {regen_request.book_id}")
@@ -144,4 +153,75 @@ async def reject_regeneration(
     return {
         "message": "Regeneración rechazada",
         "request_id": request_id
-    }
\ No newline at end of file
+    }
+
+@router.post("/books/{book_id}/cancel")
+async def cancel_book_generation(
+    book_id: str,
+    data: ApproveRequest,
+    db: Session = Depends(get_db)
+):
+    """
+    Cancelar todos los trabajos de generación de un libro (también pagados)
+    """
+    # Verificar contraseña
+    if data.password != settings.debug_payment_password:
+        raise HTTPException(status_code=401, detail="Contraseña de admin incorrecta")
+    
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if not book:
+        raise HTTPException(status_code=404, detail="Libro no encontrado")
+    
+    result = cancel_book_jobs(db, book_id)
+    print(f"🛑 Admin canceló la generación del libro {book_id}")
+    
+    return {
+        "message": "Cancelación solicitada",
+        "book_id": book_id,
+        **result
+    }
+
+@router.get("/books/{book_id}/events")
+async def get_book_generation_events(
+    book_id: str,
+    password: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Coste y latencia de un libro: stages, llamadas a proveedores, intentos, bytes y tokens
+    Requiere contraseña de admin
+    """
+    if password != settings.debug_payment_password:
+        raise HTTPException(status_code=401, detail="Contraseña de admin incorrecta")
+    
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if not book:
+        raise HTTPException(status_code=404, detail="Libro no encontrado")
+    
+    ledger = get_book_ledger(db, book_id, total_pages=book.total_pages)
+    ledger["price_per_extra_page_cents"] = settings.price_per_extra_page
+    return ledger
+
+@router.get("/metrics")
+async def get_generation_metrics(
+    password: str,
+    db: Session = Depends(get_db)
+):
+    """
+    Métricas de generación (cola de trabajos, rate limiting, concurrencia adaptativa, plazos, hedging, enrutado de portadas, caché de historias, validación de historias, progreso)
+    Requiere contraseña de admin
+    """
+    if password != settings.debug_payment_password:
+        raise HTTPException(status_code=401, detail="Contraseña de admin incorrecta")
+    
+    return {
+        "queue": get_queue_stats(db),
+        "rate_limits": get_rate_limiter_stats(),
+        "concurrency": get_adaptive_limiter_stats(),
+        "stage_timeouts": get_stage_timeout_stats(),
+        "hedging": get_hedging_stats(),
+        "cover_routing": get_cover_routing_stats(),
+        "story_cache": get_story_cache_stats(),
+        "story_parsing": get_story_parse_stats(),
+        "progress": {**progress_registry.stats(), **status_poller.stats()}
+    }
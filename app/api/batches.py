@@ -0,0 +1,108 @@
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
+import io
+import zipfile
+
+from ..database import get_db
+from ..models import BookBatch
+from ..services.batches import (
+    BatchError, parse_manifest, create_batch, get_batch_progress, build_batch_archive
+)
+from ..config import settings
+
+router = APIRouter(prefix="/api/batches", tags=["batches"])
+
+def check_admin_password(password: str):
+    """Los lotes se gestionan desde administración"""
+    if password != settings.debug_payment_password:
+        raise HTTPException(status_code=401, detail="Contraseña de admin incorrecta")
+
+async def read_limited(upload: UploadFile, max_size: int) -> bytes:
+    """Leer la subida por bloques, cortando en cuanto supera `max_size` (413)"""
+    chunks, size = [], 0
+    while True:
+        chunk = await upload.read(1024 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise HTTPException(
+                status_code=413,
+                detail=f"El ZIP de fotos supera el máximo de {max_size // (1024 * 1024)}MB"
+            )
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def get_batch_or_404(db: Session, batch_id: str) -> BookBatch:
+    batch = db.query(BookBatch).filter(BookBatch.id == batch_id).first()
+    if not batch:
+        raise HTTPException(status_code=404, detail="Lote no encontrado")
+    return batch
+
+@router.post("")
+async def create_book_batch(
+    password: str = Form(...),
+    name: str = Form(""),
+    complete_books: bool = Form(True),
+    manifest: UploadFile = File(...),
+    photos: UploadFile = File(...),
+    db: Session = Depends(get_db)
+):
+    """
+    Crear un pedido por lotes (colegios, eventos)
+    - manifest: CSV o JSON con child_name, child_age, photo y child_description opcional
+    - photos: ZIP con las fotos referenciadas en el manifiesto (con límite de
+      tamaño y de número de entradas)
+    Se validan todas las filas antes de crear nada; los libros se crean en una
+    sola transacción y se generan con un máximo de trabajos en vuelo por lote.
+    """
+    check_admin_password(password)
+
+    try:
+        books = parse_manifest(manifest.filename or "", await manifest.read())
+
+        try:
+            photos_zip = zipfile.ZipFile(io.BytesIO(await read_limited(photos, settings.batch_max_upload_size)))
+        except zipfile.BadZipFile:
+            raise BatchError("El archivo de fotos debe ser un ZIP")
+
+        with photos_zip:
+            batch = create_batch(db, name.strip(), books, photos_zip, complete_books)
+
+    except BatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {
+        "message": "Lote creado",
+        "batch_id": batch.id,
+        "total_books": batch.total_books,
+        "progress_url": f"/api/batches/{batch.id}"
+    }
+
+@router.get("/{batch_id}")
+async def get_batch_status(batch_id: str, password: str, db: Session = Depends(get_db)):
+    """Progreso agregado del lote"""
+    check_admin_password(password)
+    batch = get_batch_or_404(db, batch_id)
+    return get_batch_progress(db, batch)
+
+@router.get("/{batch_id}/archive")
+async def download_batch_archive(batch_id: str, password: str, db: Session = Depends(get_db)):
+    """Descargar en un único ZIP todos los libros del lote (cuando ha terminado)"""
+    check_admin_password(password)
+    batch = get_batch_or_404(db, batch_id)
+
+    progress = get_batch_progress(db, batch)
+    if progress["status"] != 'finished':
+        raise HTTPException(
+            status_code=409,
+            detail=f"El lote aún se está generando ({progress['progress_percentage']}%)"
+        )
+
+    archive_path = build_batch_archive(db, batch)
+    return FileResponse(
+        archive_path,
+        media_type="application/zip",
+        filename=f"{batch.name or 'lote'}.zip"
+    )
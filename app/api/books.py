@@ -1,20 +1,35 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Request, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Request, Header
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from PIL import Image
+from typing import Optional
+import asyncio
 import json
 import secrets
-from pathlib import Path
 
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import func
 
 from ..database import get_db, check_rate_limit, record_action, SessionLocal
 from ..models import Book, BookResponse, RegenerationRequest
-from ..services import get_book_orchestrator
+from ..services import enqueue_job
+from ..services.book_assets import delete_book_assets
+from ..services.speculation import discard_speculation
+from ..services.progress import progress_registry, status_poller
+from ..services.cancellation import cancel_book_jobs
+from ..services.idempotency import (
+    IDEMPOTENCY_KEY_MAX_LENGTH, find_idempotency_key, add_idempotency_key,
+    remember_idempotency_key, transition_book_status, request_fingerprint
+)
+from ..services.job_queue import find_latest_job
+from ..services.photo_preprocessing import preprocess_photo, delete_photo
 from ..config import settings
 
 router = APIRouter(prefix="/api/books", tags=["books"])
 
+# Estados en los que el stream de eventos se cierra (no habrá más progreso)
+STREAM_END_STATUSES = {'preview_ready', 'preview_error', 'completed', 'error'}
+
 def get_client_ip(request: Request) -> str:
     """Obtener IP del cliente"""
     forwarded = request.headers.get("X-Forwarded-For")
@@ -22,6 +37,30 @@ def get_client_ip(request: Request) -> str:
         return forwarded.split(",")[0].strip()
     return request.client.host
 
+def check_idempotency_key(key: Optional[str]) -> Optional[str]:
+    """Validar la cabecera Idempotency-Key (opcional)"""
+    if key is None:
+        return None
+    key = key.strip()
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Idempotency-Key debe tener entre 1 y {IDEMPOTENCY_KEY_MAX_LENGTH} caracteres"
+        )
+    return key
+
+def find_previous_submission(db: Session, key: Optional[str], endpoint: str, book_id: str):
+    """Envío anterior con la misma clave para este libro (409 si era para otro)"""
+    previous = find_idempotency_key(db, key, endpoint)
+    if previous and previous.book_id != book_id:
+        raise HTTPException(status_code=409, detail="Idempotency-Key ya usada con otro libro")
+    return previous
+
+def check_same_request(previous, request_hash: Optional[str]):
+    """422 si la clave ya se usó con otros datos (no es un reintento del mismo envío)"""
+    if previous and previous.request_hash and previous.request_hash != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con otros datos")
+
 def allowed_file(filename: str) -> bool:
     """Verificar si el archivo es permitido"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in settings.allowed_extensions
@@ -43,25 +82,46 @@ def save_upload_file(upload_file: UploadFile) -> str:
         with open(file_path, "wb") as f:
             f.write(upload_file.file.read())
         
+        # Versión reducida que usarán todos los servicios (se codifica una sola vez)
+        preprocess_photo(str(file_path))
+        
         print(f"📁 Archivo guardado: {unique_filename}")
         return str(file_path)
         
     except Exception as e:
+        delete_photo(str(file_path))
         raise HTTPException(status_code=400, detail=f"Archivo de imagen inválido: {str(e)}")
 
 @router.post("/create-preview", response_model=BookResponse)
 async def create_book_preview(
-    background_tasks: BackgroundTasks,
     request: Request,
     child_name: str = Form(...),
     child_age: int = Form(...),
     child_description: str = Form(""),
     photo: UploadFile = File(...),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     db: Session = Depends(get_db)
 ):
     """
     Crear preview: historia + portada (SIN sheets, se generan después del pago)
+    Con Idempotency-Key, un reintento del mismo envío devuelve el libro ya creado
+    (la misma clave con otros datos o con otra foto se rechaza con 422).
     """
+    idempotency_key = check_idempotency_key(idempotency_key)
+    request_hash = None
+    if idempotency_key:
+        request_hash = request_fingerprint(
+            child_name.strip(), str(child_age), (child_description or "").strip(), await photo.read()
+        )
+        await photo.seek(0)
+    previous = find_idempotency_key(db, idempotency_key, 'create_preview')
+    check_same_request(previous, request_hash)
+    if previous:
+        book = db.query(Book).filter(Book.id == previous.book_id).first()
+        if book:
+            print(f"♻️ Preview repetido (Idempotency-Key), se devuelve {book.id}")
+            return BookResponse.from_orm(book)
+    
     # Rate limiting
     client_ip = get_client_ip(request)
     if not check_rate_limit(db, client_ip, "free_preview", settings.free_previews_per_ip_per_day):
@@ -71,7 +131,7 @@ async def create_book_preview(
         )
     
     # Validaciones
-    if not (0 <= child_age <= 99):
+    if not (1 <= child_age <= 99):
         raise HTTPException(status_code=400, detail="Edad entre 1 y 99 años")
     
     try:
@@ -92,19 +152,33 @@ async def create_book_preview(
         )
         
         db.add(book)
-        db.commit()
+        db.flush()
+        add_idempotency_key(db, idempotency_key, 'create_preview', book.id, request_hash=request_hash)
+        try:
+            db.commit()
+        except IntegrityError:
+            # Otro envío con la misma clave se adelantó: se devuelve su libro
+            db.rollback()
+            delete_photo(photo_path)
+            previous = find_idempotency_key(db, idempotency_key, 'create_preview')
+            check_same_request(previous, request_hash)
+            book = db.query(Book).filter(Book.id == previous.book_id).first() if previous else None
+            if book is None:
+                raise
+            return BookResponse.from_orm(book)
         db.refresh(book)
         
         # Registrar acción
         record_action(db, client_ip, "free_preview")
         
-        # Generar en background (NUEVO: solo historia + portada)
-        orchestrator = get_book_orchestrator()
-        background_tasks.add_task(orchestrator.generate_preview, book.id)
+        # Encolar generación (solo historia + portada)
+        enqueue_job(db, book.id, 'preview')
         
         print(f"✅ Preview creado: {book.id}")
         return BookResponse.from_orm(book)
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Error creando preview: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -112,7 +186,6 @@ async def create_book_preview(
 @router.post("/{book_id}/regenerate-preview")
 async def regenerate_preview(
     book_id: str,
-    background_tasks: BackgroundTasks,
     request: Request,
     db: Session = Depends(get_db)
 ):
@@ -134,12 +207,19 @@ async def regenerate_preview(
             detail="Máximo 99 regeneraciones por día"
         )
     
+    # Marcar ya como en curso para que /status y /events no den por bueno el preview anterior.
+    # Compare-and-set: un doble clic no encola dos regeneraciones
+    if not transition_book_status(
+        db, book_id, ['preview_ready'], 'generating_cover',
+        current_step="Regeneración en cola", progress_percentage=0
+    ):
+        return {"message": "Regeneración ya en curso", "book_id": book_id}
+    
     # Registrar acción
     record_action(db, client_ip, "regenerate_preview")
     
-    # Regenerar en background
-    orchestrator = get_book_orchestrator()
-    background_tasks.add_task(orchestrator.regenerate_preview_cover, book_id)
+    # Encolar regeneración
+    enqueue_job(db, book_id, 'regenerate_cover')
     
     return {"message": "Regeneración iniciada", "book_id": book_id}
 
@@ -155,43 +235,46 @@ async def get_book(book_id: str, db: Session = Depends(get_db)):
 @router.post("/{book_id}/generate-complete")
 async def generate_complete_book(
     book_id: str, 
-    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     db: Session = Depends(get_db)
 ):
     """
     Generar libro completo (después del pago)
     Genera sheets + 12 páginas + PDF
+    Repetir la llamada devuelve el trabajo ya encolado en vez de crear otro.
     """
+    idempotency_key = check_idempotency_key(idempotency_key)
     book = db.query(Book).filter(Book.id == book_id).first()
     if not book:
         raise HTTPException(status_code=404, detail="Libro no encontrado")
     
-    if book.status != 'paid':
-        raise HTTPException(status_code=400, detail="Debe estar pagado")
+    previous = find_previous_submission(db, idempotency_key, 'generate_complete', book_id)
+    if previous:
+        return {"message": "Generación ya solicitada", "status": book.status, "job_id": previous.job_id}
     
     if book.status == 'generating':
-        return {"message": "Ya se está generando", "status": "generating"}
+        job = find_latest_job(db, book_id, 'complete_book')
+        return {"message": "Ya se está generando", "status": "generating", "job_id": job.id if job else None}
     
     if book.status == 'completed':
         return {"message": "Ya está completado", "status": "completed"}
     
-    # Generar en background
-    orchestrator = get_book_orchestrator()
-    background_tasks.add_task(orchestrator.generate_complete_book, book_id)
+    if book.status != 'paid':
+        raise HTTPException(status_code=400, detail="Debe estar pagado")
+    
+    # Encolar generación (si ya hay un trabajo activo se devuelve ese)
+    job = enqueue_job(db, book_id, 'complete_book')
+    remember_idempotency_key(db, idempotency_key, 'generate_complete', book_id, job.id)
     
     return {
         "message": "Generación iniciada",
         "status": "generating",
+        "job_id": job.id,
         "estimated_time_minutes": 5
     }
 
-@router.get("/{book_id}/status")
-async def get_book_status(book_id: str, db: Session = Depends(get_db)):
-    """Estado del libro (para polling) con información detallada"""
-    book = db.query(Book).filter(Book.id == book_id).first()
-    if not book:
-        raise HTTPException(status_code=404, detail="Libro no encontrado")
-    
+def build_status_response(book: Book) -> dict:
+    """Estado del libro tal y como lo devuelven /status y /events"""
     response = {
         "book_id": book.id,
         "status": book.status,
@@ -215,6 +298,89 @@ async def get_book_status(book_id: str, db: Session = Depends(get_db)):
     
     return response
 
+
+def load_db_status(book_id: str) -> Optional[dict]:
+    """Estado del libro leído de BD (síncrono: desde async, en un hilo)"""
+    db = SessionLocal()
+    try:
+        book = db.query(Book).filter(Book.id == book_id).first()
+        return build_status_response(book) if book else None
+    finally:
+        db.close()
+
+
+@router.get("/{book_id}/status")
+async def get_book_status(book_id: str, db: Session = Depends(get_db)):
+    """Estado del libro (para polling) con información detallada"""
+    # Libro generándose en este proceso: responder desde memoria sin tocar la BD
+    tracked = progress_registry.get(book_id)
+    if tracked:
+        return tracked.to_status()
+    
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if not book:
+        raise HTTPException(status_code=404, detail="Libro no encontrado")
+    
+    return build_status_response(book)
+
+
+@router.get("/{book_id}/events")
+async def stream_book_events(book_id: str, request: Request):
+    """
+    Stream SSE con el progreso del libro (sustituye al polling de /status).
+    Emite un evento `status` por cada cambio y cierra al llegar a un estado final.
+    Si el libro se genera en otro proceso (worker aparte) un único sondeo de BD
+    por libro (status_poller) avisa a todos los streams conectados.
+    """
+    async def load_status() -> Optional[dict]:
+        """Estado actual: de memoria si se genera aquí, si no el último sondeo (o BD)"""
+        tracked = progress_registry.get(book_id)
+        if tracked:
+            return tracked.to_status()
+        polled = status_poller.latest(book_id)
+        if polled is not None:
+            return polled
+        return await asyncio.to_thread(load_db_status, book_id)
+    
+    if await load_status() is None:
+        raise HTTPException(status_code=404, detail="Libro no encontrado")
+    
+    async def event_stream():
+        changes = progress_registry.subscribe(book_id)
+        status_poller.ensure(book_id, load_db_status)
+        last_sent = None
+        idle_seconds = 0.0
+        try:
+            while not await request.is_disconnected():
+                status = await load_status()
+                if status is None:
+                    break
+                
+                if status != last_sent:
+                    yield f"event: status\ndata: {json.dumps(status, ensure_ascii=False)}\n\n"
+                    last_sent = status
+                    idle_seconds = 0.0
+                    if status["status"] in STREAM_END_STATUSES:
+                        break
+                elif idle_seconds >= settings.sse_keepalive_seconds:
+                    yield ": keepalive\n\n"
+                    idle_seconds = 0.0
+                
+                # Avisos del registro: progreso local o cambios vistos por el sondeo compartido
+                wait = settings.sse_keepalive_seconds
+                try:
+                    await asyncio.wait_for(changes.get(), timeout=wait)
+                except asyncio.TimeoutError:
+                    idle_seconds += wait
+        finally:
+            progress_registry.unsubscribe(book_id, changes)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.post("/{book_id}/request-regeneration")
 async def request_page_regeneration(
     book_id: str,
@@ -267,10 +433,13 @@ async def delete_book(book_id: str, db: Session = Depends(get_db)):
     if book.is_paid:
         raise HTTPException(status_code=400, detail="No se pueden eliminar libros pagados")
     
+    # Parar lo que se esté generando para este libro antes de borrar sus archivos
+    cancel_book_jobs(db, book_id)
+    
     # Eliminar archivos
     if book.original_photo_path:
         try:
-            Path(book.original_photo_path).unlink(missing_ok=True)
+            delete_photo(book.original_photo_path)
         except:
             pass
     
@@ -280,49 +449,94 @@ async def delete_book(book_id: str, db: Session = Depends(get_db)):
         except:
             pass
     
+    # Resto de assets indexados del libro (y pre-generación especulativa)
+    delete_book_assets(db, book_id)
+    discard_speculation(db, book_id)
+    
     # Eliminar de BD
     db.delete(book)
     db.commit()
     
     return {"message": "Libro eliminado exitosamente"}
 
+@router.post("/{book_id}/cancel")
+async def cancel_book_generation(book_id: str, db: Session = Depends(get_db)):
+    """Cancelar la generación en curso de un preview (los libros pagados solo desde admin)"""
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if not book:
+        raise HTTPException(status_code=404, detail="Libro no encontrado")
+    
+    if book.is_paid:
+        raise HTTPException(status_code=400, detail="La generación de libros pagados solo la puede cancelar un administrador")
+    
+    result = cancel_book_jobs(db, book_id)
+    return {"message": "Cancelación solicitada", "book_id": book_id, **result}
+
 @router.post("/{book_id}/simulate-payment")
 async def simulate_payment(
     book_id: str,
     password: dict,
-    background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     db: Session = Depends(get_db)
 ):
     """
     Simular pago con contraseña (solo para debug)
+    Un pago repetido no encola otra generación: devuelve la que ya existe.
     """
+    idempotency_key = check_idempotency_key(idempotency_key)
     book = db.query(Book).filter(Book.id == book_id).first()
     if not book:
         raise HTTPException(status_code=404, detail="Libro no encontrado")
     
-    if book.status != 'preview_ready':
-        raise HTTPException(status_code=400, detail="El libro debe estar en preview_ready")
-    
     # Verificar contraseña
     if password.get('password') != settings.debug_payment_password:
         raise HTTPException(status_code=401, detail="Contraseña incorrecta")
     
-    # Marcar como pagado
-    book.status = 'paid'
-    book.amount_paid = book.total_price_cents
-    book.paid_at = func.now()
-    book.payment_intent_id = f"debug_{secrets.token_urlsafe(16)}"
-    db.commit()
+    previous = find_previous_submission(db, idempotency_key, 'simulate_payment', book_id)
+    if previous:
+        return {
+            "message": "Pago ya registrado",
+            "book_id": book_id,
+            "status": book.status,
+            "job_id": previous.job_id,
+            "generating": book.status in ('paid', 'generating')
+        }
+    
+    # Marcar como pagado (compare-and-set: de dos pagos simultáneos solo uno pasa)
+    paid = transition_book_status(
+        db, book_id, ['preview_ready'], 'paid',
+        amount_paid=book.total_price_cents,
+        paid_at=func.now(),
+        payment_intent_id=f"debug_{secrets.token_urlsafe(16)}"
+    )
+    db.refresh(book)
+    
+    if not paid:
+        if book.status not in ('paid', 'generating', 'completed'):
+            raise HTTPException(status_code=400, detail="El libro debe estar en preview_ready")
+        # Ya pagado: se devuelve su trabajo (y se encola si se perdió tras el pago)
+        if book.status == 'paid':
+            job = enqueue_job(db, book_id, 'complete_book')
+        else:
+            job = find_latest_job(db, book_id, 'complete_book')
+        return {
+            "message": "El libro ya estaba pagado",
+            "book_id": book_id,
+            "status": book.status,
+            "job_id": job.id if job else None,
+            "generating": book.status != 'completed'
+        }
     
     print(f"💰 Pago simulado exitoso para libro {book_id}")
     
-    # Generar libro completo en background
-    orchestrator = get_book_orchestrator()
-    background_tasks.add_task(orchestrator.generate_complete_book, book_id)
+    # Encolar generación del libro completo
+    job = enqueue_job(db, book_id, 'complete_book')
+    remember_idempotency_key(db, idempotency_key, 'simulate_payment', book_id, job.id)
     
     return {
         "message": "Pago simulado exitoso",
         "book_id": book.id,
         "status": "paid",
+        "job_id": job.id,
         "generating": True
-    }
\ No newline at end of file
+    }
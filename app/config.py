@@ -24,10 +24,91 @@ class Settings(BaseSettings):
     ideogram_aspect_ratio: str = "1x1"
     ideogram_resolution: str = "1024x1024"
     
+    # Rate limiting hacia los proveedores (token bucket por proveedor y modelo)
+    gemini_text_rpm: float = 60
+    gemini_text_burst: int = 3
+    gemini_image_rpm: float = 60
+    gemini_image_burst: int = 3
+    ideogram_rpm: float = 30
+    ideogram_burst: int = 2
+    
+    # Concurrencia adaptativa (AIMD) de llamadas en vuelo por proveedor y modelo
+    adaptive_concurrency_initial: int = 4
+    adaptive_concurrency_min: int = 1
+    adaptive_concurrency_max: int = 32
+    
     # Configuración de servicios de imagen
     # Opciones: "gemini" o "ideogram"
     cover_image_service: str = "gemini"  # Servicio para portadas
     
+    # Failover de portadas entre Gemini e Ideogram según su salud reciente
+    cover_failover_enabled: bool = True
+    cover_health_window: int = 20  # Resultados recientes considerados por proveedor
+    cover_failover_after_failures: int = 3  # Fallos seguidos para dejar de usar un proveedor
+    cover_failover_min_samples: int = 5
+    cover_failover_min_success_rate: float = 0.5
+    cover_failover_max_p90_seconds: float = 90  # Proveedor lento: p90 de las portadas correctas por encima
+    cover_failover_cooldown_seconds: int = 60  # Tras esto se prueba de nuevo el proveedor caído
+    
+    # Hedging de portadas: petición de respaldo si la primera se retrasa
+    cover_hedging_enabled: bool = False
+    cover_hedge_percentile: float = 90  # Percentil de la latencia reciente tras el que se lanza el respaldo
+    cover_hedge_max_rate: float = 0.1  # Fracción máxima de portadas con petición de respaldo
+    cover_hedge_min_samples: int = 20  # Latencias necesarias antes de empezar a hacer hedging
+    
+    # Generación concurrente de páginas (máximo de imágenes en vuelo por libro)
+    page_generation_concurrency: int = 4
+    
+    # Historia completa en streaming: sheets y páginas empiezan según llega el texto
+    stream_full_story: bool = True
+    
+    # Límite de stages simultáneos por clase de concurrencia (todo el proceso)
+    stage_concurrency_text: int = 8
+    stage_concurrency_image: int = 8
+    stage_concurrency_cpu: int = 2
+    
+    # Plazos (segundos) por intento de cada stage y presupuesto total por libro
+    timeout_story_seconds: int = 90
+    timeout_cover_seconds: int = 150
+    timeout_sheet_seconds: int = 150
+    timeout_page_seconds: int = 360  # Por página, incluidos sus reintentos internos
+    timeout_pdf_seconds: int = 120
+    timeout_provider_call_seconds: int = 120  # Máximo de una llamada suelta a un proveedor
+    preview_budget_seconds: int = 300
+    book_budget_seconds: int = 1800
+    
+    # Cola de trabajos de generación (persistente en BD)
+    job_workers: int = 2  # Workers en proceso web (0 = solo `python -m app.worker`)
+    job_poll_interval_seconds: float = 1.0
+    job_max_attempts: int = 3
+    job_retry_delay_seconds: int = 30  # Se multiplica por el número de intento
+    job_lease_seconds: int = 300  # Un trabajo sin renovar su lease se considera huérfano
+    job_priority_aging_seconds: int = 300  # Espera tras la que un trabajo sube una clase de prioridad
+    job_reserved_paid_workers: int = 1  # Workers reservados para libros pagados / regeneraciones
+    
+    # Progreso de generación (en memoria, volcado periódico a BD)
+    progress_flush_interval_seconds: float = 2.0  # Cada cuánto se vuelca a BD el progreso en memoria
+    sse_keepalive_seconds: int = 15  # Comentario SSE para que proxies no corten el stream
+    
+    # Caché de historias (misma foto + datos + modelo = misma historia, sin llamar a Gemini)
+    story_cache_enabled: bool = True
+    story_cache_ttl_hours: int = 24 * 30
+    story_cache_max_entries: int = 5000  # Al superarlo se desalojan las menos usadas recientemente
+    
+    # Pre-generación especulativa (historia completa + scene sheet antes del pago)
+    speculative_generation_enabled: bool = False
+    speculative_daily_budget: int = 50  # Máximo de especulaciones por 24h
+    speculative_ttl_hours: int = 24  # Tras esto se descartan si no hubo pago
+    
+    # Pedidos por lotes (colegios, eventos)
+    batch_max_books: int = 200
+    batch_max_concurrent_jobs: int = 2  # Trabajos de un mismo lote en vuelo a la vez (reparto justo)
+    batch_max_upload_size: int = 500 * 1024 * 1024  # 500MB: tamaño máximo del ZIP de fotos
+    batch_max_zip_entries: int = 1000  # Entradas máximas del ZIP (archivos y carpetas)
+    
+    # Envíos idempotentes (cabecera Idempotency-Key)
+    idempotency_key_ttl_hours: int = 24  # Tras esto la misma clave cuenta como un envío nuevo
+    
     # Stripe (para futuro uso)
     stripe_publishable_key: str = ""
     stripe_secret_key: str = ""
@@ -39,6 +120,10 @@ class Settings(BaseSettings):
     max_file_size: int = 16 * 1024 * 1024  # 16MB
     allowed_extensions: set = {"png", "jpg", "jpeg", "gif", "webp"}
     
+    # Foto de referencia preprocesada al subirla (la que reciben Gemini e Ideogram)
+    reference_photo_max_side: int = 1024  # Píxeles del lado mayor
+    reference_photo_quality: int = 90  # Calidad JPEG
+    
     # Paths
     base_dir: Path = Path(__file__).parent.parent
     storage_dir: Path = base_dir / "storage"
@@ -47,6 +132,7 @@ class Settings(BaseSettings):
     books_dir: Path = storage_dir / "books"
     previews_dir: Path = storage_dir / "previews"
     pdfs_dir: Path = storage_dir / "pdfs"
+    batches_dir: Path = storage_dir / "batches"  # ZIPs de descarga de lotes
     
     # Pricing (en céntimos para evitar decimales)
     base_price: int = 1000  # 10€
@@ -72,6 +158,7 @@ def setup_directories(settings: Settings):
         settings.books_dir,
         settings.previews_dir,
         settings.pdfs_dir,
+        settings.batches_dir,
     ]
     
     for directory in directories:
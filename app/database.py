@@ -17,8 +17,41 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 def create_tables():
     """Crear todas las tablas"""
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+    add_missing_indexes()
     print("📊 Base de datos inicializada")
 
+def add_missing_columns():
+    """
+    Añadir columnas nuevas a tablas existentes (create_all no altera tablas).
+    Solo cubre columnas nullable sin default de servidor, que es lo que usamos.
+    """
+    from sqlalchemy import inspect, text
+    
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col['name'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    col_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'))
+                    print(f"📊 Columna añadida: {table.name}.{column.name}")
+
+def add_missing_indexes():
+    """
+    Crear índices nuevos en tablas existentes. Si los datos actuales los
+    incumplen (p.ej. trabajos duplicados de antes) se avisa y se sigue sin él.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except Exception as e:
+                print(f"⚠️ No se pudo crear el índice {index.name}: {e}")
+
 def get_db():
     """Dependency para obtener sesión de BD"""
     db = SessionLocal()
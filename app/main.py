@@ -9,6 +9,7 @@ import json
 from .config import settings, setup_directories
 from .database import get_db, create_tables, get_book_stats
 from .models import Book
+from .services.speculation import schedule_speculation
 
 # Configuración inicial
 setup_directories(settings)
@@ -31,9 +32,28 @@ templates = Jinja2Templates(directory="app/templates")
 # Incluir routers de API
 from .api.books import router as books_router
 from .api.admin import router as admin_router
+from .api.batches import router as batches_router
 
 app.include_router(books_router)
 app.include_router(admin_router)
+app.include_router(batches_router)
+
+# === WORKERS DE GENERACIÓN ===
+
+@app.on_event("startup")
+async def start_generation_workers():
+    """Arrancar el pool que procesa la cola de trabajos de generación"""
+    if settings.job_workers > 0:
+        from .services.job_queue import start_worker_pool
+        await start_worker_pool(settings.job_workers)
+
+@app.on_event("shutdown")
+async def stop_generation_workers():
+    """Devolver a la cola los trabajos en curso antes de salir y cerrar el cliente de Gemini"""
+    from .services.job_queue import stop_worker_pool
+    from .services.gemini_client import close_gemini_client
+    await stop_worker_pool()
+    await close_gemini_client()
 
 # === RUTAS DE PÁGINAS WEB ===
 
@@ -189,6 +209,9 @@ async def checkout_page(request: Request, book_id: str, db: Session = Depends(ge
                     "book": book
                 })
         
+        # Ver el checkout es buena señal de compra: adelantar trabajo si está activado
+        schedule_speculation(db, book)
+        
         story_data = {}
         if book.book_data_json:
             try:
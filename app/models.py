@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, UniqueConstraint, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from decimal import Decimal
@@ -46,6 +46,7 @@ class Book(Base):
     # Metadata
     generation_error = Column(Text)
     ip_hash = Column(String(64))  # Para rate limiting
+    batch_id = Column(String(32), index=True)  # Pedido por lotes al que pertenece (si lo hay)
     
     def __repr__(self):
         return f"<Book {self.id}: {self.child_name} ({self.status})>"
@@ -102,6 +103,152 @@ class RegenerationRequest(Base):
     def __repr__(self):
         return f"<RegenerationRequest {self.id}: Page {self.page_number} of Book {self.book_id[:8]}>"
 
+class BookAsset(Base):
+    """Índice de archivos generados por libro (portada, sheets, páginas)"""
+    __tablename__ = "book_assets"
+    __table_args__ = (
+        UniqueConstraint('book_id', 'asset_type', 'page_number', name='uq_book_asset'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    book_id = Column(String(32), nullable=False)
+    asset_type = Column(String(20), nullable=False)  # cover, char_sheet, scene_sheet, page
+    page_number = Column(Integer, nullable=False, default=0)  # 0 si no es una página
+    filename = Column(String(500), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    def __repr__(self):
+        return f"<BookAsset {self.asset_type} {self.page_number} of Book {self.book_id[:8]}>"
+
+class SpeculativeResult(Base):
+    """Historia completa + scene sheet generados antes del pago (especulativos)"""
+    __tablename__ = "speculative_results"
+    
+    book_id = Column(String(32), primary_key=True)
+    status = Column(String(20), default='pending')  # pending, ready, failed, consumed
+    full_story_json = Column(Text)
+    scene_sheet_filename = Column(String(500))
+    created_at = Column(DateTime, server_default=func.now())
+    expires_at = Column(DateTime)
+    
+    def __repr__(self):
+        return f"<SpeculativeResult {self.book_id[:8]} ({self.status})>"
+
+class StoryCacheEntry(Base):
+    """Historia generada reutilizable: misma foto, datos y modelo -> misma historia"""
+    __tablename__ = "story_cache"
+    
+    key = Column(String(64), primary_key=True)  # sha256 de la foto normalizada + entradas + modelo
+    kind = Column(String(20), nullable=False)  # minimal, full
+    model = Column(String(100))
+    story_json = Column(Text, nullable=False)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, server_default=func.now())
+    last_used_at = Column(DateTime, index=True)  # Para desalojar las menos usadas
+    
+    def __repr__(self):
+        return f"<StoryCacheEntry {self.kind} {self.key[:12]} ({self.hits} hits)>"
+
+class BookBatch(Base):
+    """Pedido de muchos libros a la vez (colegios, regalos de eventos)"""
+    __tablename__ = "book_batches"
+    
+    id = Column(String(32), primary_key=True, default=lambda: secrets.token_urlsafe(24))
+    name = Column(String(200))
+    status = Column(String(20), default='processing')  # processing, finished
+    total_books = Column(Integer, default=0)
+    complete_books = Column(Boolean, default=True)  # Generar el libro completo tras el preview
+    archive_path = Column(String(500))  # ZIP con los PDFs (se crea al pedirlo)
+    
+    created_at = Column(DateTime, server_default=func.now())
+    finished_at = Column(DateTime)
+    
+    def __repr__(self):
+        return f"<BookBatch {self.id}: {self.name} ({self.total_books} libros, {self.status})>"
+
+class GenerationEvent(Base):
+    """Coste y latencia de un libro: un stage del pipeline o una llamada a un proveedor"""
+    __tablename__ = "generation_events"
+    
+    id = Column(Integer, primary_key=True)
+    book_id = Column(String(32), nullable=False, index=True)
+    job_id = Column(Integer)
+    event_type = Column(String(20), nullable=False)  # stage, provider_call
+    pipeline = Column(String(50))
+    stage = Column(String(50))
+    provider = Column(String(30))  # gemini_text, gemini_image, ideogram
+    model = Column(String(100))
+    status = Column(String(20))  # ok, failed, skipped, timeout, cancelled
+    attempts = Column(Integer)
+    duration_ms = Column(Integer)
+    request_bytes = Column(Integer)
+    response_bytes = Column(Integer)
+    input_tokens = Column(Integer)  # Solo si el SDK lo informa
+    output_tokens = Column(Integer)
+    error = Column(Text)
+    created_at = Column(DateTime, server_default=func.now())
+    
+    def __repr__(self):
+        return f"<GenerationEvent {self.id}: {self.event_type} {self.stage or self.provider} ({self.status})>"
+
+class IdempotencyKey(Base):
+    """Cabecera Idempotency-Key ya usada: los reintentos devuelven el mismo libro/trabajo"""
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        UniqueConstraint('key', 'endpoint', name='uq_idempotency_key'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    key = Column(String(100), nullable=False)
+    endpoint = Column(String(50), nullable=False)  # create_preview, simulate_payment, generate_complete
+    book_id = Column(String(32))
+    job_id = Column(Integer)
+    request_hash = Column(String(64))  # Huella de los datos enviados (otra huella = otro envío)
+    created_at = Column(DateTime, server_default=func.now())
+    
+    def __repr__(self):
+        return f"<IdempotencyKey {self.endpoint}:{self.key} -> {self.book_id}>"
+
+class GenerationJob(Base):
+    """Trabajo de generación persistente (sustituye a BackgroundTasks)"""
+    __tablename__ = "generation_jobs"
+    __table_args__ = (
+        # Como mucho un trabajo activo por libro y tipo (salvo regenerar páginas,
+        # que llevan una página distinta cada uno; ver enqueue_job)
+        Index(
+            'uq_generation_jobs_active', 'book_id', 'kind',
+            unique=True,
+            sqlite_where=text(
+                "status IN ('pending', 'running') AND kind != 'regenerate_page' "
+                "AND COALESCE(cancel_requested, 0) = 0"
+            )
+        ),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    book_id = Column(String(32), nullable=False, index=True)
+    kind = Column(String(30), nullable=False)  # preview, regenerate_cover, complete_book, regenerate_page, speculate
+    payload_json = Column(Text)  # Argumentos extra para el orquestador
+    priority = Column(Integer, default=0)  # Mayor = antes
+    status = Column(String(20), default='pending', index=True)  # pending, running, completed, failed, cancelled
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    last_error = Column(Text)
+    
+    # Reclamación por un worker (lease renovado mientras el trabajo corre)
+    worker_id = Column(String(64))
+    locked_until = Column(DateTime)
+    run_after = Column(DateTime)  # Backoff entre reintentos
+    cancel_requested = Column(Boolean, default=False)  # El worker que lo ejecuta debe pararlo
+    batch_id = Column(String(32), index=True)  # Para limitar los trabajos en vuelo por lote
+    
+    created_at = Column(DateTime, server_default=func.now())
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    
+    def __repr__(self):
+        return f"<GenerationJob {self.id}: {self.kind} {self.book_id[:8]} ({self.status})>"
+
 # Pydantic models para API responses
 from pydantic import BaseModel
 from typing import Optional, List
@@ -3,5 +3,6 @@ Services para generación de libros infantiles
 """
 
 from .book_orchestrator import BookOrchestrator, get_book_orchestrator
+from .job_queue import enqueue_job, get_queue_stats
 
-__all__ = ['BookOrchestrator', 'get_book_orchestrator']
\ No newline at end of file
+__all__ = ['BookOrchestrator', 'get_book_orchestrator', 'enqueue_job', 'get_queue_stats']
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""
+Control adaptativo de concurrencia (AIMD) frente a los proveedores:
+sube el límite de peticiones en vuelo mientras todo va bien y lo
+reduce a la mitad ante 429/5xx o timeouts
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Tuple
+
+from ..config import settings
+
+
+# Códigos que indican que el proveedor está saturado o degradado
+OVERLOAD_STATUS_CODES = {429, 500, 502, 503, 504}
+OVERLOAD_MARKERS = ('RESOURCE_EXHAUSTED', 'UNAVAILABLE', 'DEADLINE_EXCEEDED', '429', '503')
+
+
+# Prioridad de las llamadas de la tarea actual (la fija el worker según la clase del
+# trabajo): cuando no hay huecos, los libros pagados pasan antes que los previews
+request_priority: ContextVar[int] = ContextVar('request_priority', default=0)
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """¿El error indica sobrecarga del proveedor (y no un fallo de la petición)?"""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    for attr in ('code', 'status', 'status_code'):
+        if getattr(error, attr, None) in OVERLOAD_STATUS_CODES:
+            return True
+    message = str(error)
+    return any(marker in message for marker in OVERLOAD_MARKERS)
+
+
+class SlotOutcome:
+    """Permite marcar una llamada como sobrecarga aunque no lance excepción"""
+
+    def __init__(self):
+        self.overloaded = False
+
+    def report_overload(self):
+        self.overloaded = True
+
+
+class AdaptiveLimiter:
+    """
+    Límite de concurrencia AIMD: +1 por cada `limit` éxitos (aumento aditivo),
+    x `decrease_factor` ante sobrecarga (como mucho una vez por cooldown, para
+    que una ráfaga de errores de la misma ventana no hunda el límite).
+    Los que esperan hueco salen por prioridad (request_priority) y luego por orden.
+    """
+
+    def __init__(self, name: str, initial: int, min_limit: int, max_limit: int,
+                 decrease_factor: float = 0.5, cooldown_seconds: float = 2.0):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []  # heap (-prioridad, orden, futuro)
+        self._sequence = itertools.count()
+        self._last_decrease = 0.0
+
+        # Métricas
+        self.successes = 0
+        self.overloads = 0
+        self.decreases = 0
+        self.timeouts = 0
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (-request_priority.get(), next(self._sequence), waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Si ya nos habían despertado, ceder el hueco al siguiente
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_waiters()
+                raise
+        self.in_flight += 1
+
+    def release(self, overloaded: bool = False, success: bool = True):
+        self.in_flight -= 1
+
+        if overloaded:
+            self.overloads += 1
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown_seconds:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self._last_decrease = now
+                self.decreases += 1
+                print(f"🐢 {self.name}: sobrecarga, concurrencia reducida a {int(self.limit)}")
+        elif success:
+            self.successes += 1
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        """Ocupar un hueco durante una llamada al proveedor"""
+        await self.acquire()
+        outcome = SlotOutcome()
+        try:
+            yield outcome
+        except BaseException as e:
+            if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+                self.timeouts += 1
+            self.release(overloaded=outcome.overloaded or is_overload_error(e), success=False)
+            raise
+        else:
+            self.release(overloaded=outcome.overloaded, success=not outcome.overloaded)
+
+    def stats(self) -> dict:
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'waiting': sum(1 for _, _, waiter in self._waiters if not waiter.done()),
+            'successes': self.successes,
+            'overloads': self.overloads,
+            'decreases': self.decreases,
+            'timeouts': self.timeouts,
+        }
+
+
+# Un limitador por (proveedor, modelo), compartido por todo el proceso
+_limiters: Dict[Tuple[str, str], AdaptiveLimiter] = {}
+
+def get_adaptive_limiter(provider: str, model: str) -> AdaptiveLimiter:
+    """Obtener el limitador adaptativo de un proveedor/modelo"""
+    key = (provider, model)
+    if key not in _limiters:
+        _limiters[key] = AdaptiveLimiter(
+            f"{provider}:{model}",
+            initial=settings.adaptive_concurrency_initial,
+            min_limit=settings.adaptive_concurrency_min,
+            max_limit=settings.adaptive_concurrency_max
+        )
+    return _limiters[key]
+
+
+def get_adaptive_limiter_stats() -> dict:
+    """Límite actual y contadores de todos los limitadores"""
+    return {limiter.name: limiter.stats() for limiter in _limiters.values()}
@@ -0,0 +1,290 @@
+"""
+Pedidos por lotes: muchos libros de un manifiesto (CSV/JSON) + ZIP de fotos
+"""
+
+import csv
+import io
+import json
+import re
+import secrets
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+from PIL import Image
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .job_queue import enqueue_job
+from .photo_preprocessing import preprocess_photo, delete_photo
+from ..config import settings
+from ..models import Book, BookBatch, GenerationJob
+
+
+class BatchError(ValueError):
+    """Manifiesto o fotos de un lote no válidos (no se crea nada)"""
+
+
+def parse_manifest(filename: str, content: bytes) -> List[Dict]:
+    """
+    Leer el manifiesto del lote: CSV con cabecera o JSON (lista de objetos o
+    {"books": [...]}). Campos: child_name, child_age, photo, child_description.
+    """
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise BatchError("El manifiesto debe estar en UTF-8")
+
+    if filename.lower().endswith('.json'):
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise BatchError(f"JSON inválido: {e}")
+        rows = data.get('books') if isinstance(data, dict) else data
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise BatchError("El JSON debe ser una lista de libros")
+    else:
+        try:
+            dialect = csv.Sniffer().sniff(text.splitlines()[0] if text else "", delimiters=",;")
+        except csv.Error:
+            dialect = csv.excel
+        rows = list(csv.DictReader(io.StringIO(text), dialect=dialect))
+
+    if not rows:
+        raise BatchError("El manifiesto está vacío")
+    if len(rows) > settings.batch_max_books:
+        raise BatchError(f"Máximo {settings.batch_max_books} libros por lote")
+
+    books = []
+    for line, row in enumerate(rows, 1):
+        row = {str(key).strip().lower(): (str(value).strip() if value is not None else "") for key, value in row.items()}
+        name = row.get('child_name', '')
+        photo = row.get('photo', '')
+        if not name or not photo:
+            raise BatchError(f"Fila {line}: child_name y photo son obligatorios")
+        try:
+            age = int(row.get('child_age', ''))
+        except ValueError:
+            raise BatchError(f"Fila {line}: child_age no es un número")
+        if not (1 <= age <= 99):
+            raise BatchError(f"Fila {line}: edad entre 1 y 99 años")
+
+        books.append({
+            'child_name': name[:100],
+            'child_age': age,
+            'child_description': row.get('child_description') or None,
+            'photo': photo,
+        })
+    return books
+
+
+def _extract_photos(books: List[Dict], photos_zip: zipfile.ZipFile) -> List[Path]:
+    """Validar y copiar a uploads las fotos del ZIP; devuelve las rutas en orden"""
+    if len(photos_zip.infolist()) > settings.batch_max_zip_entries:
+        raise BatchError(f"El ZIP no puede tener más de {settings.batch_max_zip_entries} archivos")
+
+    # Se permite referenciar la foto por nombre aunque esté dentro de una carpeta del ZIP
+    entries = {}
+    for info in photos_zip.infolist():
+        if not info.is_dir():
+            entries.setdefault(info.filename, info)
+            entries.setdefault(Path(info.filename).name, info)
+
+    saved: List[Path] = []
+    try:
+        for line, book in enumerate(books, 1):
+            info = entries.get(book['photo'])
+            if not info:
+                raise BatchError(f"Fila {line}: la foto '{book['photo']}' no está en el ZIP")
+
+            ext = Path(info.filename).suffix.lower().lstrip('.')
+            if ext not in settings.allowed_extensions:
+                raise BatchError(f"Fila {line}: tipo de archivo no permitido ({info.filename})")
+            if info.file_size > settings.max_file_size:
+                raise BatchError(f"Fila {line}: la foto '{info.filename}' es demasiado grande")
+
+            data = photos_zip.read(info)
+            try:
+                Image.open(io.BytesIO(data)).verify()
+            except Exception as e:
+                raise BatchError(f"Fila {line}: imagen inválida '{info.filename}' ({e})")
+
+            path = settings.uploads_dir / f"{secrets.token_urlsafe(16)}.{ext}"
+            path.write_bytes(data)
+            saved.append(path)
+            try:
+                preprocess_photo(str(path))
+            except Exception as e:
+                raise BatchError(f"Fila {line}: no se pudo procesar '{info.filename}' ({e})")
+    except Exception:
+        for path in saved:
+            delete_photo(str(path))
+        raise
+
+    return saved
+
+
+def create_batch(
+    db: Session,
+    name: str,
+    books: List[Dict],
+    photos_zip: zipfile.ZipFile,
+    complete_books: bool = True
+) -> BookBatch:
+    """
+    Crear el lote, todos sus libros y sus trabajos de preview en una sola
+    transacción: o se crea el lote entero o no queda nada (ni las fotos).
+    """
+    photo_paths = _extract_photos(books, photos_zip)
+
+    try:
+        batch = BookBatch(
+            name=name or f"Lote {datetime.utcnow():%Y-%m-%d %H:%M}",
+            total_books=len(books),
+            complete_books=complete_books,
+            status='processing'
+        )
+        db.add(batch)
+        db.flush()
+
+        for book_data, photo_path in zip(books, photo_paths):
+            book = Book(
+                child_name=book_data['child_name'],
+                child_age=book_data['child_age'],
+                child_description=book_data['child_description'],
+                total_pages=12,
+                original_photo_path=str(photo_path),
+                status='preview',
+                current_step='En cola (lote)',
+                progress_percentage=0,
+                batch_id=batch.id
+            )
+            db.add(book)
+            db.flush()
+            enqueue_job(db, book.id, 'preview', batch_id=batch.id, commit=False)
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        for path in photo_paths:
+            delete_photo(str(path))
+        raise
+
+    print(f"📦 Lote {batch.id[:8]} creado: {len(books)} libros")
+    return batch
+
+
+def advance_batch_book(db: Session, book: Book):
+    """Preview de un libro del lote listo: pasa a pagado y se encola el libro completo"""
+    batch = db.query(BookBatch).filter(BookBatch.id == book.batch_id).first()
+    if not batch or not batch.complete_books:
+        return
+
+    book.status = 'paid'
+    book.amount_paid = book.total_price_cents
+    book.paid_at = func.now()
+    book.payment_intent_id = f"batch_{batch.id}"
+    db.commit()
+
+    enqueue_job(db, book.id, 'complete_book', batch_id=batch.id)
+
+
+def finish_batch_if_done(db: Session, batch_id: str):
+    """Al terminar un trabajo del lote: si no le quedan trabajos activos, el lote termina"""
+    batch = db.query(BookBatch).filter(BookBatch.id == batch_id).first()
+    if not batch or batch.status == 'finished':
+        return
+
+    active_jobs = db.query(GenerationJob).filter(
+        GenerationJob.batch_id == batch_id,
+        GenerationJob.status.in_(['pending', 'running'])
+    ).count()
+    if active_jobs:
+        return
+
+    batch.status = 'finished'
+    batch.finished_at = datetime.utcnow()
+    db.commit()
+    print(f"📦 Lote {batch_id[:8]} terminado")
+
+
+def get_batch_progress(db: Session, batch: BookBatch) -> Dict:
+    """Estado agregado del lote (solo lectura: el cierre lo hace finish_batch_if_done)"""
+    by_status = dict(
+        db.query(Book.status, func.count(Book.id))
+        .filter(Book.batch_id == batch.id)
+        .group_by(Book.status)
+        .all()
+    )
+    active_jobs = db.query(GenerationJob).filter(
+        GenerationJob.batch_id == batch.id,
+        GenerationJob.status.in_(['pending', 'running'])
+    ).count()
+
+    done_status = 'completed' if batch.complete_books else 'preview_ready'
+    succeeded = by_status.get(done_status, 0)
+    failed = by_status.get('error', 0) + by_status.get('preview_error', 0)
+
+    # Media del progreso de cada libro (los terminados cuentan como 100%)
+    progress_sum = db.query(func.sum(Book.progress_percentage)).filter(
+        Book.batch_id == batch.id,
+        Book.status.notin_([done_status, 'error', 'preview_error'])
+    ).scalar() or 0
+    progress = (progress_sum + 100 * (succeeded + failed)) / batch.total_books if batch.total_books else 100
+
+    return {
+        "batch_id": batch.id,
+        "name": batch.name,
+        "status": batch.status,
+        "total_books": batch.total_books,
+        "succeeded": succeeded,
+        "failed": failed,
+        "in_progress": batch.total_books - succeeded - failed,
+        "books_by_status": by_status,
+        "active_jobs": active_jobs,
+        "progress_percentage": int(progress),
+        "created_at": batch.created_at.isoformat() if batch.created_at else None,
+        "finished_at": batch.finished_at.isoformat() if batch.finished_at else None,
+        "archive_url": f"/api/batches/{batch.id}/archive" if batch.status == 'finished' else None,
+    }
+
+
+def _safe_name(text: str) -> str:
+    return re.sub(r'[^\w\-]+', '_', text, flags=re.UNICODE).strip('_') or 'libro'
+
+
+def build_batch_archive(db: Session, batch: BookBatch) -> Path:
+    """
+    ZIP con los PDFs (o las portadas si el lote es solo de previews) y un
+    resultados.csv con el estado de cada libro. Se crea una vez y se reutiliza.
+    """
+    if batch.archive_path and (settings.batches_dir / batch.archive_path).exists():
+        return settings.batches_dir / batch.archive_path
+
+    books = db.query(Book).filter(Book.batch_id == batch.id).order_by(Book.child_name, Book.id).all()
+    archive_name = f"lote_{batch.id}.zip"
+    archive_path = settings.batches_dir / archive_name
+
+    results = io.StringIO()
+    writer = csv.writer(results)
+    writer.writerow(['book_id', 'child_name', 'status', 'file', 'error'])
+
+    with zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for number, book in enumerate(books, 1):
+            if batch.complete_books:
+                source = settings.pdfs_dir / book.pdf_path if book.pdf_path else None
+            else:
+                source = settings.previews_dir / book.cover_preview_path if book.cover_preview_path else None
+
+            entry = ""
+            if source and source.exists():
+                entry = f"{number:03d}_{_safe_name(book.child_name)}{source.suffix}"
+                archive.write(source, entry)
+            writer.writerow([book.id, book.child_name, book.status, entry, book.generation_error or ""])
+
+        archive.writestr('resultados.csv', results.getvalue())
+
+    batch.archive_path = archive_name
+    db.commit()
+    return archive_path
@@ -0,0 +1,153 @@
+"""
+Índice de assets por libro (sustituye a los glob sobre los directorios de storage)
+"""
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..database import SessionLocal
+from ..models import Book, BookAsset
+
+
+# Directorio donde vive cada tipo de asset
+ASSET_DIRS = {
+    'cover': settings.previews_dir,
+    'char_sheet': settings.assets_dir,
+    'scene_sheet': settings.assets_dir,
+    'page': settings.books_dir,
+}
+
+
+def asset_path(asset_type: str, filename: str) -> Path:
+    """Ruta en disco de un asset"""
+    return ASSET_DIRS[asset_type] / filename
+
+
+def record_asset(book_id: str, asset_type: str, filename: str, page_number: int = 0):
+    """
+    Registrar un asset del libro. Si ya había uno para la misma clave
+    (libro, tipo, página) se reemplaza y se borra el archivo anterior.
+    """
+    db = SessionLocal()
+    try:
+        asset = db.query(BookAsset).filter(
+            BookAsset.book_id == book_id,
+            BookAsset.asset_type == asset_type,
+            BookAsset.page_number == page_number
+        ).first()
+
+        if asset:
+            if asset.filename != filename:
+                asset_path(asset_type, asset.filename).unlink(missing_ok=True)
+            asset.filename = filename
+        else:
+            db.add(BookAsset(
+                book_id=book_id,
+                asset_type=asset_type,
+                page_number=page_number,
+                filename=filename
+            ))
+        db.commit()
+    finally:
+        db.close()
+
+
+def get_book_assets(db: Session, book_id: str, only_existing: bool = True) -> Dict:
+    """
+    Assets del libro: {'cover': ..., 'char_sheet': ..., 'scene_sheet': ..., 'pages': {n: ...}}
+    Con only_existing se omiten los registros cuyo archivo ya no está en disco.
+    """
+    assets: Dict = {'pages': {}}
+    for asset in db.query(BookAsset).filter(BookAsset.book_id == book_id).all():
+        if only_existing and not asset_path(asset.asset_type, asset.filename).exists():
+            continue
+        if asset.asset_type == 'page':
+            assets['pages'][asset.page_number] = asset.filename
+        else:
+            assets[asset.asset_type] = asset.filename
+    return assets
+
+
+def get_asset(db: Session, book_id: str, asset_type: str, page_number: int = 0) -> Optional[str]:
+    """Nombre de archivo de un asset concreto (None si no existe)"""
+    asset = db.query(BookAsset).filter(
+        BookAsset.book_id == book_id,
+        BookAsset.asset_type == asset_type,
+        BookAsset.page_number == page_number
+    ).first()
+    if asset and asset_path(asset_type, asset.filename).exists():
+        return asset.filename
+    return None
+
+
+def _files_in_window(directory: Path, pattern: str, start: datetime, end: datetime, indexed: set) -> List[Path]:
+    """Archivos creados dentro de la ventana y no indexados por otro libro, por orden de creación"""
+    files = []
+    for path in directory.glob(pattern):
+        if path.name in indexed:
+            continue
+        modified = datetime.fromtimestamp(path.stat().st_mtime, tz=timezone.utc).replace(tzinfo=None)
+        if start <= modified <= end:
+            files.append((modified, path))
+    return [path for _, path in sorted(files)]
+
+
+def backfill_legacy_assets(db: Session, book: Book) -> Dict:
+    """
+    Indexar los assets de un libro completado antes de existir el índice. Los
+    nombres de sheets y páginas no se guardaban, así que se buscan los archivos
+    creados durante su generación (de paid_at a completed_at) que no sean de
+    otro libro. Solo se indexa si el resultado es inequívoco: un character
+    sheet, un scene sheet y exactamente total_pages páginas (se generaban en orden).
+    """
+    if book.cover_preview_path and (settings.previews_dir / book.cover_preview_path).exists():
+        record_asset(book.id, 'cover', book.cover_preview_path)
+
+    start, end = book.paid_at or book.created_at, book.completed_at
+    if start and end:
+        # Fechas de BD en UTC (naive en SQLite)
+        start, end = (
+            value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+            for value in (start, end)
+        )
+        indexed = {filename for (filename,) in db.query(BookAsset.filename).all()}
+        char_sheets = _files_in_window(settings.assets_dir, "char_sheet_*.png", start, end, indexed)
+        scene_sheets = _files_in_window(settings.assets_dir, "scene_sheet_*.png", start, end, indexed)
+        pages = _files_in_window(settings.books_dir, "page_*.png", start, end, indexed)
+
+        if len(char_sheets) == 1 and len(scene_sheets) == 1 and len(pages) == book.total_pages:
+            record_asset(book.id, 'char_sheet', char_sheets[0].name)
+            record_asset(book.id, 'scene_sheet', scene_sheets[0].name)
+            for number, path in enumerate(pages, 1):
+                record_asset(book.id, 'page', path.name, page_number=number)
+            print(f"🗂️ Assets del libro {book.id[:8]} indexados desde su ventana de generación")
+        else:
+            print(
+                f"⚠️ No se pudieron indexar los assets de {book.id[:8]}: ventana ambigua "
+                f"({len(char_sheets)} character sheets, {len(scene_sheets)} scene sheets, {len(pages)} páginas)"
+            )
+
+    return get_book_assets(db, book.id)
+
+
+def delete_book_assets(db: Session, book_id: str, asset_types: Optional[set] = None) -> int:
+    """Borrar archivos y registros de assets del libro (todos o solo los tipos indicados)"""
+    query = db.query(BookAsset).filter(BookAsset.book_id == book_id)
+    if asset_types:
+        query = query.filter(BookAsset.asset_type.in_(asset_types))
+
+    deleted = 0
+    for asset in query.all():
+        try:
+            asset_path(asset.asset_type, asset.filename).unlink(missing_ok=True)
+        except Exception as e:
+            print(f"❌ Error eliminando {asset.filename}: {e}")
+        db.delete(asset)
+        deleted += 1
+
+    db.commit()
+    return deleted
@@ -2,8 +2,11 @@
 Orquestador principal para generación de libros
 """
 
+import asyncio
 import json
-from typing import Optional
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Union
 from sqlalchemy.sql import func
 from pathlib import Path
 
@@ -11,22 +14,23 @@ from .gemini_text import GeminiTextService
 from .gemini_image import GeminiImageService
 from .ideogram_image import IdeogramImageService
 from .pdf_generator import PDFGenerator
+from .book_assets import record_asset, get_book_assets, delete_book_assets, backfill_legacy_assets
+from .pipeline import Pipeline, Stage, DEFAULT_RETRY
+from .deadlines import deadline_scope
+from .hedging import get_hedger
+from .provider_health import get_cover_router
+from .speculation import schedule_speculation, consume_speculation
+from .batches import advance_batch_book
+from .progress import progress_registry, update_book_progress
+from .job_queue import final_attempt
+from .story_stream import StoryFeed
 from ..database import SessionLocal
-from ..models import Book
+from ..models import Book, SpeculativeResult
 from ..config import settings
 
 
-def update_book_progress(book_id: str, step: str, progress: int):
-    """Actualizar progreso del libro en BD"""
-    db = SessionLocal()
-    try:
-        book = db.query(Book).filter(Book.id == book_id).first()
-        if book:
-            book.current_step = step
-            book.progress_percentage = progress
-            db.commit()
-    finally:
-        db.close()
+# Paso mostrado tras un intento fallido que la cola va a reintentar (estado no terminal)
+RETRYING_STEP = "Reintentando…"
 
 
 class BookOrchestrator:
@@ -47,20 +51,115 @@ class BookOrchestrator:
         print(f"🎯 Book Orchestrator inicializado (portadas: {self.cover_service})")
     
     async def _generate_cover(self, story_data: dict, reference_photo_path: str) -> Optional[str]:
-        """Generar portada usando el servicio configurado"""
-        if self.cover_service == "ideogram":
-            print(f"🎨 Usando Ideogram para portada...")
-            return await self.ideogram_image.generate_cover(
-                story_data=story_data,
-                reference_photo_path=reference_photo_path
-            )
-        else:  # gemini
-            print(f"🎨 Usando Gemini para portada...")
-            return await self.gemini_image.generate_cover(
-                story_data=story_data,
-                reference_photo_path=reference_photo_path
-            )
+        """
+        Generar portada con el proveedor que elija el router (el configurado
+        mientras esté sano, si no el alternativo). Con hedging activado, si
+        tarda más de lo habitual se lanza una segunda petición y gana la primera
+        """
+        router = get_cover_router(self.cover_service)
+        provider = router.choose()
+        
+        def request():
+            return self._request_cover(provider, story_data, reference_photo_path)
+        
+        def backup_request():
+            return self._request_cover(router.backup_for(provider), story_data, reference_photo_path)
+        
+        hedger = get_hedger(f"cover:{provider}")
+        return await hedger.run(request, backup_request, discard=self._discard_cover)
     
+    async def _request_cover(self, service: str, story_data: dict, reference_photo_path: str) -> Optional[str]:
+        router = get_cover_router(self.cover_service)
+        started = time.monotonic()
+        try:
+            if service == "ideogram":
+                print(f"🎨 Usando Ideogram para portada...")
+                result = await self.ideogram_image.generate_cover(
+                    story_data=story_data,
+                    reference_photo_path=reference_photo_path
+                )
+            else:  # gemini
+                print(f"🎨 Usando Gemini para portada...")
+                result = await self.gemini_image.generate_cover(
+                    story_data=story_data,
+                    reference_photo_path=reference_photo_path
+                )
+        except Exception:
+            router.record(service, False, time.monotonic() - started)
+            raise
+        
+        router.record(service, result is not None, time.monotonic() - started)
+        return result
+    
+    @staticmethod
+    def _discard_cover(filename: str):
+        """Borrar la portada de la petición que perdió la carrera"""
+        (settings.previews_dir / filename).unlink(missing_ok=True)
+    
+    async def _generate_pages(
+        self,
+        book_id: str,
+        pages: Union[List[dict], StoryFeed],
+        char_sheet_path: Path,
+        scene_sheet_path: Path,
+        existing_pages: Optional[Dict[int, str]] = None
+    ) -> List[Optional[str]]:
+        """
+        Generar las ilustraciones de las páginas en paralelo.
+        Como máximo `page_generation_concurrency` peticiones en vuelo; el
+        resultado mantiene el orden de las páginas (None = página fallida).
+        Las páginas de `existing_pages` (ya indexadas) no se regeneran.
+        Con un StoryFeed cada página empieza en cuanto llega su texto.
+        """
+        existing_pages = existing_pages or {}
+        total_pages = pages.num_pages if isinstance(pages, StoryFeed) else len(pages)
+        semaphore = asyncio.Semaphore(max(1, settings.page_generation_concurrency))
+        page_filenames: List[Optional[str]] = [existing_pages.get(i) for i in range(1, total_pages + 1)]
+        completed = sum(1 for name in page_filenames if name)
+
+        if completed:
+            print(f"♻️ Reutilizando {completed}/{total_pages} páginas ya generadas")
+
+        async def generate_one(index: int):
+            nonlocal completed
+            if isinstance(pages, StoryFeed):
+                try:
+                    page_data = await pages.page(index)
+                except Exception as e:
+                    print(f"❌ Página {index + 1} sin texto: {e}")
+                    return
+            else:
+                page_data = pages[index]
+            
+            async with semaphore:
+                print(f"🖼️ Generando página {index + 1}/{total_pages}...")
+                with deadline_scope(settings.timeout_page_seconds):
+                    page_filename = await self.gemini_image.generate_page_image_with_retry(
+                        page_data=page_data,
+                        character_sheet_path=str(char_sheet_path),
+                        scene_sheet_path=str(scene_sheet_path),
+                        max_retries=3
+                    )
+
+            if not page_filename:
+                print(f"❌ FALLO CRÍTICO: Página {index + 1} falló después de 3 intentos")
+                return
+
+            page_filenames[index] = page_filename
+            record_asset(book_id, 'page', page_filename, page_number=index + 1)
+
+            # El progreso cuenta páginas terminadas, no el índice de la página
+            completed += 1
+            progress = int(20 + (completed / total_pages) * 70)  # 20% a 90%
+            update_book_progress(book_id, f"Generando páginas ({completed}/{total_pages})", progress)
+
+        update_book_progress(book_id, f"Generando páginas ({completed}/{total_pages})", int(20 + (completed / total_pages) * 70))
+        await asyncio.gather(*(
+            generate_one(i) for i in range(total_pages) if not page_filenames[i]
+        ))
+
+        return page_filenames
+
     async def generate_preview(self, book_id: str):
         """
         Generar PREVIEW RÁPIDO: historia mínima + portada ilustrada
@@ -71,43 +170,50 @@ class BookOrchestrator:
             book = db.query(Book).filter(Book.id == book_id).first()
             if not book:
                 print(f"❌ Libro {book_id} no encontrado")
-                return
+                return False
             
-            # 1. Generar historia MÍNIMA (rápido)
-            update_book_progress(book_id, "Creando la idea del cuento", 20)
-            print(f"🤖 Generando historia mínima...")
-            minimal_story = await self.gemini_text.generate_minimal_story(
-                photo_path=book.original_photo_path,
-                child_name=book.child_name,
-                age=book.child_age,
-                description=book.child_description or ""
-            )
+            # Un reintento de la cola parte de un preview_error anterior
+            book.status = 'preview'
+            book.generation_error = None
+            db.commit()
+            progress_registry.track(book)
             
-            # Guardar edad en la historia
-            minimal_story['age'] = book.child_age
+            # 1. Generar historia MÍNIMA (rápido)
+            async def minimal_story_stage():
+                update_book_progress(book_id, "Creando la idea del cuento", 20)
+                print(f"🤖 Generando historia mínima...")
+                minimal_story = await self.gemini_text.generate_minimal_story(
+                    photo_path=book.original_photo_path,
+                    child_name=book.child_name,
+                    age=book.child_age,
+                    description=book.child_description or ""
+                )
+                # Guardar edad en la historia
+                minimal_story['age'] = book.child_age
+                return minimal_story
             
             # 2. Generar portada con servicio configurado
-            update_book_progress(book_id, "Transformando en portada mágica", 60)
-            print(f"🎨 Generando portada con {self.cover_service.upper()}...")
-            cover_filename = None
-            for attempt in range(1, 4):
-                print(f"  Intento {attempt}/3...")
-                cover_filename = await self._generate_cover(
+            async def cover_stage(minimal_story):
+                update_book_progress(book_id, "Transformando en portada mágica", 60)
+                print(f"🎨 Generando portada con {self.cover_service.upper()}...")
+                return await self._generate_cover(
                     story_data=minimal_story,
                     reference_photo_path=book.original_photo_path
                 )
-                if cover_filename:
-                    break
-                if attempt < 3:
-                    print(f"  ⚠️ Reintentando en 2 segundos...")
-                    import asyncio
-                    await asyncio.sleep(2)
             
-            if not cover_filename:
-                raise Exception("No se pudo generar portada después de 3 intentos")
+            results = await Pipeline('preview', [
+                Stage('minimal_story', minimal_story_stage, retry=DEFAULT_RETRY, concurrency='text',
+                      timeout=settings.timeout_story_seconds),
+                Stage('cover', cover_stage, inputs=['minimal_story'], retry=DEFAULT_RETRY,
+                      concurrency='image', label='portada', timeout=settings.timeout_cover_seconds),
+            ], budget_seconds=settings.preview_budget_seconds).run()
+            minimal_story = results['minimal_story']
+            cover_filename = results['cover']
             
             # 3. Actualizar BD (guardar historia MÍNIMA)
-            update_book_progress(book_id, "Preview listo", 100)
+            progress_registry.discard(book_id)
+            book.current_step = "Preview listo"
+            book.progress_percentage = 100
             book.title = minimal_story['titulo']
             book.story_theme = minimal_story.get('tema', '')
             book.book_data_json = json.dumps(minimal_story, ensure_ascii=False)
@@ -115,18 +221,34 @@ class BookOrchestrator:
             book.status = 'preview_ready'
             
             db.commit()
+            record_asset(book_id, 'cover', cover_filename)
             print(f"✅ Preview {book_id} completado (servicio: {self.cover_service})")
             
+            if book.batch_id:
+                # Los libros de un lote van directos al libro completo (ya están pagados)
+                advance_batch_book(db, book)
+            else:
+                # Adelantar trabajo del libro completo (solo si está activado)
+                schedule_speculation(db, book)
+            return True
+            
         except Exception as e:
             print(f"❌ Error generando preview {book_id}: {e}")
             
             if 'db' in locals() and 'book' in locals():
-                book.status = 'preview_error'
-                book.generation_error = str(e)
-                book.current_step = "Error en generación"
+                if final_attempt.get():
+                    book.status = 'preview_error'
+                    book.generation_error = str(e)
+                    book.current_step = "Error en generación"
+                else:
+                    # La cola lo reintentará: el cliente sigue esperando
+                    book.current_step = RETRYING_STEP
                 db.commit()
+            return False
         
         finally:
+            # Sin await entre el commit final y esto: ningún volcado pisa el estado terminal
+            progress_registry.discard(book_id)
             if 'db' in locals():
                 db.close()
     
@@ -150,25 +272,21 @@ class BookOrchestrator:
             book.current_step = "Regenerando portada"
             book.progress_percentage = 50
             db.commit()
+            progress_registry.track(book)
             
             # Regenerar portada CON RETRY (usando servicio configurado)
-            print(f"🔄 Regenerando portada con {self.cover_service.upper()}...")
-            cover_filename = None
-            for attempt in range(1, 4):
-                print(f"  Intento {attempt}/3...")
-                cover_filename = await self._generate_cover(
+            async def cover_stage(minimal_story):
+                print(f"🔄 Regenerando portada con {self.cover_service.upper()}...")
+                return await self._generate_cover(
                     story_data=minimal_story,
                     reference_photo_path=book.original_photo_path
                 )
-                if cover_filename:
-                    break
-                if attempt < 3:
-                    print(f"  ⚠️ Reintentando en 2 segundos...")
-                    import asyncio
-                    await asyncio.sleep(2)
             
-            if not cover_filename:
-                raise Exception("No se pudo regenerar portada después de 3 intentos")
+            results = await Pipeline('regenerate_cover', [
+                Stage('cover', cover_stage, inputs=['minimal_story'], retry=DEFAULT_RETRY,
+                      concurrency='image', label='portada', timeout=settings.timeout_cover_seconds),
+            ], budget_seconds=settings.preview_budget_seconds).run(minimal_story=minimal_story)
+            cover_filename = results['cover']
             
             # Borrar portada anterior
             if book.cover_preview_path:
@@ -179,11 +297,13 @@ class BookOrchestrator:
                     pass
             
             # Actualizar BD
+            progress_registry.discard(book_id)
             book.cover_preview_path = cover_filename
             book.status = 'preview_ready'
             book.current_step = "Preview listo"
             book.progress_percentage = 100
             db.commit()
+            record_asset(book_id, 'cover', cover_filename)
             
             print(f"✅ Portada regenerada: {cover_filename}")
             return True
@@ -191,11 +311,15 @@ class BookOrchestrator:
         except Exception as e:
             print(f"❌ Error regenerando portada: {e}")
             if 'db' in locals() and 'book' in locals():
-                book.status = 'preview_error'
-                book.generation_error = f"Error regenerando portada: {str(e)}"
+                if final_attempt.get():
+                    book.status = 'preview_error'
+                    book.generation_error = f"Error regenerando portada: {str(e)}"
+                else:
+                    book.current_step = RETRYING_STEP
                 db.commit()
             return False
         finally:
+            progress_registry.discard(book_id)
             if 'db' in locals():
                 db.close()
     
@@ -203,147 +327,280 @@ class BookOrchestrator:
         """
         Generar libro completo DESPUÉS DEL PAGO:
         1. Extender historia mínima a completa
-        2. Generar sheets
+        2. Generar sheets (en paralelo)
         3. Generar 12 páginas
         4. Crear PDF
+        Cada stage reutiliza lo ya generado en intentos anteriores.
         """
         try:
             db = SessionLocal()
             book = db.query(Book).filter(Book.id == book_id).first()
             if not book:
                 print(f"❌ Libro {book_id} no encontrado")
-                return
+                return False
             
             book.status = 'generating'
             book.current_step = "Iniciando generación completa"
             book.progress_percentage = 0
             db.commit()
+            progress_registry.track(book)
             
-            minimal_story = json.loads(book.book_data_json)
+            story_data = json.loads(book.book_data_json)
             cover_path = settings.previews_dir / book.cover_preview_path
+            assets = get_book_assets(db, book_id)
             
-            print(f"🎨 Generando libro completo para {book.child_name}...")
+            # Sin historia completa guardada, los sheets/páginas de un intento anterior
+            # (streaming interrumpido) corresponden a otra historia: se descartan
+            if 'paginas' not in story_data and (
+                assets.get('char_sheet') or assets.get('scene_sheet') or assets['pages']
+            ):
+                print(f"🧹 Descartando sheets/páginas de un intento sin historia completa")
+                delete_book_assets(db, book_id, {'char_sheet', 'scene_sheet', 'page'})
+                assets = get_book_assets(db, book_id)
             
-            # 1. EXTENDER historia mínima a completa (con 12 páginas + personajes + objetos + escenarios)
-            update_book_progress(book_id, "Extendiendo historia completa", 5)
-            print(f"📖 Extendiendo historia a 12 páginas...")
-            full_story = await self.gemini_text.extend_full_story(
-                minimal_story=minimal_story,
-                num_pages=book.total_pages
-            )
+            # Partes de la historia completa según llegan (streaming)
+            feed = StoryFeed(book.total_pages)
             
-            # Guardar historia completa
-            book.book_data_json = json.dumps(full_story, ensure_ascii=False)
-            db.commit()
+            print(f"🎨 Generando libro completo para {book.child_name}...")
             
-            # 2. Generar character sheet (basado en portada) - SIEMPRE con Gemini
-            update_book_progress(book_id, "Creando personajes con portada", 10)
-            print(f"🎨 Generando character sheet...")
-            char_sheet_filename = None
-            for attempt in range(1, 4):
-                print(f"  Intento {attempt}/3...")
-                char_sheet_filename = await self.gemini_image.generate_character_sheet(
+            # 1. EXTENDER historia mínima a completa (con 12 páginas + personajes + objetos + escenarios).
+            # Un intento fallido no toca el feed: solo se falla al agotar los reintentos (on_failure)
+            async def full_story_stage():
+                full_story = await build_full_story()
+                feed.complete(full_story)
+                return full_story
+            
+            async def build_full_story():
+                speculation = None if 'paginas' in story_data else consume_speculation(db, book_id)
+                if speculation:
+                    # Historia (y scene sheet) pre-generados mientras estaba en el checkout
+                    print(f"⚡ Reutilizando pre-generación especulativa")
+                    full_story, speculative_scene_sheet = speculation
+                    if speculative_scene_sheet and 'scene_sheet' not in assets:
+                        record_asset(book_id, 'scene_sheet', speculative_scene_sheet)
+                        assets['scene_sheet'] = speculative_scene_sheet
+                elif 'paginas' in story_data:
+                    # Checkpoint: la historia completa ya se generó en un intento anterior
+                    print(f"♻️ Reutilizando historia completa guardada")
+                    return story_data
+                else:
+                    update_book_progress(book_id, "Extendiendo historia completa", 5)
+                    print(f"📖 Extendiendo historia a 12 páginas...")
+                    if settings.stream_full_story:
+                        full_story = await self.gemini_text.stream_full_story(
+                            minimal_story=story_data,
+                            num_pages=book.total_pages,
+                            on_section=feed.add_section,
+                            on_page=feed.add_page
+                        )
+                    else:
+                        full_story = await self.gemini_text.extend_full_story(
+                            minimal_story=story_data,
+                            num_pages=book.total_pages
+                        )
+                
+                # Guardar historia completa
+                book.book_data_json = json.dumps(full_story, ensure_ascii=False)
+                db.commit()
+                return full_story
+            
+            # Personajes, objetos y escenarios: en streaming llegan antes que las
+            # páginas, así los sheets no esperan a que termine todo el texto
+            async def story_outline_stage():
+                return await feed.outline()
+            
+            # 2. Character sheet (basado en portada) - SIEMPRE con Gemini
+            async def char_sheet_stage(story_outline):
+                filename = assets.get('char_sheet')
+                if filename:
+                    print(f"♻️ Reutilizando character sheet: {filename}")
+                    return filename
+                
+                update_book_progress(book_id, "Creando personajes y escenarios", 10)
+                print(f"🎨 Generando character sheet...")
+                filename = await self.gemini_image.generate_character_sheet(
+                    story_data=story_outline,
+                    cover_image_path=str(cover_path)
+                )
+                if filename:
+                    record_asset(book_id, 'char_sheet', filename)
+                return filename
+            
+            # 3. Scene sheet - solo depende de los escenarios, corre en paralelo al anterior
+            async def scene_sheet_stage(story_outline):
+                filename = assets.get('scene_sheet')
+                if filename:
+                    print(f"♻️ Reutilizando scene sheet: {filename}")
+                    return filename
+                
+                print(f"🏞️ Generando scene sheet...")
+                filename = await self.gemini_image.generate_scene_sheet(
+                    story_data=story_outline
+                )
+                if filename:
+                    record_asset(book_id, 'scene_sheet', filename)
+                return filename
+            
+            async def regenerate_sheets(full_story):
+                """Sheets con el esquema definitivo (los anteriores se hicieron con otro)"""
+                char_sheet = await self.gemini_image.generate_character_sheet(
                     story_data=full_story,
                     cover_image_path=str(cover_path)
                 )
-                if char_sheet_filename:
-                    break
-                if attempt < 3:
-                    print(f"  ⚠️ Reintentando en 2 segundos...")
-                    import asyncio
-                    await asyncio.sleep(2)
-            
-            if not char_sheet_filename:
-                raise Exception("No se pudo generar character sheet después de 3 intentos")
-            
-            char_sheet_path = settings.assets_dir / char_sheet_filename
-            
-            # 3. Generar scene sheet - SIEMPRE con Gemini
-            update_book_progress(book_id, "Creando escenarios", 20)
-            print(f"🏞️ Generando scene sheet...")
-            scene_sheet_filename = None
-            for attempt in range(1, 4):
-                print(f"  Intento {attempt}/3...")
-                scene_sheet_filename = await self.gemini_image.generate_scene_sheet(
-                    story_data=full_story
+                scene_sheet = await self.gemini_image.generate_scene_sheet(story_data=full_story)
+                if not char_sheet or not scene_sheet:
+                    raise Exception("No se pudieron rehacer los sheets con la historia definitiva")
+                record_asset(book_id, 'char_sheet', char_sheet)
+                record_asset(book_id, 'scene_sheet', scene_sheet)
+                return char_sheet, scene_sheet
+            
+            # 4. Páginas en paralelo (concurrencia limitada) - SIEMPRE con Gemini.
+            # Cada una empieza en cuanto llega su texto, sin esperar a la historia entera
+            async def pages_stage(char_sheet, scene_sheet):
+                page_filenames = await self._generate_pages(
+                    book_id=book_id,
+                    pages=feed,
+                    char_sheet_path=settings.assets_dir / char_sheet,
+                    scene_sheet_path=settings.assets_dir / scene_sheet,
+                    existing_pages=assets['pages']
                 )
-                if scene_sheet_filename:
-                    break
-                if attempt < 3:
-                    print(f"  ⚠️ Reintentando en 2 segundos...")
-                    import asyncio
-                    await asyncio.sleep(2)
-            
-            if not scene_sheet_filename:
-                raise Exception("No se pudo generar scene sheet después de 3 intentos")
-            
-            scene_sheet_path = settings.assets_dir / scene_sheet_filename
-            
-            # 4. Generar páginas con RETRY - SIEMPRE con Gemini
-            page_filenames = []
-            failed_pages = []
-            total_pages = len(full_story['paginas'])
-            
-            for i, page_data in enumerate(full_story['paginas'], 1):
-                progress = int(20 + (i / total_pages) * 70)  # 20% a 90%
-                update_book_progress(book_id, f"Generando página {i}/{total_pages}", progress)
-                print(f"🖼️ Generando página {i}/{total_pages}...")
                 
-                page_filename = await self.gemini_image.generate_page_image_with_retry(
-                    page_data=page_data,
-                    character_sheet_path=str(char_sheet_path),
-                    scene_sheet_path=str(scene_sheet_path),
-                    max_retries=3
-                )
+                # Lo emitido en streaming puede diferir de la historia guardada (JSON
+                # reparado, reintento del stage): se rehace lo que no coincide
+                full_story = await feed.story()
+                stale_pages = feed.stale_pages(full_story)
+                if feed.outline_changed(full_story):
+                    print("🔁 El esquema definitivo no coincide con el emitido: rehaciendo sheets y páginas")
+                    char_sheet, scene_sheet = await regenerate_sheets(full_story)
+                    stale_pages = list(range(len(page_filenames)))
+                if stale_pages:
+                    print(f"🔁 Rehaciendo {len(stale_pages)} páginas que no coinciden con la historia definitiva")
+                    page_filenames = await self._generate_pages(
+                        book_id=book_id,
+                        pages=full_story['paginas'],
+                        char_sheet_path=settings.assets_dir / char_sheet,
+                        scene_sheet_path=settings.assets_dir / scene_sheet,
+                        existing_pages={
+                            i: name for i, name in enumerate(page_filenames, 1)
+                            if name and i - 1 not in stale_pages
+                        }
+                    )
                 
-                if not page_filename:
-                    print(f"❌ FALLO CRÍTICO: Página {i} falló después de 3 intentos")
-                    failed_pages.append(i)
-                    page_filenames.append(None)
-                else:
-                    page_filenames.append(page_filename)
-            
-            # Si alguna página falló, NO completar el libro
-            if failed_pages:
-                error_msg = f"Páginas fallidas: {', '.join(map(str, failed_pages))}"
-                raise Exception(error_msg)
+                # Si alguna página falló, NO completar el libro
+                failed_pages = [i for i, name in enumerate(page_filenames, 1) if not name]
+                if failed_pages:
+                    raise Exception(f"Páginas fallidas: {', '.join(map(str, failed_pages))}")
+                return page_filenames
             
             # 5. Crear PDF
-            update_book_progress(book_id, "Creando PDF final", 95)
-            print("📄 Creando PDF...")
-            pdf_filename = await self.pdf_generator.create_pdf(
-                book=book,
-                story_data=full_story,
-                cover_filename=book.cover_preview_path,
-                page_filenames=page_filenames
-            )
+            async def pdf_stage(full_story, pages):
+                update_book_progress(book_id, "Creando PDF final", 95)
+                print("📄 Creando PDF...")
+                return await self.pdf_generator.create_pdf(
+                    book=book,
+                    story_data=full_story,
+                    cover_filename=book.cover_preview_path,
+                    page_filenames=pages
+                )
             
-            if not pdf_filename:
-                raise Exception("No se pudo crear el PDF")
+            results = await Pipeline('complete_book', [
+                Stage('full_story', full_story_stage, retry=DEFAULT_RETRY, concurrency='text',
+                      timeout=settings.timeout_story_seconds, on_failure=feed.fail),
+                # Sin plazo propio: termina cuando llega el esquema o falla la historia
+                Stage('story_outline', story_outline_stage, label='el esquema de la historia'),
+                Stage('char_sheet', char_sheet_stage, inputs=['story_outline'], retry=DEFAULT_RETRY,
+                      concurrency='image', label='character sheet', timeout=settings.timeout_sheet_seconds),
+                Stage('scene_sheet', scene_sheet_stage, inputs=['story_outline'], retry=DEFAULT_RETRY,
+                      concurrency='image', label='scene sheet', timeout=settings.timeout_sheet_seconds),
+                # Sin plazo propio: cada página lleva el suyo (timeout_page_seconds)
+                Stage('pages', pages_stage, inputs=['char_sheet', 'scene_sheet'],
+                      concurrency='image', label='las páginas'),
+                Stage('pdf', pdf_stage, inputs=['full_story', 'pages'],
+                      concurrency='cpu', label='el PDF', timeout=settings.timeout_pdf_seconds),
+            ], budget_seconds=settings.book_budget_seconds).run()
             
             # 6. Finalizar
-            update_book_progress(book_id, "Libro completado", 100)
+            progress_registry.discard(book_id)
+            book.current_step = "Libro completado"
+            book.progress_percentage = 100
             book.status = 'completed'
-            book.pdf_path = pdf_filename
+            book.pdf_path = results['pdf']
             book.completed_at = func.now()
             db.commit()
             
             print(f"🎉 Libro {book_id} completado exitosamente")
+            return True
             
         except Exception as e:
             print(f"❌ Error generando libro {book_id}: {e}")
             db = SessionLocal()
             book = db.query(Book).filter(Book.id == book_id).first()
             if book:
-                book.status = 'error'
-                book.generation_error = str(e)
-                book.current_step = "Error en generación"
+                if final_attempt.get():
+                    book.status = 'error'
+                    book.generation_error = str(e)
+                    book.current_step = "Error en generación"
+                else:
+                    book.current_step = RETRYING_STEP
                 db.commit()
             db.close()
+            return False
         finally:
+            progress_registry.discard(book_id)
             if 'db' in locals():
                 db.close()
     
+    async def speculate_full_book(self, book_id: str):
+        """
+        Pre-generar historia completa + scene sheet antes del pago (baja prioridad).
+        Un fallo no se reintenta: la especulación es prescindible y consume cuota.
+        """
+        db = SessionLocal()
+        try:
+            result = db.query(SpeculativeResult).filter(SpeculativeResult.book_id == book_id).first()
+            book = db.query(Book).filter(Book.id == book_id).first()
+            if not result or result.status != 'pending':
+                return True
+            
+            # Si ya pagó (o se borró) o caducó, el trabajo normal se encarga
+            if not book or book.status != 'preview_ready' or (
+                result.expires_at and result.expires_at < datetime.utcnow()
+            ):
+                result.status = 'failed'
+                db.commit()
+                return True
+            
+            minimal_story = json.loads(book.book_data_json)
+            
+            print(f"🔮 Especulando historia completa para {book_id[:8]}...")
+            full_story = await self.gemini_text.extend_full_story(
+                minimal_story=minimal_story,
+                num_pages=book.total_pages
+            )
+            
+            print(f"🔮 Especulando scene sheet para {book_id[:8]}...")
+            scene_sheet_filename = await self.gemini_image.generate_scene_sheet(
+                story_data=full_story
+            )
+            
+            db.refresh(result)
+            result.full_story_json = json.dumps(full_story, ensure_ascii=False)
+            result.scene_sheet_filename = scene_sheet_filename
+            result.status = 'ready'
+            db.commit()
+            
+            print(f"✅ Especulación lista para {book_id[:8]}")
+            return True
+            
+        except Exception as e:
+            print(f"❌ Error en especulación {book_id}: {e}")
+            if 'result' in locals() and result:
+                result.status = 'failed'
+                db.commit()
+            return True
+        finally:
+            db.close()
+    
     async def regenerate_single_page(self, book_id: str, page_number: int):
         """Regenerar una página específica y recrear el PDF"""
         try:
@@ -359,15 +616,17 @@ class BookOrchestrator:
             
             page_data = story_data['paginas'][page_number - 1]
             
-            # Localizar sheets en assets
-            char_sheet_files = list(settings.assets_dir.glob("char_sheet_*.png"))
-            scene_sheet_files = list(settings.assets_dir.glob("scene_sheet_*.png"))
+            # Localizar sheets y páginas del libro en el índice de assets
+            assets = get_book_assets(db, book_id)
+            if 'char_sheet' not in assets or 'scene_sheet' not in assets:
+                # Libro completado antes del índice de assets
+                assets = backfill_legacy_assets(db, book)
             
-            if not char_sheet_files or not scene_sheet_files:
+            if 'char_sheet' not in assets or 'scene_sheet' not in assets:
                 raise Exception("Sheets no encontrados")
             
-            char_sheet_path = char_sheet_files[0]
-            scene_sheet_path = scene_sheet_files[0]
+            char_sheet_path = settings.assets_dir / assets['char_sheet']
+            scene_sheet_path = settings.assets_dir / assets['scene_sheet']
             
             print(f"🔄 Regenerando página {page_number}...")
             
@@ -382,17 +641,13 @@ class BookOrchestrator:
             if not new_page_filename:
                 raise Exception("No se pudo regenerar la página")
             
-            # Obtener lista de todas las páginas actuales
-            page_filenames = []
-            page_files = sorted(settings.books_dir.glob("page_*.png"))
+            # Reemplaza (y borra) la versión anterior de la página en el índice
+            record_asset(book_id, 'page', new_page_filename, page_number=page_number)
+            assets['pages'][page_number] = new_page_filename
             
-            for i in range(1, len(story_data['paginas']) + 1):
-                if i == page_number:
-                    page_filenames.append(new_page_filename)
-                elif i-1 < len(page_files):
-                    page_filenames.append(page_files[i-1].name)
-                else:
-                    page_filenames.append(None)
+            page_filenames = [
+                assets['pages'].get(i) for i in range(1, len(story_data['paginas']) + 1)
+            ]
             
             # Recrear PDF con la nueva página
             print("📄 Recreando PDF...")
@@ -0,0 +1,101 @@
+"""
+Cancelación cooperativa de trabajos de generación de un libro
+"""
+
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+from .batches import finish_batch_if_done
+from .book_assets import delete_book_assets
+from .job_queue import request_local_cancel
+from .speculation import discard_speculation
+from ..models import Book, GenerationJob
+
+
+CANCELLED_MESSAGE = "Generación cancelada"
+
+
+def cancel_book_jobs(db: Session, book_id: str) -> dict:
+    """
+    Cancelar los trabajos de un libro: los pendientes se cancelan aquí mismo y
+    a los que están corriendo se les pide parar (su worker los cancela y libera
+    lo generado a medias en cuanto lo ve, en este u otro proceso).
+    """
+    pending = db.query(GenerationJob.id, GenerationJob.kind).filter(
+        GenerationJob.book_id == book_id,
+        GenerationJob.status == 'pending'
+    ).all()
+
+    cancelled_kinds = []
+    for job_id, kind in pending:
+        # Compare-and-set: si un worker lo acaba de reclamar, se trata como en curso
+        updated = db.query(GenerationJob).filter(
+            GenerationJob.id == job_id,
+            GenerationJob.status == 'pending'
+        ).update({
+            GenerationJob.status: 'cancelled',
+            GenerationJob.last_error: CANCELLED_MESSAGE,
+            GenerationJob.finished_at: datetime.utcnow(),
+        }, synchronize_session=False)
+        if updated:
+            cancelled_kinds.append(kind)
+
+    running_query = db.query(GenerationJob).filter(
+        GenerationJob.book_id == book_id,
+        GenerationJob.status == 'running'
+    )
+    running_ids = [job.id for job in running_query.all()]
+    running_query.update({GenerationJob.cancel_requested: True}, synchronize_session=False)
+    db.commit()
+
+    for kind in cancelled_kinds:
+        release_cancelled_work(db, book_id, kind)
+
+    # Si el trabajo corre en este proceso no hace falta esperar al siguiente sondeo
+    request_local_cancel(running_ids)
+
+    if cancelled_kinds or running_ids:
+        print(f"🛑 Cancelación libro {book_id[:8]}: {len(cancelled_kinds)} pendientes, {len(running_ids)} en curso")
+
+    return {"cancelled": len(cancelled_kinds), "cancelling": len(running_ids)}
+
+
+def release_cancelled_work(db: Session, book_id: str, kind: str):
+    """Dejar el libro en un estado coherente y borrar lo generado a medias"""
+    book = db.query(Book).filter(Book.id == book_id).first()
+
+    if not book:
+        # Libro eliminado mientras se generaba: no debe quedar nada suyo
+        delete_book_assets(db, book_id)
+        discard_speculation(db, book_id)
+        return
+
+    if kind == 'preview':
+        book.status = 'preview_error'
+        book.generation_error = CANCELLED_MESSAGE
+        book.current_step = CANCELLED_MESSAGE
+
+    elif kind == 'regenerate_cover':
+        # La portada anterior solo se borra al terminar, así que sigue siendo válida
+        if book.cover_preview_path:
+            book.status = 'preview_ready'
+            book.current_step = "Preview listo"
+            book.progress_percentage = 100
+        else:
+            book.status = 'preview_error'
+            book.generation_error = CANCELLED_MESSAGE
+
+    elif kind == 'complete_book':
+        delete_book_assets(db, book_id, {'char_sheet', 'scene_sheet', 'page'})
+        book.status = 'error'
+        book.generation_error = CANCELLED_MESSAGE
+        book.current_step = CANCELLED_MESSAGE
+
+    elif kind == 'speculate':
+        discard_speculation(db, book_id)
+
+    db.commit()
+
+    if book.batch_id:
+        finish_batch_if_done(db, book.batch_id)
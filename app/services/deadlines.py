@@ -0,0 +1,62 @@
+"""
+Plazos (deadlines) de las llamadas a proveedores: un stage fija su plazo y
+todas las llamadas que hace dentro lo heredan por ContextVar
+"""
+
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Optional, TypeVar
+
+T = TypeVar('T')
+
+# Instante (time.monotonic) en el que vence el plazo de la tarea actual
+_deadline: ContextVar[Optional[float]] = ContextVar('call_deadline', default=None)
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]):
+    """Limitar a `seconds` lo que se ejecute dentro (nunca amplía un plazo exterior)"""
+    if seconds is None:
+        yield
+        return
+
+    deadline = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        deadline = min(deadline, outer)
+
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_seconds(default: float) -> float:
+    """Tiempo disponible para una llamada: el plazo vigente o `default` si es menor"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    return min(default, deadline - time.monotonic())
+
+
+def deadline_expired() -> bool:
+    """Si el plazo vigente ya venció (sin plazo nunca vence)"""
+    deadline = _deadline.get()
+    return deadline is not None and time.monotonic() >= deadline
+
+
+async def call_with_deadline(awaitable: Awaitable[T], default: float) -> T:
+    """
+    Esperar una llamada como mucho hasta el plazo vigente (o `default`).
+    Al vencer se abandona con asyncio.TimeoutError, que el limitador
+    adaptativo cuenta como sobrecarga y el pipeline como intento fallido.
+    """
+    timeout = remaining_seconds(default)
+    if timeout <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise asyncio.TimeoutError("Plazo agotado antes de llamar al proveedor")
+    return await asyncio.wait_for(awaitable, timeout)
@@ -0,0 +1,48 @@
+"""
+Cliente de Gemini compartido por todos los servicios del proceso (superficie
+async `client.aio`: cada llamada en vuelo es una corrutina, no un hilo)
+"""
+
+from typing import Optional
+
+from google import genai
+from google.genai import types
+
+from ..config import settings
+
+
+_client: Optional[genai.Client] = None
+
+
+def get_gemini_client() -> genai.Client:
+    """Cliente único del proceso (se crea la primera vez que se pide)"""
+    global _client
+    if _client is None:
+        if not settings.gemini_api_key:
+            raise ValueError("GEMINI_API_KEY no configurada")
+        # Timeout HTTP del SDK: red de seguridad por debajo de los plazos de cada stage
+        _client = genai.Client(
+            api_key=settings.gemini_api_key,
+            http_options=types.HttpOptions(timeout=settings.timeout_provider_call_seconds * 1000)
+        )
+        print("🔌 Cliente Gemini compartido creado")
+    return _client
+
+
+async def close_gemini_client():
+    """Cerrar las conexiones del cliente al apagar (tras parar los workers)"""
+    global _client
+    if _client is None:
+        return
+    client, _client = _client, None
+    try:
+        # aclose/close solo existen en versiones recientes del SDK
+        aclose = getattr(client.aio, 'aclose', None)
+        if aclose:
+            await aclose()
+        close = getattr(client, 'close', None)
+        if close:
+            close()
+        print("🔌 Cliente Gemini cerrado")
+    except Exception as e:
+        print(f"⚠️ Error cerrando el cliente Gemini: {e}")
@@ -2,16 +2,22 @@
 Servicio para Gemini Image - Generación de imágenes
 """
 
-from google import genai
 from google.genai import types
 from PIL import Image, ImageDraw, ImageFont
 import asyncio
 import aiofiles
 import secrets
-import time
 from typing import Dict, Optional
+from .rate_limiter import get_rate_limiter
+from .adaptive_concurrency import get_adaptive_limiter
+from .deadlines import call_with_deadline
+from .gemini_client import get_gemini_client
+from .ledger import track_provider_call, estimate_request_bytes
+from .photo_preprocessing import read_reference_photo, REFERENCE_MIME_TYPE
 from ..config import settings
 
+IMAGE_MODEL = 'gemini-2.5-flash-image'
+
 
 class GeminiImageService:
     """Servicio para generación de imágenes con Gemini 2.5 Flash Image"""
@@ -20,9 +26,9 @@ class GeminiImageService:
         if not settings.gemini_api_key:
             raise ValueError("GEMINI_API_KEY no configurada")
         
-        self.client = genai.Client(api_key=settings.gemini_api_key)
-        self.last_request = 0
-        self.min_delay = 1
+        self.client = get_gemini_client()
+        self.rate_limiter = get_rate_limiter('gemini_image', IMAGE_MODEL)
+        self.concurrency = get_adaptive_limiter('gemini_image', IMAGE_MODEL)
         print("🎨 Gemini Image Service configurado")
     
     async def generate_cover(
@@ -78,20 +84,14 @@ ESTILO VISUAL:
 
             print(f"📝 Generando portada ilustrada...")
             
-            reference_image = Image.open(reference_photo_path)
-            
-            await self._respect_rate_limit()
+            reference_image = types.Part.from_bytes(
+                data=await read_reference_photo(reference_photo_path),
+                mime_type=REFERENCE_MIME_TYPE
+            )
             
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model='gemini-2.5-flash-image',
+            response = await self._generate_image(
                 contents=[prompt, reference_image],
-                config=types.GenerateContentConfig(
-                    response_modalities=["IMAGE"],
-                    image_config=types.ImageConfig(
-                        aspect_ratio="1:1"
-                    )
-                )
+                aspect_ratio="1:1"
             )
             
             # DEBUG: Ver qué responde Gemini
@@ -186,18 +186,9 @@ CRÍTICO:
             
             cover_img = Image.open(cover_image_path)
             
-            await self._respect_rate_limit()
-            
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model='gemini-2.5-flash-image',
+            response = await self._generate_image(
                 contents=[prompt, cover_img],
-                config=types.GenerateContentConfig(
-                    response_modalities=["IMAGE"],
-                    image_config=types.ImageConfig(
-                        aspect_ratio="1:1"
-                    )
-                )
+                aspect_ratio="1:1"
             )
             
             # Validar y extraer
@@ -251,18 +242,9 @@ FORMATO:
 
             print(f"🎨 Generando scene sheet...")
             
-            await self._respect_rate_limit()
-            
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model='gemini-2.5-flash-image',
+            response = await self._generate_image(
                 contents=[prompt],
-                config=types.GenerateContentConfig(
-                    response_modalities=["IMAGE"],
-                    image_config=types.ImageConfig(
-                        aspect_ratio="16:9"
-                    )
-                )
+                aspect_ratio="16:9"
             )
             
             # Validar y extraer
@@ -331,8 +313,6 @@ FORMATO:
     ) -> Optional[str]:
         """Genera imagen de página usando los sheets con IDs"""
         try:
-            await self._respect_rate_limit()
-            
             escena = page_data.get('escena_detallada', page_data.get('texto', ''))
             personajes_ids = page_data.get('personajes_ids', [])
             objetos_ids = page_data.get('objetos_ids', [])
@@ -365,16 +345,9 @@ IMPORTANTE:
             char_img = Image.open(character_sheet_path)
             scene_img = Image.open(scene_sheet_path)
             
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model='gemini-2.5-flash-image',
+            response = await self._generate_image(
                 contents=[prompt, char_img, scene_img],
-                config=types.GenerateContentConfig(
-                    response_modalities=["IMAGE"],
-                    image_config=types.ImageConfig(
-                        aspect_ratio="1:1"
-                    )
-                )
+                aspect_ratio="1:1"
             )
             
             # Validar y extraer
@@ -442,13 +415,25 @@ IMPORTANTE:
             from pathlib import Path
             return Path(image_path).name
     
-    async def _respect_rate_limit(self):
-        """Rate limiting"""
-        now = time.time()
-        time_since_last = now - self.last_request
-        
-        if time_since_last < self.min_delay:
-            wait_time = self.min_delay - time_since_last
-            await asyncio.sleep(wait_time)
+    async def _generate_image(self, contents: list, aspect_ratio: str):
+        """
+        Llamada a Gemini Image con rate limiting (token bucket compartido)
+        y concurrencia adaptativa (AIMD) frente a 429/5xx. La espera queda
+        limitada por el plazo del stage (o timeout_provider_call_seconds)
+        """
+        await self.rate_limiter.acquire()
         
-        self.last_request = time.time()
\ No newline at end of file
+        async with self.concurrency.slot():
+            async with track_provider_call('gemini_image', IMAGE_MODEL, estimate_request_bytes(contents)) as call:
+                response = await call_with_deadline(self.client.aio.models.generate_content(
+                    model=IMAGE_MODEL,
+                    contents=contents,
+                    config=types.GenerateContentConfig(
+                        response_modalities=["IMAGE"],
+                        image_config=types.ImageConfig(
+                            aspect_ratio=aspect_ratio
+                        )
+                    )
+                ), settings.timeout_provider_call_seconds)
+                call.set_response(response)
+                return response
\ No newline at end of file
@@ -2,11 +2,19 @@
 Servicio para Gemini - Generación de historias con vision
 """
 
-from google import genai
-from PIL import Image
-import json
 import asyncio
-from typing import Dict
+from google.genai import types
+from pydantic import BaseModel, ValidationError
+from typing import Any, Callable, Dict, List, Optional, Type
+from .rate_limiter import get_rate_limiter
+from .adaptive_concurrency import get_adaptive_limiter
+from .deadlines import call_with_deadline, deadline_expired
+from .gemini_client import get_gemini_client
+from .ledger import track_provider_call, estimate_request_bytes
+from .photo_preprocessing import read_reference_photo, REFERENCE_MIME_TYPE
+from .story_cache import minimal_story_key, full_story_key, get_cached_story, store_story
+from .story_stream import OUTLINE_SECTIONS, StoryStreamParser
+from .story_schemas import MinimalStory, FullStory, Elemento, Pagina, record_parse_outcome
 from ..config import settings
 
 
@@ -17,7 +25,9 @@ class GeminiTextService:
         if not settings.gemini_api_key:
             raise ValueError("GEMINI_API_KEY no configurada")
         
-        self.client = genai.Client(api_key=settings.gemini_api_key)
+        self.client = get_gemini_client()
+        self.rate_limiter = get_rate_limiter('gemini_text', settings.gemini_model)
+        self.concurrency = get_adaptive_limiter('gemini_text', settings.gemini_model)
         print("🤖 Gemini Text Service configurado")
     
     async def generate_minimal_story(
@@ -32,9 +42,16 @@ class GeminiTextService:
         - Solo título, tema, resumen
         - Descripción básica del protagonista
         - SIN páginas detalladas, SIN personajes secundarios
+        La misma foto con los mismos datos se sirve desde la caché de historias.
         """
         
-        img = Image.open(photo_path)
+        photo = await read_reference_photo(photo_path)
+        cache_key = minimal_story_key(photo, child_name, age, description, settings.gemini_model)
+        cached = get_cached_story(cache_key, 'minimal')
+        if cached:
+            return cached
+        
+        img = types.Part.from_bytes(data=photo, mime_type=REFERENCE_MIME_TYPE)
         
         prompt = f"""Crea una idea BÁSICA de cuento infantil basado en la foto y en los intereses.
 
@@ -64,18 +81,21 @@ JSON MÍNIMO:
 IMPORTANTE: Solo genera esta información básica, NO generes páginas ni personajes secundarios."""
         
         try:
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model=settings.gemini_model,
-                contents=[prompt, img]
-            )
+            response = await self._generate_content([prompt, img], schema=MinimalStory)
             
-            story_data = self._parse_minimal_response(response.text, child_name)
+            story_data = self._parse_minimal_response(
+                await self._validated_story(response.text, MinimalStory, 'minimal'), child_name
+            )
+            store_story(cache_key, 'minimal', story_data, settings.gemini_model)
             
             print(f"📖 Historia mínima generada: '{story_data['titulo']}'")
             return story_data
             
         except Exception as e:
+            # Un plazo agotado no es un fallo del proveedor: lo reintenta el pipeline
+            if self._is_deadline_error(e):
+                print(f"⏰ Historia mínima sin terminar dentro del plazo: {e}")
+                raise
             print(f"❌ Error generando historia mínima: {e}")
             return self._fallback_minimal_story(child_name, age)
     
@@ -90,9 +110,37 @@ IMPORTANTE: Solo genera esta información básica, NO generes páginas ni person
         - Personajes secundarios con IDs
         - Objetos importantes con IDs
         - Escenarios con IDs
+        Se cachea por historia mínima + número de páginas.
         """
         
-        prompt = f"""Extiende esta idea de cuento en una historia COMPLETA de {num_pages} páginas.
+        cache_key = full_story_key(minimal_story, num_pages, settings.gemini_model)
+        cached = get_cached_story(cache_key, 'full')
+        if cached:
+            return cached
+        
+        prompt = self._full_story_prompt(minimal_story, num_pages)
+        
+        try:
+            response = await self._generate_content([prompt], schema=FullStory)
+            
+            story_data = self._parse_full_response(
+                await self._validated_story(response.text, FullStory, 'full'), minimal_story, num_pages
+            )
+            store_story(cache_key, 'full', story_data, settings.gemini_model)
+            
+            print(f"📖 Historia completa generada con {len(story_data['paginas'])} páginas")
+            return story_data
+            
+        except Exception as e:
+            if self._is_deadline_error(e):
+                print(f"⏰ Historia completa sin terminar dentro del plazo: {e}")
+                raise
+            print(f"❌ Error extendiendo historia: {e}")
+            return self._fallback_full_story(minimal_story, num_pages)
+    
+    def _full_story_prompt(self, minimal_story: Dict, num_pages: int) -> str:
+        """Prompt de la historia completa (personajes, objetos y escenarios van antes que las páginas)"""
+        return f"""Extiende esta idea de cuento en una historia COMPLETA de {num_pages} páginas.
 
 HISTORIA BASE:
 - Título: {minimal_story['titulo']}
@@ -159,106 +207,195 @@ JSON COMPLETO CON IDS NUMÉRICOS:
 }}
 
 CRÍTICO: Las descripciones deben ser TAN detalladas que un ilustrador pueda dibujar exactamente lo mismo."""
+    
+    async def stream_full_story(
+        self,
+        minimal_story: Dict,
+        num_pages: int,
+        on_section: Callable[[str, Any], None],
+        on_page: Callable[[int, Dict], None]
+    ) -> Dict:
+        """
+        Como extend_full_story, pero en streaming: avisa de cada sección
+        (personajes, objetos, escenarios) y de cada página en cuanto se
+        completan en el JSON, para que sheets y páginas empiecen antes.
+        Si el stream falla antes de emitir nada se usa la llamada normal;
+        si falla después, o por plazo agotado, se lanza el error.
+        """
+        cache_key = full_story_key(minimal_story, num_pages, settings.gemini_model)
+        cached = get_cached_story(cache_key, 'full')
+        if cached:
+            self._emit_story(cached, on_section, on_page)
+            return cached
+        
+        emitted = False
+        
+        # Lo emitido se valida y normaliza igual que la historia final; lo que no
+        # cumpla el esquema se deja para cuando esté la historia definitiva
+        def section(key: str, value: Any):
+            nonlocal emitted
+            if key not in OUTLINE_SECTIONS or not isinstance(value, list):
+                return
+            try:
+                items = [Elemento.model_validate(item).model_dump() for item in value]
+            except ValidationError:
+                return
+            emitted = True
+            on_section(key, self._normalize_section(key, items, minimal_story))
+        
+        def page(index: int, page_data: Dict):
+            nonlocal emitted
+            try:
+                page_data = Pagina.model_validate(page_data).model_dump()
+            except ValidationError:
+                return
+            emitted = True
+            on_page(index, page_data)
+        
+        parser = StoryStreamParser(section, page)
+        prompt = self._full_story_prompt(minimal_story, num_pages)
         
         try:
-            response = await asyncio.to_thread(
-                self.client.models.generate_content,
-                model=settings.gemini_model,
-                contents=[prompt]
+            text = await self._stream_content([prompt], parser.feed, schema=FullStory)
+            story_data = self._parse_full_response(
+                await self._validated_story(text, FullStory, 'full'), minimal_story, num_pages
             )
-            
-            story_data = self._parse_full_response(response.text, minimal_story, num_pages)
-            
-            print(f"📖 Historia completa generada con {len(story_data['paginas'])} páginas")
-            return story_data
-            
         except Exception as e:
-            print(f"❌ Error extendiendo historia: {e}")
-            return self._fallback_full_story(minimal_story, num_pages)
+            # Sin plazo para la llamada normal solo quedaría caer en la historia de respaldo
+            if emitted or self._is_deadline_error(e):
+                raise
+            print(f"⚠️ Streaming de la historia falló ({e}), usando la llamada normal")
+            story_data = await self.extend_full_story(minimal_story, num_pages)
+            self._emit_story(story_data, on_section, on_page)
+            return story_data
+        
+        store_story(cache_key, 'full', story_data, settings.gemini_model)
+        print(f"📖 Historia completa generada en streaming con {len(story_data['paginas'])} páginas")
+        return story_data
+    
+    def _emit_story(self, story_data: Dict, on_section, on_page):
+        """Emitir de golpe una historia ya completa (caché o llamada normal)"""
+        for key in OUTLINE_SECTIONS:
+            on_section(key, story_data.get(key, []))
+        for index, page_data in enumerate(story_data['paginas']):
+            on_page(index, page_data)
+    
+    @staticmethod
+    def _is_deadline_error(error: Exception) -> bool:
+        """Plazo del stage o de la llamada agotado (no se cubre con la historia de respaldo)"""
+        return isinstance(error, asyncio.TimeoutError) or deadline_expired()
+    
+    @staticmethod
+    def _json_config(schema: Optional[Type[BaseModel]]) -> Optional[types.GenerateContentConfig]:
+        """Salida JSON restringida al esquema (None = texto libre)"""
+        if schema is None:
+            return None
+        return types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=schema
+        )
     
-    def _parse_minimal_response(self, response_text: str, child_name: str) -> Dict:
-        """Parsear respuesta mínima"""
+    async def _generate_content(self, contents: list, schema: Optional[Type[BaseModel]] = None):
+        """
+        Llamada a Gemini con rate limiting (token bucket compartido)
+        y concurrencia adaptativa (AIMD) frente a 429/5xx. La espera queda
+        limitada por el plazo del stage (o timeout_provider_call_seconds).
+        Con `schema` la respuesta es JSON restringido a ese modelo.
+        """
+        await self.rate_limiter.acquire()
+        
+        async with self.concurrency.slot():
+            async with track_provider_call('gemini_text', settings.gemini_model, estimate_request_bytes(contents)) as call:
+                response = await call_with_deadline(self.client.aio.models.generate_content(
+                    model=settings.gemini_model,
+                    contents=contents,
+                    config=self._json_config(schema)
+                ), settings.timeout_provider_call_seconds)
+                call.set_response(response)
+                return response
+    
+    async def _stream_content(
+        self,
+        contents: list,
+        on_text: Callable[[str], None],
+        schema: Optional[Type[BaseModel]] = None
+    ) -> str:
+        """
+        Llamada en streaming con los mismos límites que _generate_content.
+        Pasa cada fragmento de texto a `on_text` y devuelve el texto completo.
+        """
+        await self.rate_limiter.acquire()
+        
+        async with self.concurrency.slot():
+            async with track_provider_call('gemini_text', settings.gemini_model, estimate_request_bytes(contents)) as call:
+                async def consume() -> str:
+                    chunks = []
+                    stream = await self.client.aio.models.generate_content_stream(
+                        model=settings.gemini_model,
+                        contents=contents,
+                        config=self._json_config(schema)
+                    )
+                    async for chunk in stream:
+                        call.set_response(chunk)  # Acumula bytes; el último trae los tokens totales
+                        if chunk.text:
+                            chunks.append(chunk.text)
+                            on_text(chunk.text)
+                    return "".join(chunks)
+                
+                return await call_with_deadline(consume(), settings.timeout_provider_call_seconds)
+    
+    async def _validated_story(self, response_text: Optional[str], schema: Type[BaseModel], kind: str) -> Dict:
+        """
+        Validar la respuesta contra su esquema. Si no lo cumple se pide a Gemini
+        que corrija solo esos errores (mucho más barato que regenerar la
+        historia); si tampoco, se lanza el error y se usa la historia de respaldo.
+        """
         try:
-            clean_text = response_text.strip()
-            if clean_text.startswith('```json'):
-                clean_text = clean_text[7:]
-            if clean_text.startswith('```'):
-                clean_text = clean_text[3:]
-            if clean_text.endswith('```'):
-                clean_text = clean_text[:-3]
-            
-            data = json.loads(clean_text.strip())
-            data['child_name'] = child_name
-            
-            # Validar estructura mínima
-            if 'titulo' not in data:
-                data['titulo'] = f"Las Aventuras de {child_name}"
-            if 'tema' not in data:
-                data['tema'] = "aventura"
-            if 'resumen' not in data:
-                data['resumen'] = f"Una historia mágica sobre {child_name}"
-            if 'mundo_descripcion' not in data:
-                data['mundo_descripcion'] = "Un mundo mágico lleno de aventuras"
-            if 'protagonista' not in data:
-                data['protagonista'] = {
-                    "nombre": child_name,
-                    "descripcion_fisica": f"{child_name}, el protagonista"
-                }
-            
-            return data
-            
+            story = schema.model_validate_json(response_text or "")
+            record_parse_outcome(kind, 'ok')
+            return story.model_dump()
+        except ValidationError as e:
+            errors = [
+                f"- {'.'.join(map(str, error['loc'])) or 'JSON'}: {error['msg']}"
+                for error in e.errors()[:20]
+            ]
+            print(f"⚠️ Historia {kind} no cumple el esquema ({e.error_count()} errores), pidiendo reparación")
+        
+        prompt = f"""El siguiente JSON no cumple el esquema requerido.
+
+ERRORES:
+{chr(10).join(errors)}
+
+JSON RECIBIDO:
+{response_text or '(vacío)'}
+
+Devuelve el JSON corregido: conserva todo el contenido válido y cambia solo lo necesario para corregir estos errores."""
+        
+        try:
+            response = await self._generate_content([prompt], schema=schema)
+            story = schema.model_validate_json(response.text or "")
         except Exception as e:
-            print(f"❌ Error parseando historia mínima: {e}")
-            raise e
+            record_parse_outcome(kind, 'failed')
+            print(f"❌ Reparación de la historia {kind} fallida: {e}")
+            raise
+        
+        record_parse_outcome(kind, 'repaired')
+        print(f"🩹 Historia {kind} reparada")
+        return story.model_dump()
+    
+    def _parse_minimal_response(self, data: Dict, child_name: str) -> Dict:
+        """Completar la historia mínima ya validada"""
+        data['child_name'] = child_name
+        return data
     
-    def _parse_full_response(self, response_text: str, minimal_story: Dict, num_pages: int) -> Dict:
-        """Parsear respuesta completa"""
+    def _parse_full_response(self, data: Dict, minimal_story: Dict, num_pages: int) -> Dict:
+        """Completar la historia completa ya validada (IDs, escenario por defecto, nº de páginas)"""
         try:
-            clean_text = response_text.strip()
-            if clean_text.startswith('```json'):
-                clean_text = clean_text[7:]
-            if clean_text.startswith('```'):
-                clean_text = clean_text[3:]
-            if clean_text.endswith('```'):
-                clean_text = clean_text[:-3]
-            
-            data = json.loads(clean_text.strip())
             data['child_name'] = minimal_story['child_name']
             
-            # Asegurar estructura con IDs numéricos
-            if 'personajes_principales' not in data:
-                data['personajes_principales'] = [
-                    {
-                        "id": 1,
-                        "nombre": minimal_story['protagonista']['nombre'],
-                        "descripcion": minimal_story['protagonista']['descripcion_fisica']
-                    }
-                ]
-            
-            if 'objetos_importantes' not in data:
-                data['objetos_importantes'] = []
-            
-            if 'escenarios' not in data:
-                data['escenarios'] = [
-                    {
-                        "id": 1,
-                        "nombre": "Escenario principal",
-                        "descripcion": minimal_story.get('mundo_descripcion', 'Mundo mágico')
-                    }
-                ]
-            
-            # Limitar y numerar
-            data['personajes_principales'] = data['personajes_principales'][:3]
-            for i, p in enumerate(data['personajes_principales'], 1):
-                p['id'] = i
-            
-            data['objetos_importantes'] = data['objetos_importantes'][:3]
-            for i, o in enumerate(data['objetos_importantes'], 1):
-                o['id'] = i
-            
-            data['escenarios'] = data['escenarios'][:3]
-            for i, e in enumerate(data['escenarios'], 1):
-                e['id'] = i
+            # Escenario por defecto, limitar y numerar
+            for key in OUTLINE_SECTIONS:
+                data[key] = self._normalize_section(key, data[key], minimal_story)
             
             # Ajustar páginas
             if len(data['paginas']) != num_pages:
@@ -282,6 +419,26 @@ CRÍTICO: Las descripciones deben ser TAN detalladas que un ilustrador pueda dib
             print(f"❌ Error parseando historia completa: {e}")
             raise e
     
+    def _normalize_section(self, key: str, items: List[Dict], minimal_story: Dict) -> List[Dict]:
+        """Personajes, objetos o escenarios tal como se guardan (y se emiten en streaming)"""
+        if key == 'escenarios' and not items:
+            items = [
+                {
+                    "id": 1,
+                    "nombre": "Escenario principal",
+                    "descripcion": minimal_story.get('mundo_descripcion', 'Mundo mágico')
+                }
+            ]
+        return self._number_items(items)
+    
+    @staticmethod
+    def _number_items(items: List[Dict]) -> List[Dict]:
+        """Máximo 3 elementos, con IDs 1..n (los que usan sheets y páginas)"""
+        items = items[:3]
+        for i, item in enumerate(items, 1):
+            item['id'] = i
+        return items
+    
     def _fallback_minimal_story(self, child_name: str, age: int) -> Dict:
         """Historia mínima de respaldo"""
         return {
@@ -0,0 +1,142 @@
+"""
+Peticiones "hedged": si la primera tarda más que el percentil configurado de
+las latencias recientes, se lanza una segunda y gana la que termine antes
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from ..config import settings
+
+
+class Hedger:
+    """
+    Lanza una petición de respaldo cuando la principal supera el percentil
+    `hedge_percentile` de las últimas latencias. Se queda con el primer
+    resultado válido (no None), cancela la otra y descarta su salida si llegó
+    a producirla. Como mucho `max_rate` de las peticiones recientes llevan
+    respaldo, para que el coste extra esté acotado.
+    """
+
+    def __init__(self, name: str, window: int = 100):
+        self.name = name
+        self.latencies: Deque[float] = deque(maxlen=window)  # Segundos de las peticiones con éxito
+        self.recent_hedged: Deque[bool] = deque(maxlen=window)  # ¿Llevó respaldo? (para el tope)
+
+        # Métricas
+        self.requests = 0
+        self.hedges = 0
+        self.backup_wins = 0
+        self.capped = 0  # Veces que se habría lanzado respaldo pero el tope lo impidió
+
+    def hedge_delay(self) -> Optional[float]:
+        """Espera antes del respaldo (None si aún no hay suficientes muestras)"""
+        if len(self.latencies) < settings.cover_hedge_min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, math.ceil(settings.cover_hedge_percentile / 100 * len(ordered)) - 1)
+        return ordered[max(0, index)]
+
+    def _can_hedge(self) -> bool:
+        if not self.recent_hedged:
+            return True
+        return sum(self.recent_hedged) / len(self.recent_hedged) < settings.cover_hedge_max_rate
+
+    async def run(
+        self,
+        primary: Callable[[], Awaitable[Any]],
+        backup: Callable[[], Awaitable[Any]],
+        discard: Optional[Callable[[Any], None]] = None
+    ) -> Any:
+        """Ejecutar `primary` y, si se retrasa, también `backup`; devuelve el primer resultado válido"""
+        self.requests += 1
+        started = time.monotonic()
+        primary_task = asyncio.ensure_future(primary())
+        delay = self.hedge_delay() if settings.cover_hedging_enabled else None
+
+        hedged = False
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait({primary_task}, timeout=delay)
+                if not done:
+                    if self._can_hedge():
+                        hedged = True
+                    else:
+                        self.capped += 1
+
+            if not hedged:
+                result = await primary_task
+                if result is not None:
+                    self.latencies.append(time.monotonic() - started)
+                return result
+
+            self.hedges += 1
+            print(f"🏇 {self.name}: sin respuesta tras {delay:.1f}s (p{settings.cover_hedge_percentile:g}), lanzando petición de respaldo")
+            backup_task = asyncio.ensure_future(backup())
+            return await self._first_valid(primary_task, backup_task, started, discard)
+        finally:
+            self.recent_hedged.append(hedged)
+            if not primary_task.done():
+                primary_task.cancel()
+
+    async def _first_valid(self, primary_task, backup_task, started: float, discard) -> Any:
+        pending = {primary_task, backup_task}
+        result = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled() or task.exception() is not None:
+                        continue
+                    if task.result() is None:
+                        continue
+                    if result is None:
+                        result = task.result()
+                        if task is backup_task:
+                            self.backup_wins += 1
+                        self.latencies.append(time.monotonic() - started)
+                    elif discard:
+                        # Terminaron las dos a la vez: sobra la salida de la perdedora
+                        discard(task.result())
+                if result is not None:
+                    return result
+            # Ninguna dio resultado: se propaga el error de la principal si lo hubo
+            if not primary_task.cancelled() and primary_task.exception() is not None:
+                raise primary_task.exception()
+            return None
+        finally:
+            for task in pending:
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    # Terminó justo al resolverse la otra: su salida también sobra
+                    if task.result() is not None and discard:
+                        discard(task.result())
+                else:
+                    task.cancel()
+
+    def stats(self) -> dict:
+        delay = self.hedge_delay()
+        return {
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_rate': round(self.hedges / self.requests, 3) if self.requests else 0.0,
+            'backup_wins': self.backup_wins,
+            'capped': self.capped,
+            'hedge_delay_seconds': round(delay, 2) if delay is not None else None,
+        }
+
+
+# Un hedger por tipo de petición, compartido por todo el proceso
+_hedgers: Dict[str, Hedger] = {}
+
+def get_hedger(name: str) -> Hedger:
+    if name not in _hedgers:
+        _hedgers[name] = Hedger(name)
+    return _hedgers[name]
+
+
+def get_hedging_stats() -> dict:
+    """Métricas de todos los hedgers"""
+    return {hedger.name: hedger.stats() for hedger in _hedgers.values()}
@@ -0,0 +1,106 @@
+"""
+Envíos idempotentes: cabecera Idempotency-Key y transiciones de estado
+atómicas, para que un doble clic o un reintento del cliente no cree otro
+libro ni encole otra generación
+"""
+
+import hashlib
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Union
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models import Book, IdempotencyKey
+
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 100
+
+
+def request_fingerprint(*parts: Union[str, bytes]) -> str:
+    """Huella de los datos de un envío, para detectar una clave reutilizada con otros datos"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def find_idempotency_key(db: Session, key: Optional[str], endpoint: str) -> Optional[IdempotencyKey]:
+    """Envío anterior con la misma clave (si no ha caducado)"""
+    if not key:
+        return None
+    cutoff = datetime.utcnow() - timedelta(hours=settings.idempotency_key_ttl_hours)
+    return db.query(IdempotencyKey).filter(
+        IdempotencyKey.key == key,
+        IdempotencyKey.endpoint == endpoint,
+        IdempotencyKey.created_at >= cutoff
+    ).first()
+
+
+def add_idempotency_key(
+    db: Session,
+    key: Optional[str],
+    endpoint: str,
+    book_id: str,
+    job_id: Optional[int] = None,
+    request_hash: Optional[str] = None
+):
+    """
+    Añadir la clave a la transacción en curso (sin commit): el libro o el
+    trabajo y su clave se guardan juntos. Si otro envío con la misma clave
+    llega antes, el commit del llamante lanza IntegrityError.
+    """
+    if not key:
+        return
+    # Las claves caducadas se pueden reutilizar
+    cutoff = datetime.utcnow() - timedelta(hours=settings.idempotency_key_ttl_hours)
+    db.query(IdempotencyKey).filter(
+        IdempotencyKey.endpoint == endpoint,
+        IdempotencyKey.created_at < cutoff
+    ).delete(synchronize_session=False)
+    db.add(IdempotencyKey(
+        key=key, endpoint=endpoint, book_id=book_id, job_id=job_id, request_hash=request_hash
+    ))
+
+
+def remember_idempotency_key(
+    db: Session,
+    key: Optional[str],
+    endpoint: str,
+    book_id: str,
+    job_id: Optional[int] = None
+):
+    """Guardar la clave de un envío ya aceptado (si otro la guardó antes, se queda la suya)"""
+    if not key:
+        return
+    add_idempotency_key(db, key, endpoint, book_id, job_id)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+
+
+def transition_book_status(
+    db: Session,
+    book_id: str,
+    from_statuses: Iterable[str],
+    to_status: str,
+    **values
+) -> bool:
+    """
+    Compare-and-set del estado del libro: solo cambia si sigue en uno de
+    `from_statuses`. De dos peticiones simultáneas solo una obtiene True.
+    Los objetos Book ya cargados en la sesión quedan desactualizados (refresh).
+    """
+    updated = db.query(Book).filter(
+        Book.id == book_id,
+        Book.status.in_(list(from_statuses))
+    ).update({
+        Book.status: to_status,
+        **{getattr(Book, name): value for name, value in values.items()}
+    }, synchronize_session=False)
+    db.commit()
+    return bool(updated)
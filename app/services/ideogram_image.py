@@ -2,13 +2,17 @@
 Servicio para Ideogram - Generación de portadas con Character Reference
 """
 
+import asyncio
 import aiohttp
 import aiofiles
 import secrets
-import time
-import asyncio
 from typing import Dict, Optional
 from pathlib import Path
+from .rate_limiter import get_rate_limiter
+from .adaptive_concurrency import get_adaptive_limiter, OVERLOAD_STATUS_CODES
+from .deadlines import remaining_seconds
+from .ledger import track_provider_call
+from .photo_preprocessing import read_reference_photo, reference_photo_path, REFERENCE_MIME_TYPE
 from ..config import settings
 
 
@@ -27,8 +31,8 @@ class IdeogramImageService:
             raise ValueError(f"❌ Solo se soporta V_3_TURBO, modelo actual: {self.model}")
         
         self.base_url = "https://api.ideogram.ai/v1/ideogram-v3/generate"
-        self.last_request = 0
-        self.min_delay = 1
+        self.rate_limiter = get_rate_limiter('ideogram', self.model)
+        self.concurrency = get_adaptive_limiter('ideogram', self.model)
         
         print(f"🎨 Ideogram Service configurado (modelo: {self.model})")
     
@@ -142,26 +146,36 @@ MUY IMPORTANTE: - No pongas otro texto que no sea el título.
             data.add_field('magic_prompt_option', 'OFF')
             data.add_field('style_type', 'FICTION')  # Requerido para character reference
             
-            # Añadir la imagen como character reference
-            with open(photo_path, 'rb') as f:
-                image_data = f.read()
-                data.add_field(
-                    'character_reference_images',
-                    image_data,
-                    filename=Path(photo_path).name,
-                    content_type='image/jpeg'
-                )
+            # Añadir la imagen como character reference (versión preprocesada, sin bloquear el loop)
+            image_data = await read_reference_photo(photo_path)
+            data.add_field(
+                'character_reference_images',
+                image_data,
+                filename=reference_photo_path(photo_path).name,
+                content_type=REFERENCE_MIME_TYPE
+            )
             
             print(f"📤 Enviando request multipart a Ideogram con character reference")
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.base_url, data=data, headers=headers) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        print(f"❌ Error de Ideogram API (multipart): {response.status} - {error_text}")
-                        return None
-                    
-                    return await response.json()
+            # Concurrencia adaptativa: 429/5xx reducen el número de peticiones en vuelo
+            async with self.concurrency.slot() as outcome:
+                timeout = remaining_seconds(settings.timeout_provider_call_seconds)
+                if timeout <= 0:
+                    raise asyncio.TimeoutError("Plazo agotado antes de llamar a Ideogram")
+                request_bytes = len(prompt.encode('utf-8')) + len(image_data)
+                async with track_provider_call('ideogram', self.model, request_bytes) as call, \
+                        aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+                    async with session.post(self.base_url, data=data, headers=headers) as response:
+                        call.response_bytes = response.content_length or 0
+                        if response.status != 200:
+                            error_text = await response.text()
+                            print(f"❌ Error de Ideogram API (multipart): {response.status} - {error_text}")
+                            call.fail(f"HTTP {response.status}: {error_text}")
+                            if response.status in OVERLOAD_STATUS_CODES:
+                                outcome.report_overload()
+                            return None
+                        
+                        return await response.json()
                     
         except Exception as e:
             print(f"❌ Error en multipart request: {e}")
@@ -172,13 +186,17 @@ MUY IMPORTANTE: - No pongas otro texto que no sea el título.
     async def _download_image(self, image_url: str, child_name: str) -> Optional[str]:
         """Descargar imagen desde URL de Ideogram"""
         try:
-            async with aiohttp.ClientSession() as session:
+            timeout = aiohttp.ClientTimeout(total=max(1, remaining_seconds(settings.timeout_provider_call_seconds)))
+            async with track_provider_call('ideogram', 'download') as call, \
+                    aiohttp.ClientSession(timeout=timeout) as session:
                 async with session.get(image_url) as response:
                     if response.status != 200:
                         print(f"❌ Error descargando imagen: {response.status}")
+                        call.fail(f"HTTP {response.status}")
                         return None
                     
                     image_data = await response.read()
+                    call.response_bytes = len(image_data)
                     
                     # Guardar imagen
                     filename = f"cover_{secrets.token_urlsafe(8)}.png"
@@ -194,12 +212,5 @@ MUY IMPORTANTE: - No pongas otro texto que no sea el título.
             return None
     
     async def _respect_rate_limit(self):
-        """Rate limiting"""
-        now = time.time()
-        time_since_last = now - self.last_request
-        
-        if time_since_last < self.min_delay:
-            wait_time = self.min_delay - time_since_last
-            await asyncio.sleep(wait_time)
-        
-        self.last_request = time.time()
\ No newline at end of file
+        """Rate limiting (token bucket compartido por todo el proceso)"""
+        await self.rate_limiter.acquire()
\ No newline at end of file
@@ -0,0 +1,544 @@
+"""
+Cola persistente de trabajos de generación + pool de workers en proceso
+"""
+
+import asyncio
+import json
+import os
+import secrets
+import socket
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .adaptive_concurrency import request_priority
+from .ledger import current_book, current_job, flush_events
+from ..config import settings
+from ..database import SessionLocal
+from ..models import GenerationJob
+
+
+# Tipo de trabajo -> método del orquestador que lo ejecuta
+JOB_HANDLERS = {
+    'preview': 'generate_preview',
+    'regenerate_cover': 'regenerate_preview_cover',
+    'complete_book': 'generate_complete_book',
+    'regenerate_page': 'regenerate_single_page',
+    'speculate': 'speculate_full_book',
+}
+
+# Clases de prioridad (mayor = antes)
+PRIORITY_PAID_BOOK = 40
+PRIORITY_PAGE_REGENERATION = 30
+PRIORITY_PREVIEW = 20
+PRIORITY_COVER_REGENERATION = 10
+PRIORITY_SPECULATIVE = 0
+
+# Cada `job_priority_aging_seconds` de espera un trabajo sube una clase (anti-inanición)
+PRIORITY_STEP = 10
+
+DEFAULT_PRIORITIES = {
+    'complete_book': PRIORITY_PAID_BOOK,
+    'regenerate_page': PRIORITY_PAGE_REGENERATION,
+    'preview': PRIORITY_PREVIEW,
+    'regenerate_cover': PRIORITY_COVER_REGENERATION,
+    'speculate': PRIORITY_SPECULATIVE,
+}
+
+# Tipos que pueden tener varios trabajos activos por libro (cada uno una página distinta)
+MULTIPLE_ACTIVE_KINDS = {'regenerate_page'}
+
+# A partir de esta prioridad el trabajo es de un cliente que ya pagó
+PAID_PRIORITY_THRESHOLD = PRIORITY_PAGE_REGENERATION
+
+# Ventana usada para calcular el throughput (jobs/minuto)
+THROUGHPUT_WINDOW_MINUTES = 10
+
+# Si el intento en curso es el último: solo entonces el handler deja el libro en
+# un estado de error terminal (fuera de la cola, p.ej. llamado a mano, siempre lo es)
+final_attempt: ContextVar[bool] = ContextVar('job_final_attempt', default=True)
+
+# Despierta al dispatcher del proceso actual al encolar (evita esperar al polling)
+_wake_event: Optional[asyncio.Event] = None
+
+
+def enqueue_job(
+    db: Session,
+    book_id: str,
+    kind: str,
+    payload: Optional[dict] = None,
+    priority: Optional[int] = None,
+    batch_id: Optional[str] = None,
+    commit: bool = True
+) -> GenerationJob:
+    """
+    Encolar un trabajo de generación (hace commit en la sesión recibida,
+    salvo commit=False para encolarlo dentro de una transacción mayor).
+    Sin prioridad explícita se usa la de la clase del trabajo.
+    Si el libro ya tiene uno activo del mismo tipo se devuelve ese (un doble
+    envío no genera dos veces); el índice uq_generation_jobs_active lo garantiza
+    también cuando dos peticiones compiten.
+    """
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Tipo de trabajo desconocido: {kind}")
+    if priority is None:
+        priority = DEFAULT_PRIORITIES[kind]
+
+    if kind not in MULTIPLE_ACTIVE_KINDS:
+        existing = find_active_job(db, book_id, kind)
+        if existing:
+            print(f"♻️ Ya hay un trabajo {kind} activo para libro {book_id[:8]} (job {existing.id})")
+            return existing
+
+    job = GenerationJob(
+        book_id=book_id,
+        kind=kind,
+        payload_json=json.dumps(payload) if payload else None,
+        priority=priority,
+        status='pending',
+        attempts=0,
+        max_attempts=settings.job_max_attempts,
+        batch_id=batch_id
+    )
+    db.add(job)
+    if not commit:
+        db.flush()
+        return job
+    try:
+        db.commit()
+    except IntegrityError:
+        # Otra petición encoló el mismo trabajo entre la comprobación y el commit
+        db.rollback()
+        existing = find_active_job(db, book_id, kind)
+        if existing is None:
+            raise
+        return existing
+    db.refresh(job)
+
+    if _wake_event is not None:
+        _wake_event.set()
+
+    print(f"📥 Trabajo encolado: {job.kind} para libro {book_id[:8]} (job {job.id})")
+    return job
+
+
+def find_active_job(db: Session, book_id: str, kind: str) -> Optional[GenerationJob]:
+    """Trabajo pendiente o en curso (y no cancelándose) del libro para ese tipo"""
+    return db.query(GenerationJob).filter(
+        GenerationJob.book_id == book_id,
+        GenerationJob.kind == kind,
+        GenerationJob.status.in_(['pending', 'running']),
+        GenerationJob.cancel_requested.isnot(True)
+    ).first()
+
+
+def find_latest_job(db: Session, book_id: str, kind: str) -> Optional[GenerationJob]:
+    """Último trabajo del libro para ese tipo, en cualquier estado"""
+    return db.query(GenerationJob).filter(
+        GenerationJob.book_id == book_id,
+        GenerationJob.kind == kind
+    ).order_by(GenerationJob.id.desc()).first()
+
+
+def get_queue_stats(db: Session) -> dict:
+    """Métricas de la cola: profundidad, estados y throughput"""
+    counts = dict(
+        db.query(GenerationJob.status, func.count(GenerationJob.id))
+        .group_by(GenerationJob.status)
+        .all()
+    )
+
+    now = datetime.utcnow()
+    since = now - timedelta(minutes=THROUGHPUT_WINDOW_MINUTES)
+    finished_recently = db.query(GenerationJob).filter(
+        GenerationJob.status == 'completed',
+        GenerationJob.finished_at >= since
+    ).count()
+
+    oldest_pending = db.query(func.min(GenerationJob.created_at)).filter(
+        GenerationJob.status == 'pending'
+    ).scalar()
+
+    pending_by_kind = dict(
+        db.query(GenerationJob.kind, func.count(GenerationJob.id))
+        .filter(GenerationJob.status == 'pending')
+        .group_by(GenerationJob.kind)
+        .all()
+    )
+
+    return {
+        'queue_depth': counts.get('pending', 0),
+        'pending_by_kind': pending_by_kind,
+        'running': counts.get('running', 0),
+        'completed': counts.get('completed', 0),
+        'failed': counts.get('failed', 0),
+        'cancelled': counts.get('cancelled', 0),
+        'jobs_per_minute': round(finished_recently / THROUGHPUT_WINDOW_MINUTES, 2),
+        'oldest_pending_seconds': int((now - oldest_pending).total_seconds()) if oldest_pending else 0,
+    }
+
+
+class JobWorkerPool:
+    """
+    Pool de workers que reclama trabajos de la BD y los ejecuta con el orquestador.
+    Cada trabajo reclamado tiene un lease que se renueva mientras corre; si el
+    proceso muere, el lease caduca y otro worker (o el siguiente arranque) lo retoma.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = max(1, concurrency)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self._running: Dict[int, asyncio.Task] = {}
+        self._running_priority: Dict[int, int] = {}
+        self._cancelling: Set[int] = set()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    async def start(self):
+        global _wake_event
+        _wake_event = asyncio.Event()
+        self._recover_stale_jobs()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+        print(f"👷 Pool de workers iniciado ({self.concurrency} workers, id {self.worker_id})")
+
+    async def stop(self):
+        """Parar el pool devolviendo a la cola los trabajos en curso"""
+        for task in (self._dispatcher, self._heartbeat):
+            if task:
+                task.cancel()
+
+        running_ids = list(self._running)
+        for task in self._running.values():
+            task.cancel()
+        if self._running:
+            await asyncio.gather(*self._running.values(), return_exceptions=True)
+
+        self._release_jobs(running_ids)
+        print(f"👷 Pool de workers detenido ({len(running_ids)} trabajos devueltos a la cola)")
+
+    async def _dispatch_loop(self):
+        while True:
+            try:
+                self._poll_cancel_requests()
+            except Exception as e:
+                print(f"❌ Error consultando cancelaciones: {e}")
+
+            try:
+                while len(self._running) < self.concurrency:
+                    # Los últimos huecos se reservan para trabajos de clientes que ya pagaron
+                    unpaid_running = sum(
+                        1 for p in self._running_priority.values() if p < PAID_PRIORITY_THRESHOLD
+                    )
+                    reserved = min(settings.job_reserved_paid_workers, self.concurrency - 1)
+                    min_priority = PAID_PRIORITY_THRESHOLD if unpaid_running >= self.concurrency - reserved else None
+
+                    claimed = self._claim_next(min_priority)
+                    if claimed is None:
+                        break
+                    job_id, priority = claimed
+                    self._running_priority[job_id] = priority
+                    self._running[job_id] = asyncio.create_task(self._run_job(job_id, priority))
+            except Exception as e:
+                print(f"❌ Error en dispatcher de trabajos: {e}")
+
+            _wake_event.clear()
+            try:
+                await asyncio.wait_for(_wake_event.wait(), timeout=settings.job_poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def cancel(self, job_ids: Iterable[int]):
+        """Cancelar trabajos que corren en este pool (la tarea recibe CancelledError)"""
+        for job_id in job_ids:
+            task = self._running.get(job_id)
+            if task and job_id not in self._cancelling:
+                self._cancelling.add(job_id)
+                task.cancel()
+
+    def _poll_cancel_requests(self):
+        """Recoger cancelaciones pedidas desde otro proceso (API web, admin)"""
+        if not self._running:
+            return
+        db = SessionLocal()
+        try:
+            requested = db.query(GenerationJob.id).filter(
+                GenerationJob.id.in_(list(self._running)),
+                GenerationJob.cancel_requested.is_(True)
+            ).all()
+        finally:
+            db.close()
+        self.cancel(job_id for job_id, in requested)
+
+    async def _heartbeat_loop(self):
+        interval = max(1, settings.job_lease_seconds // 3)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self._renew_leases()
+                self._recover_stale_jobs()
+            except Exception as e:
+                print(f"❌ Error renovando leases: {e}")
+
+    def _claim_next(self, min_priority: Optional[int] = None) -> Optional[Tuple[int, int]]:
+        """
+        Reclamar atómicamente el siguiente trabajo pendiente (id, prioridad).
+        El orden es por prioridad efectiva: la de su clase más un escalón por
+        cada `job_priority_aging_seconds` que lleva esperando.
+        """
+        db = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            ready = db.query(
+                GenerationJob.id, GenerationJob.priority, GenerationJob.created_at
+            ).filter(
+                GenerationJob.status == 'pending',
+                or_(GenerationJob.run_after.is_(None), GenerationJob.run_after <= now)
+            )
+            if min_priority is not None:
+                ready = ready.filter(GenerationJob.priority >= min_priority)
+
+            # Reparto justo: un lote grande no ocupa más de `batch_max_concurrent_jobs` workers
+            saturated_batches = [
+                batch_id for batch_id, running in
+                db.query(GenerationJob.batch_id, func.count(GenerationJob.id)).filter(
+                    GenerationJob.status == 'running',
+                    GenerationJob.batch_id.isnot(None)
+                ).group_by(GenerationJob.batch_id).all()
+                if running >= settings.batch_max_concurrent_jobs
+            ]
+            if saturated_batches:
+                ready = ready.filter(or_(
+                    GenerationJob.batch_id.is_(None),
+                    GenerationJob.batch_id.notin_(saturated_batches)
+                ))
+
+            # Los más prioritarios + los más antiguos (candidatos a envejecer)
+            candidates = {
+                row.id: row for row in
+                ready.order_by(GenerationJob.priority.desc(), GenerationJob.id.asc()).limit(20).all()
+                + ready.order_by(GenerationJob.id.asc()).limit(20).all()
+            }
+
+            def effective_priority(row) -> int:
+                waited = (now - row.created_at).total_seconds() if row.created_at else 0
+                aging = int(waited // max(1, settings.job_priority_aging_seconds)) * PRIORITY_STEP
+                return (row.priority or 0) + aging
+
+            ordered = sorted(candidates.values(), key=lambda row: (-effective_priority(row), row.id))
+
+            for row in ordered[:5]:
+                # Compare-and-set: solo uno de los workers que compitan gana
+                claimed = db.query(GenerationJob).filter(
+                    GenerationJob.id == row.id,
+                    GenerationJob.status == 'pending'
+                ).update({
+                    GenerationJob.status: 'running',
+                    GenerationJob.worker_id: self.worker_id,
+                    GenerationJob.locked_until: now + timedelta(seconds=settings.job_lease_seconds),
+                    GenerationJob.started_at: now,
+                    GenerationJob.attempts: GenerationJob.attempts + 1,
+                }, synchronize_session=False)
+                db.commit()
+                if claimed:
+                    return row.id, row.priority or 0
+            return None
+        finally:
+            db.close()
+
+    async def _run_job(self, job_id: int, priority: int):
+        error = None
+        cancelled = False
+        # Las llamadas a proveedores de este trabajo heredan su prioridad
+        request_priority.set(priority)
+        try:
+            db = SessionLocal()
+            try:
+                job = db.get(GenerationJob, job_id)
+                kind, book_id = job.kind, job.book_id
+                payload = json.loads(job.payload_json) if job.payload_json else {}
+                attempt, max_attempts = job.attempts, job.max_attempts
+            finally:
+                db.close()
+
+            print(f"⚙️ Ejecutando job {job_id}: {kind} para libro {book_id[:8]} (intento {attempt}/{max_attempts})")
+            current_book.set(book_id)
+            current_job.set(job_id)
+            final_attempt.set(attempt >= max_attempts)
+
+            from .book_orchestrator import get_book_orchestrator
+            handler = getattr(get_book_orchestrator(), JOB_HANDLERS[kind])
+            result = await handler(book_id, **payload)
+            if result is False:
+                error = "La generación terminó con error"
+        except asyncio.CancelledError:
+            # Parada del pool: se propaga y el trabajo vuelve a la cola
+            if job_id not in self._cancelling:
+                raise
+            cancelled = True
+        except Exception as e:
+            error = str(e)
+        finally:
+            self._running.pop(job_id, None)
+            self._running_priority.pop(job_id, None)
+            self._cancelling.discard(job_id)
+            flush_events()
+            if _wake_event is not None:
+                _wake_event.set()
+
+        if cancelled:
+            self._finish_cancelled_job(job_id)
+        else:
+            self._finish_job(job_id, error)
+
+    def _finish_job(self, job_id: int, error: Optional[str]):
+        db = SessionLocal()
+        try:
+            job = db.get(GenerationJob, job_id)
+            now = datetime.utcnow()
+            job.worker_id = None
+            job.locked_until = None
+
+            if error is None:
+                job.status = 'completed'
+                job.finished_at = now
+                print(f"✅ Job {job_id} completado")
+            elif job.attempts < job.max_attempts:
+                job.status = 'pending'
+                job.last_error = error
+                job.run_after = now + timedelta(seconds=settings.job_retry_delay_seconds * job.attempts)
+                print(f"⚠️ Job {job_id} falló (intento {job.attempts}/{job.max_attempts}), se reintentará: {error}")
+            else:
+                job.status = 'failed'
+                job.last_error = error
+                job.finished_at = now
+                print(f"❌ Job {job_id} falló definitivamente: {error}")
+
+            db.commit()
+
+            if job.batch_id and job.status != 'pending':
+                from .batches import finish_batch_if_done
+                finish_batch_if_done(db, job.batch_id)
+        finally:
+            db.close()
+
+    def _finish_cancelled_job(self, job_id: int):
+        from .cancellation import CANCELLED_MESSAGE, release_cancelled_work
+
+        db = SessionLocal()
+        try:
+            job = db.get(GenerationJob, job_id)
+            job.status = 'cancelled'
+            job.last_error = CANCELLED_MESSAGE
+            job.finished_at = datetime.utcnow()
+            job.worker_id = None
+            job.locked_until = None
+            db.commit()
+            print(f"🛑 Job {job_id} cancelado")
+
+            release_cancelled_work(db, job.book_id, job.kind)
+        finally:
+            db.close()
+
+    def _renew_leases(self):
+        if not self._running:
+            return
+        db = SessionLocal()
+        try:
+            db.query(GenerationJob).filter(
+                GenerationJob.id.in_(list(self._running)),
+                GenerationJob.worker_id == self.worker_id
+            ).update({
+                GenerationJob.locked_until: datetime.utcnow() + timedelta(seconds=settings.job_lease_seconds)
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _recover_stale_jobs(self):
+        """Devolver a la cola los trabajos cuyo worker murió (lease caducado)"""
+        db = SessionLocal()
+        try:
+            stale = db.query(GenerationJob).filter(
+                GenerationJob.status == 'running',
+                or_(GenerationJob.locked_until.is_(None), GenerationJob.locked_until < datetime.utcnow())
+            ).all()
+
+            cancelled = []
+            for job in stale:
+                job.worker_id = None
+                job.locked_until = None
+                if job.cancel_requested:
+                    job.status = 'cancelled'
+                    job.finished_at = datetime.utcnow()
+                    cancelled.append((job.book_id, job.kind))
+                elif job.attempts < job.max_attempts:
+                    job.status = 'pending'
+                    print(f"♻️ Job {job.id} recuperado tras caída del worker")
+                else:
+                    job.status = 'failed'
+                    job.last_error = "Worker caído tras el último intento"
+                    job.finished_at = datetime.utcnow()
+
+            if stale:
+                db.commit()
+
+            failed_batches = {job.batch_id for job in stale if job.batch_id and job.status == 'failed'}
+            if failed_batches:
+                from .batches import finish_batch_if_done
+                for batch_id in failed_batches:
+                    finish_batch_if_done(db, batch_id)
+
+            if cancelled:
+                from .cancellation import release_cancelled_work
+                for book_id, kind in cancelled:
+                    release_cancelled_work(db, book_id, kind)
+        finally:
+            db.close()
+
+    def _release_jobs(self, job_ids):
+        """Devolver trabajos interrumpidos por una parada ordenada (no cuenta como intento)"""
+        if not job_ids:
+            return
+        db = SessionLocal()
+        try:
+            db.query(GenerationJob).filter(
+                GenerationJob.id.in_(job_ids),
+                GenerationJob.status == 'running'
+            ).update({
+                GenerationJob.status: 'pending',
+                GenerationJob.worker_id: None,
+                GenerationJob.locked_until: None,
+                GenerationJob.attempts: GenerationJob.attempts - 1,
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+
+# Singleton
+_pool: Optional[JobWorkerPool] = None
+
+async def start_worker_pool(concurrency: int) -> JobWorkerPool:
+    """Arrancar el pool de workers del proceso actual"""
+    global _pool
+    if _pool is None:
+        _pool = JobWorkerPool(concurrency)
+        await _pool.start()
+    return _pool
+
+def request_local_cancel(job_ids: Iterable[int]):
+    """Cancelar ya los trabajos que corran en el pool de este proceso (si hay)"""
+    if _pool is not None:
+        _pool.cancel(job_ids)
+
+async def stop_worker_pool():
+    """Parar el pool de workers del proceso actual"""
+    global _pool
+    if _pool is not None:
+        await _pool.stop()
+        _pool = None
@@ -0,0 +1,239 @@
+"""
+Registro de coste y latencia por libro: stages del pipeline y llamadas a
+proveedores (tiempo, intentos, bytes y tokens) en la tabla generation_events
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from ..database import SessionLocal
+from ..models import GenerationEvent
+
+
+# Libro / trabajo / stage en curso: los fija el worker y el pipeline, y las
+# llamadas a proveedores los heredan sin pasarlos por parámetros
+current_book: ContextVar[Optional[str]] = ContextVar('ledger_book', default=None)
+current_job: ContextVar[Optional[int]] = ContextVar('ledger_job', default=None)
+current_stage: ContextVar[Optional[Tuple[str, str]]] = ContextVar('ledger_stage', default=None)  # (pipeline, stage)
+
+# Eventos pendientes de guardar (se vuelcan al terminar cada trabajo)
+_pending: List[Dict] = []
+
+
+def record_event(event_type: str, **fields):
+    """Anotar un evento del libro en curso (sin libro en contexto no se registra)"""
+    book_id = fields.pop('book_id', None) or current_book.get()
+    if not book_id:
+        return
+    if 'stage' not in fields and current_stage.get():
+        fields['pipeline'], fields['stage'] = current_stage.get()
+    _pending.append({
+        'book_id': book_id,
+        'job_id': current_job.get(),
+        'event_type': event_type,
+        'created_at': datetime.utcnow(),
+        **fields,
+    })
+
+
+def flush_events():
+    """Guardar en BD, en una sola transacción, los eventos anotados"""
+    if not _pending:
+        return
+    events = _pending[:]
+    _pending.clear()
+
+    db = SessionLocal()
+    try:
+        db.add_all(GenerationEvent(**event) for event in events)
+        db.commit()
+    except Exception as e:
+        print(f"❌ Error guardando eventos de generación: {e}")
+    finally:
+        db.close()
+
+
+def estimate_request_bytes(contents: list) -> int:
+    """Tamaño aproximado de lo que se envía: texto en UTF-8 e imágenes por su archivo"""
+    total = 0
+    for item in contents:
+        if isinstance(item, str):
+            total += len(item.encode('utf-8'))
+        elif isinstance(item, (bytes, bytearray)):
+            total += len(item)
+        elif getattr(item, 'filename', None) and Path(item.filename).exists():
+            total += Path(item.filename).stat().st_size
+        elif getattr(item, 'inline_data', None) is not None and item.inline_data.data:  # types.Part con bytes
+            total += len(item.inline_data.data)
+        elif hasattr(item, 'size'):  # Imagen PIL en memoria
+            width, height = item.size
+            total += width * height * 3
+    return total
+
+
+class ProviderCall:
+    """Datos de una llamada que se completan al recibir la respuesta"""
+
+    def __init__(self, provider: str, model: str, request_bytes: int):
+        self.provider = provider
+        self.model = model
+        self.request_bytes = request_bytes
+        self.response_bytes = 0
+        self.input_tokens: Optional[int] = None
+        self.output_tokens: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def fail(self, error: str):
+        """Marcar como fallida una llamada que no lanzó excepción (p.ej. HTTP 4xx/5xx)"""
+        self.error = error[:500]
+
+    def set_response(self, response):
+        """Bytes y tokens de una respuesta de google-genai"""
+        if response is None:
+            return
+        for candidate in getattr(response, 'candidates', None) or []:
+            content = getattr(candidate, 'content', None)
+            for part in getattr(content, 'parts', None) or []:
+                if getattr(part, 'text', None):
+                    self.response_bytes += len(part.text.encode('utf-8'))
+                inline_data = getattr(part, 'inline_data', None)
+                if inline_data is not None and inline_data.data:
+                    self.response_bytes += len(inline_data.data)
+
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            self.input_tokens = getattr(usage, 'prompt_token_count', None)
+            self.output_tokens = getattr(usage, 'candidates_token_count', None)
+
+
+@asynccontextmanager
+async def track_provider_call(provider: str, model: str, request_bytes: int = 0):
+    """Medir una llamada a un proveedor y anotarla en el libro en curso"""
+    call = ProviderCall(provider, model, request_bytes)
+    started = time.monotonic()
+    status, error = 'ok', None
+    try:
+        yield call
+    except asyncio.CancelledError:
+        status = 'cancelled'
+        raise
+    except (asyncio.TimeoutError, TimeoutError):
+        status, error = 'timeout', "Plazo superado"
+        raise
+    except Exception as e:
+        status, error = 'failed', str(e)[:500]
+        raise
+    finally:
+        if status == 'ok' and call.error:
+            status, error = 'failed', call.error
+        record_event(
+            'provider_call',
+            provider=provider,
+            model=model,
+            status=status,
+            attempts=1,
+            duration_ms=int((time.monotonic() - started) * 1000),
+            request_bytes=call.request_bytes,
+            response_bytes=call.response_bytes,
+            input_tokens=call.input_tokens,
+            output_tokens=call.output_tokens,
+            error=error,
+        )
+
+
+def get_book_ledger(db: Session, book_id: str, total_pages: Optional[int] = None) -> Dict:
+    """Eventos de un libro y su resumen por stage, por proveedor y por página"""
+    events = db.query(GenerationEvent).filter(
+        GenerationEvent.book_id == book_id
+    ).order_by(GenerationEvent.created_at, GenerationEvent.id).all()
+
+    by_stage: Dict[str, Dict] = {}
+    by_provider: Dict[str, Dict] = {}
+    totals = {'provider_calls': 0, 'failed_calls': 0, 'request_bytes': 0,
+              'response_bytes': 0, 'input_tokens': 0, 'output_tokens': 0}
+    calls_per_stage: Dict[str, int] = {}
+    page_calls = {'provider_calls': 0, 'seconds': 0.0, 'input_tokens': 0, 'output_tokens': 0}
+
+    for event in events:
+        if event.event_type == 'stage':
+            stage = by_stage.setdefault(f"{event.pipeline}.{event.stage}", {
+                'runs': 0, 'attempts': 0, 'seconds': 0.0, 'failed': 0, 'provider_calls': 0
+            })
+            stage['runs'] += 1
+            stage['attempts'] += event.attempts or 0
+            stage['seconds'] = round(stage['seconds'] + (event.duration_ms or 0) / 1000, 2)
+            stage['failed'] += event.status != 'ok'
+            continue
+
+        provider = by_provider.setdefault(f"{event.provider}:{event.model}", {
+            'calls': 0, 'failed': 0, 'seconds': 0.0, 'input_tokens': 0, 'output_tokens': 0
+        })
+        provider['calls'] += 1
+        provider['failed'] += event.status != 'ok'
+        provider['seconds'] = round(provider['seconds'] + (event.duration_ms or 0) / 1000, 2)
+        provider['input_tokens'] += event.input_tokens or 0
+        provider['output_tokens'] += event.output_tokens or 0
+
+        totals['provider_calls'] += 1
+        totals['failed_calls'] += event.status != 'ok'
+        totals['request_bytes'] += event.request_bytes or 0
+        totals['response_bytes'] += event.response_bytes or 0
+        totals['input_tokens'] += event.input_tokens or 0
+        totals['output_tokens'] += event.output_tokens or 0
+
+        # Llamadas hechas dentro de un stage del pipeline
+        if event.stage:
+            key = f"{event.pipeline}.{event.stage}"
+            calls_per_stage[key] = calls_per_stage.get(key, 0) + 1
+
+        if event.stage == 'pages':
+            page_calls['provider_calls'] += 1
+            page_calls['seconds'] += (event.duration_ms or 0) / 1000
+            page_calls['input_tokens'] += event.input_tokens or 0
+            page_calls['output_tokens'] += event.output_tokens or 0
+
+    for key, calls in calls_per_stage.items():
+        if key in by_stage:
+            by_stage[key]['provider_calls'] = calls
+
+    # Coste medio de una página (llamadas, tiempo y tokens) para contrastarlo con su precio
+    per_page = None
+    if total_pages:
+        per_page = {key: round(value / total_pages, 2) for key, value in page_calls.items()}
+        per_page['pages'] = total_pages
+
+    return {
+        'book_id': book_id,
+        'totals': totals,
+        'by_stage': by_stage,
+        'by_provider': by_provider,
+        'per_page': per_page,
+        'events': [
+            {
+                'id': event.id,
+                'job_id': event.job_id,
+                'type': event.event_type,
+                'pipeline': event.pipeline,
+                'stage': event.stage,
+                'provider': event.provider,
+                'model': event.model,
+                'status': event.status,
+                'attempts': event.attempts,
+                'duration_ms': event.duration_ms,
+                'request_bytes': event.request_bytes,
+                'response_bytes': event.response_bytes,
+                'input_tokens': event.input_tokens,
+                'output_tokens': event.output_tokens,
+                'error': event.error,
+                'created_at': event.created_at.isoformat() if event.created_at else None,
+            }
+            for event in events
+        ],
+    }
@@ -2,6 +2,7 @@
 Generador de PDFs para libros
 """
 
+import asyncio
 from reportlab.lib.pagesizes import inch
 from reportlab.pdfgen import canvas
 from reportlab.lib.colors import Color
@@ -31,9 +32,23 @@ class PDFGenerator:
         - Portada a página completa
         - 12 páginas con imagen + texto superpuesto
         - Contraportada
+        El dibujo (reportlab/PIL) es síncrono: va en un hilo para no bloquear el
+        event loop y para que el plazo del stage pueda abandonarlo.
         """
+        pdf_filename = f"libro_{book.child_name}_{book.id[:8]}.pdf"
+        return await asyncio.to_thread(
+            self._build_pdf, pdf_filename, story_data, cover_filename, page_filenames
+        )
+    
+    def _build_pdf(
+        self,
+        pdf_filename: str,
+        story_data: Dict,
+        cover_filename: Optional[str],
+        page_filenames: List[Optional[str]]
+    ) -> Optional[str]:
+        """Dibujar y guardar el PDF (se ejecuta fuera del event loop)"""
         try:
-            pdf_filename = f"libro_{book.child_name}_{book.id[:8]}.pdf"
             pdf_path = settings.pdfs_dir / pdf_filename
             
             c = canvas.Canvas(str(pdf_path), pagesize=self.page_size)
@@ -102,7 +117,7 @@ class PDFGenerator:
                 c.showPage()
             
             # 3. CONTRAPORTADA
-            await self._add_back_cover(c, story_data, width, height)
+            self._add_back_cover(c, story_data, width, height)
             c.showPage()
             
             c.save()
@@ -159,7 +174,7 @@ class PDFGenerator:
         
         return lines
     
-    async def _add_back_cover(self, canvas_obj, story_data: Dict, width: float, height: float):
+    def _add_back_cover(self, canvas_obj, story_data: Dict, width: float, height: float):
         """Añadir contraportada"""
         try:
             # Crear imagen para contraportada
@@ -0,0 +1,80 @@
+"""
+Foto de referencia preprocesada: se orienta, recorta, reduce y codifica una
+sola vez al subirla (`<foto>.ref.jpg`) y todos los servicios envían esos bytes
+"""
+
+import asyncio
+from pathlib import Path
+
+import aiofiles
+from PIL import Image, ImageOps
+
+from ..config import settings
+
+
+REFERENCE_SUFFIX = ".ref.jpg"
+REFERENCE_MIME_TYPE = "image/jpeg"
+
+# Proporciones a partir de las que se recorta (alto/ancho y ancho/alto)
+MAX_PORTRAIT_RATIO = 1.5  # Fotos de cuerpo entero: se conserva la parte de arriba
+MAX_LANDSCAPE_RATIO = 1.5  # Panorámicas: se conserva el centro
+
+
+def reference_photo_path(photo_path: str) -> Path:
+    """Ruta de la versión preprocesada de una foto subida"""
+    path = Path(photo_path)
+    return path.with_name(path.stem + REFERENCE_SUFFIX)
+
+
+def _crop_to_subject(img: Image.Image) -> Image.Image:
+    """
+    Recorte heurístico al torso (sin detector de caras): en fotos muy
+    verticales el niño suele estar de cuerpo entero con la cara arriba, y en
+    las muy apaisadas, centrado. Las proporciones normales no se tocan.
+    """
+    width, height = img.size
+    if height > width * MAX_PORTRAIT_RATIO:
+        # Un pequeño margen por encima por si la cabeza no está pegada al borde
+        crop_height = int(width * MAX_PORTRAIT_RATIO)
+        top = min(int(height * 0.03), height - crop_height)
+        return img.crop((0, top, width, top + crop_height))
+    if width > height * MAX_LANDSCAPE_RATIO:
+        crop_width = int(height * MAX_LANDSCAPE_RATIO)
+        left = (width - crop_width) // 2
+        return img.crop((left, 0, left + crop_width, height))
+    return img
+
+
+def preprocess_photo(photo_path: str) -> Path:
+    """Crear `<foto>.ref.jpg`: orientación EXIF, recorte, tamaño máximo y JPEG"""
+    target = reference_photo_path(photo_path)
+    with Image.open(photo_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode != 'RGB':
+            # Transparencias sobre blanco (PNG/WebP/GIF)
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.split()[3])
+        img = _crop_to_subject(img)
+        img.thumbnail((settings.reference_photo_max_side, settings.reference_photo_max_side), Image.LANCZOS)
+        img.save(target, 'JPEG', quality=settings.reference_photo_quality, optimize=True)
+    print(f"🖼️ Foto de referencia preparada: {target.name} ({target.stat().st_size // 1024} KB)")
+    return target
+
+
+async def read_reference_photo(photo_path: str) -> bytes:
+    """
+    Bytes de la foto de referencia. Las fotos subidas antes de existir el
+    preprocesado se procesan la primera vez que se usan.
+    """
+    target = reference_photo_path(photo_path)
+    if not target.exists():
+        target = await asyncio.to_thread(preprocess_photo, photo_path)
+    async with aiofiles.open(target, 'rb') as f:
+        return await f.read()
+
+
+def delete_photo(photo_path: str):
+    """Borrar la foto subida y su versión preprocesada"""
+    Path(photo_path).unlink(missing_ok=True)
+    reference_photo_path(photo_path).unlink(missing_ok=True)
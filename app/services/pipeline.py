@@ -0,0 +1,256 @@
+"""
+Motor de pipelines: DAG de stages con reintentos, clases de concurrencia y tiempos
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from .deadlines import deadline_scope
+from .ledger import current_stage, record_event
+from ..config import settings
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Política de reintentos de un stage"""
+    attempts: int = 1
+    delay_seconds: float = 2.0
+
+
+NO_RETRY = RetryPolicy(attempts=1)
+DEFAULT_RETRY = RetryPolicy(attempts=3, delay_seconds=2.0)
+
+
+@dataclass
+class Stage:
+    """
+    Paso del pipeline. `run` recibe como kwargs los resultados de los stages
+    listados en `inputs` (o valores iniciales del pipeline con ese nombre).
+    Un intento falla si lanza una excepción o devuelve None.
+    """
+    name: str
+    run: Callable[..., Awaitable[Any]]
+    inputs: Sequence[str] = ()
+    retry: RetryPolicy = NO_RETRY
+    concurrency: str = 'default'  # text, image, cpu o default (sin límite)
+    label: Optional[str] = None  # Nombre legible para los mensajes de error
+    timeout: Optional[float] = None  # Plazo por intento en segundos (None = sin plazo propio)
+    on_failure: Optional[Callable[[BaseException], None]] = None  # Tras agotar los intentos (o saltarse)
+
+
+@dataclass
+class StageTiming:
+    """Resultado y tiempo de un stage en una ejecución"""
+    name: str
+    status: str  # ok, failed, skipped
+    attempts: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+
+class StageFailed(Exception):
+    """Un stage agotó sus intentos o dependía de uno que falló"""
+
+    def __init__(self, stage: str, message: str):
+        super().__init__(message)
+        self.stage = stage
+
+
+# Margen para que venza antes el plazo de la llamada al proveedor (cuenta como
+# sobrecarga en el limitador adaptativo) que el del propio stage
+STAGE_TIMEOUT_GRACE_SECONDS = 1.0
+
+# Métrica: intentos abandonados por plazo, por "pipeline.stage"
+_stage_timeouts: Dict[str, int] = {}
+
+
+def get_stage_timeout_stats() -> Dict[str, int]:
+    """Intentos de stage abandonados por superar su plazo"""
+    return dict(_stage_timeouts)
+
+
+# Semáforos por clase de concurrencia, compartidos por todos los pipelines del proceso
+_class_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+def _semaphore_for(concurrency_class: str) -> Optional[asyncio.Semaphore]:
+    limits = {
+        'text': settings.stage_concurrency_text,
+        'image': settings.stage_concurrency_image,
+        'cpu': settings.stage_concurrency_cpu,
+    }
+    limit = limits.get(concurrency_class)
+    if not limit:
+        return None
+    if concurrency_class not in _class_semaphores:
+        _class_semaphores[concurrency_class] = asyncio.Semaphore(limit)
+    return _class_semaphores[concurrency_class]
+
+
+class Pipeline:
+    """
+    Ejecuta un conjunto de stages respetando sus dependencias. Los stages
+    independientes corren en paralelo; si uno falla, los que dependen de él
+    se saltan pero el resto termina (para que sus resultados queden guardados).
+    `budget_seconds` limita la ejecución completa: ningún intento se alarga más
+    allá y, agotado, los stages pendientes fallan sin reintentar.
+    """
+
+    def __init__(self, name: str, stages: List[Stage], budget_seconds: Optional[float] = None):
+        self.name = name
+        self.stages: Dict[str, Stage] = {stage.name: stage for stage in stages}
+        self.timings: Dict[str, StageTiming] = {}
+        self.budget_seconds = budget_seconds
+        self._deadline: Optional[float] = None
+
+    def _validate(self, initial: Dict[str, Any]):
+        for stage in self.stages.values():
+            for dep in stage.inputs:
+                if dep not in self.stages and dep not in initial:
+                    raise ValueError(f"Stage '{stage.name}' depende de '{dep}', que no existe")
+
+        # Detectar ciclos (DFS)
+        visiting, visited = set(), set()
+
+        def visit(name: str):
+            if name in visited or name not in self.stages:
+                return
+            if name in visiting:
+                raise ValueError(f"Ciclo en el pipeline '{self.name}' en el stage '{name}'")
+            visiting.add(name)
+            for dep in self.stages[name].inputs:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    async def run(self, **initial) -> Dict[str, Any]:
+        """Ejecutar el pipeline; devuelve los resultados de todos los stages"""
+        self._validate(initial)
+        results: Dict[str, Any] = dict(initial)
+        done = {name: asyncio.Event() for name in self.stages}
+        errors: Dict[str, BaseException] = {}
+        started = time.monotonic()
+        self._deadline = started + self.budget_seconds if self.budget_seconds else None
+
+        async def run_stage(stage: Stage):
+            # Las llamadas a proveedores de este stage quedan anotadas a su nombre
+            current_stage.set((self.name, stage.name))
+            try:
+                for dep in stage.inputs:
+                    if dep not in self.stages:
+                        continue
+                    await done[dep].wait()
+                    if dep in errors:
+                        self.timings[stage.name] = StageTiming(stage.name, 'skipped')
+                        raise StageFailed(stage.name, f"Depende de '{dep}', que falló")
+
+                kwargs = {dep: results[dep] for dep in stage.inputs}
+                results[stage.name] = await self._run_with_retry(stage, kwargs)
+            except Exception as e:
+                errors[stage.name] = e
+                if stage.on_failure:
+                    stage.on_failure(e)
+            finally:
+                done[stage.name].set()
+
+        await asyncio.gather(*(run_stage(stage) for stage in self.stages.values()))
+        self._print_timings(time.monotonic() - started)
+        self._record_timings()
+
+        # Propagar el primer fallo "raíz" (no los stages saltados por dependencia)
+        for name in self.stages:
+            timing = self.timings.get(name)
+            if name in errors and (not timing or timing.status != 'skipped'):
+                raise errors[name]
+
+        return results
+
+    async def _run_with_retry(self, stage: Stage, kwargs: Dict[str, Any]) -> Any:
+        policy = stage.retry
+        semaphore = _semaphore_for(stage.concurrency)
+        started = time.monotonic()
+        last_error = "sin resultado"
+
+        attempts = 0
+
+        for attempt in range(1, policy.attempts + 1):
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                last_error = "presupuesto de tiempo agotado"
+                break
+            attempts = attempt
+
+            timeout = None
+            try:
+                if semaphore:
+                    async with semaphore:
+                        timeout = self._attempt_timeout(stage)
+                        result = await self._run_attempt(stage, kwargs, timeout)
+                else:
+                    timeout = self._attempt_timeout(stage)
+                    result = await self._run_attempt(stage, kwargs, timeout)
+
+                if result is not None:
+                    self.timings[stage.name] = StageTiming(
+                        stage.name, 'ok', attempt, time.monotonic() - started
+                    )
+                    return result
+                last_error = "sin resultado"
+            except asyncio.TimeoutError:
+                key = f"{self.name}.{stage.name}"
+                _stage_timeouts[key] = _stage_timeouts.get(key, 0) + 1
+                last_error = f"superó el plazo de {timeout:.0f}s"
+                print(f"  ⏰ {stage.name}: intento {attempt}/{policy.attempts} {last_error}")
+            except Exception as e:
+                last_error = str(e)
+                print(f"  ❌ {stage.name}: intento {attempt}/{policy.attempts} falló: {e}")
+
+            if attempt < policy.attempts:
+                print(f"  ⚠️ {stage.name}: reintentando en {policy.delay_seconds:g} segundos...")
+                await asyncio.sleep(policy.delay_seconds)
+
+        self.timings[stage.name] = StageTiming(
+            stage.name, 'failed', attempts, time.monotonic() - started, last_error
+        )
+        label = stage.label or stage.name
+        if attempts > 1:
+            message = f"No se pudo generar {label} después de {attempts} intentos ({last_error})"
+        else:
+            message = f"No se pudo generar {label} ({last_error})"
+        raise StageFailed(stage.name, message)
+
+    def _attempt_timeout(self, stage: Stage) -> Optional[float]:
+        """Plazo de un intento: el del stage, recortado por lo que quede de presupuesto"""
+        limits = [stage.timeout] if stage.timeout else []
+        if self._deadline is not None:
+            limits.append(max(0.0, self._deadline - time.monotonic()))
+        return min(limits) if limits else None
+
+    async def _run_attempt(self, stage: Stage, kwargs: Dict[str, Any], timeout: Optional[float]) -> Any:
+        if timeout is None:
+            return await stage.run(**kwargs)
+        # Las llamadas a proveedores del stage heredan el plazo (deadline_scope)
+        with deadline_scope(timeout):
+            return await asyncio.wait_for(stage.run(**kwargs), timeout + STAGE_TIMEOUT_GRACE_SECONDS)
+
+    def _record_timings(self):
+        for timing in self.timings.values():
+            record_event(
+                'stage',
+                pipeline=self.name,
+                stage=timing.name,
+                status=timing.status,
+                attempts=timing.attempts,
+                duration_ms=int(timing.seconds * 1000),
+                error=timing.error,
+            )
+
+    def _print_timings(self, total_seconds: float):
+        parts = [
+            f"{t.name}={t.seconds:.1f}s" + (f" ({t.status})" if t.status != 'ok' else "")
+            for t in self.timings.values()
+        ]
+        print(f"⏱️ Pipeline {self.name}: {total_seconds:.1f}s total | {', '.join(parts)}")
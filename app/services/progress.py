@@ -0,0 +1,219 @@
+"""
+Registro en memoria del progreso de generación, con escrituras a BD agrupadas
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, Set
+
+from ..config import settings
+from ..database import SessionLocal
+from ..models import Book
+
+
+@dataclass
+class BookProgress:
+    """Último estado conocido de un libro en generación"""
+    book_id: str
+    status: str
+    child_name: str
+    title: Optional[str]
+    current_step: Optional[str]
+    progress_percentage: int
+    dirty: bool = False
+    updated_at: float = field(default_factory=time.monotonic)
+
+    def to_status(self) -> dict:
+        """Mismo formato que /api/books/{id}/status para estados no terminales"""
+        return {
+            "book_id": self.book_id,
+            "status": self.status,
+            "child_name": self.child_name,
+            "title": self.title,
+            "current_step": self.current_step,
+            "progress_percentage": self.progress_percentage or 0,
+        }
+
+
+class ProgressRegistry:
+    """
+    Guarda en memoria el paso y porcentaje de cada libro en generación y los
+    vuelca a BD cada `progress_flush_interval_seconds` en una sola transacción.
+    Los estados terminales los escribe el orquestador directamente en el libro,
+    así que al terminar la entrada se descarta (discard) en vez de volcarse.
+    Cada cambio avisa a los suscriptores del libro (streams SSE), que leen
+    el último estado en vez de recibir cada paso intermedio.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, BookProgress] = {}
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self.writes = 0  # Métrica: filas escritas por los volcados
+
+    def track(self, book: Book):
+        """Empezar a seguir un libro (llamar tras confirmar su nuevo estado)"""
+        self._entries[book.id] = BookProgress(
+            book_id=book.id,
+            status=book.status,
+            child_name=book.child_name,
+            title=book.title,
+            current_step=book.current_step,
+            progress_percentage=book.progress_percentage or 0,
+        )
+        self._ensure_flusher()
+        self.notify(book.id)
+
+    def update(self, book_id: str, step: str, progress: int) -> bool:
+        """Actualizar en memoria; False si el libro no se está siguiendo"""
+        entry = self._entries.get(book_id)
+        if not entry:
+            return False
+        entry.current_step = step
+        entry.progress_percentage = progress
+        entry.dirty = True
+        entry.updated_at = time.monotonic()
+        self.notify(book_id)
+        return True
+
+    def get(self, book_id: str) -> Optional[BookProgress]:
+        return self._entries.get(book_id)
+
+    def discard(self, book_id: str):
+        """Dejar de seguir un libro sin volcar (el estado final ya está en BD)"""
+        if self._entries.pop(book_id, None):
+            self.notify(book_id)
+
+    def subscribe(self, book_id: str) -> asyncio.Queue:
+        """Cola que recibe un aviso cada vez que cambia el progreso del libro"""
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers.setdefault(book_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, book_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(book_id)
+        if subscribers:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[book_id]
+
+    def has_subscribers(self, book_id: str) -> bool:
+        return bool(self._subscribers.get(book_id))
+
+    def notify(self, book_id: str):
+        # Colas de tamaño 1: si el suscriptor aún no leyó el aviso anterior, se agrupan
+        for queue in self._subscribers.get(book_id, ()):
+            if queue.empty():
+                queue.put_nowait(None)
+
+    def flush(self):
+        """Volcar a BD las entradas modificadas desde el último volcado"""
+        dirty = [entry for entry in self._entries.values() if entry.dirty]
+        if not dirty:
+            return
+
+        db = SessionLocal()
+        try:
+            for entry in dirty:
+                db.query(Book).filter(Book.id == entry.book_id).update({
+                    Book.current_step: entry.current_step,
+                    Book.progress_percentage: entry.progress_percentage,
+                }, synchronize_session=False)
+                entry.dirty = False
+            db.commit()
+            self.writes += len(dirty)
+        finally:
+            db.close()
+
+    def _ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        # Termina sola cuando no queda nada que seguir
+        while self._entries:
+            await asyncio.sleep(settings.progress_flush_interval_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Error volcando progreso: {e}")
+
+    def stats(self) -> dict:
+        return {
+            'tracked_books': len(self._entries),
+            'subscribers': sum(len(queues) for queues in self._subscribers.values()),
+            'db_writes': self.writes,
+        }
+
+
+class StatusPoller:
+    """
+    Libros que se generan en otro proceso (worker aparte): una sola tarea por
+    libro lee su estado de BD cada `progress_flush_interval_seconds` (en un
+    hilo, fuera del event loop) y avisa por el registro a todos los streams
+    suscritos, en vez de una consulta por cliente conectado.
+    """
+
+    def __init__(self, registry: ProgressRegistry):
+        self.registry = registry
+        self._latest: Dict[str, dict] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.reads = 0  # Métrica: lecturas de BD de los sondeos
+
+    def latest(self, book_id: str) -> Optional[dict]:
+        """Último estado leído de BD (None si aún no hay o se genera en este proceso)"""
+        return self._latest.get(book_id)
+
+    def ensure(self, book_id: str, load: Callable[[str], Optional[dict]]):
+        """Arrancar el sondeo del libro si no está en marcha (para mientras haya suscriptores)"""
+        task = self._tasks.get(book_id)
+        if task is None or task.done():
+            self._tasks[book_id] = asyncio.get_running_loop().create_task(self._poll(book_id, load))
+
+    async def _poll(self, book_id: str, load: Callable[[str], Optional[dict]]):
+        try:
+            while self.registry.has_subscribers(book_id):
+                if self.registry.get(book_id):
+                    # Se genera aquí: el registro ya avisa de cada cambio
+                    self._latest.pop(book_id, None)
+                else:
+                    try:
+                        status = await asyncio.to_thread(load, book_id)
+                        self.reads += 1
+                    except Exception as e:
+                        print(f"❌ Error leyendo estado de {book_id}: {e}")
+                    else:
+                        if status != self._latest.get(book_id):
+                            self._latest[book_id] = status
+                            self.registry.notify(book_id)
+                await asyncio.sleep(settings.progress_flush_interval_seconds)
+        finally:
+            self._latest.pop(book_id, None)
+            self._tasks.pop(book_id, None)
+
+    def stats(self) -> dict:
+        return {
+            'polled_books': len(self._tasks),
+            'db_reads': self.reads,
+        }
+
+
+progress_registry = ProgressRegistry()
+status_poller = StatusPoller(progress_registry)
+
+
+def update_book_progress(book_id: str, step: str, progress: int):
+    """Actualizar progreso del libro (en memoria si se está siguiendo, si no en BD)"""
+    if progress_registry.update(book_id, step, progress):
+        return
+
+    db = SessionLocal()
+    try:
+        book = db.query(Book).filter(Book.id == book_id).first()
+        if book:
+            book.current_step = step
+            book.progress_percentage = progress
+            db.commit()
+    finally:
+        db.close()
@@ -0,0 +1,164 @@
+"""
+Salud de los proveedores de portada (tasa de éxito y latencia recientes) y
+enrutado con failover automático entre Gemini e Ideogram
+"""
+
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from ..config import settings
+
+
+class ProviderHealth:
+    """Ventana de resultados recientes de un proveedor"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.outcomes: Deque[Tuple[bool, float]] = deque(maxlen=settings.cover_health_window)
+        self.consecutive_failures = 0
+        self.unhealthy_since = 0.0  # monotonic; 0 = sano
+
+    def record(self, success: bool, seconds: float):
+        self.outcomes.append((success, seconds))
+        if success:
+            self.consecutive_failures = 0
+            if self.unhealthy_since:
+                # Petición de prueba: si ha ido bien y rápida, vuelve con la ventana limpia
+                # (las latencias antiguas lo volverían a marcar como lento)
+                if seconds <= settings.cover_failover_max_p90_seconds:
+                    self.outcomes.clear()
+                    self.outcomes.append((success, seconds))
+                    self.unhealthy_since = 0.0
+                    print(f"💚 Proveedor de portadas {self.name} recuperado")
+                return
+        else:
+            self.consecutive_failures += 1
+
+        reason = self._unhealthy_reason()
+        if not self.unhealthy_since and reason:
+            self.unhealthy_since = time.monotonic()
+            print(f"🚑 Proveedor de portadas {self.name} marcado como no disponible ({reason})")
+
+    def _unhealthy_reason(self) -> Optional[str]:
+        """Motivo para dejar de usar el proveedor (None si está sano): fallos o lentitud"""
+        if self.consecutive_failures >= settings.cover_failover_after_failures:
+            return f"{self.consecutive_failures} fallos seguidos"
+        if len(self.outcomes) >= settings.cover_failover_min_samples:
+            if self.success_rate < settings.cover_failover_min_success_rate:
+                return f"tasa de éxito {self.success_rate:.0%}"
+            p90 = self.p90_seconds
+            if p90 is not None and p90 > settings.cover_failover_max_p90_seconds:
+                return f"p90 de {p90:.0f}s"
+        return None
+
+    @property
+    def success_rate(self) -> float:
+        if not self.outcomes:
+            return 1.0
+        return sum(1 for success, _ in self.outcomes if success) / len(self.outcomes)
+
+    @property
+    def p90_seconds(self) -> Optional[float]:
+        """p90 de la latencia de las peticiones correctas (None con pocas muestras)"""
+        latencies = sorted(seconds for success, seconds in self.outcomes if success)
+        if len(latencies) < settings.cover_failover_min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+
+    @property
+    def healthy(self) -> bool:
+        return not self.unhealthy_since
+
+    def probe_due(self) -> bool:
+        """Pasado el cooldown se deja pasar una petición de prueba"""
+        return bool(self.unhealthy_since) and \
+            time.monotonic() - self.unhealthy_since >= settings.cover_failover_cooldown_seconds
+
+    def stats(self) -> dict:
+        latencies = sorted(seconds for success, seconds in self.outcomes if success)
+        return {
+            'healthy': self.healthy,
+            'samples': len(self.outcomes),
+            'success_rate': round(self.success_rate, 3),
+            'consecutive_failures': self.consecutive_failures,
+            'p50_seconds': round(latencies[len(latencies) // 2], 2) if latencies else None,
+            'p90_seconds': round(self.p90_seconds, 2) if self.p90_seconds is not None else None,
+        }
+
+
+class CoverRouter:
+    """
+    Elige proveedor para cada portada: el configurado mientras esté sano (sin
+    fallos seguidos, buena tasa de éxito y p90 bajo el máximo) y, si no, el
+    alternativo. Un proveedor caído vuelve a recibir tráfico tras
+    un cooldown (petición de prueba); si acierta, recupera su papel.
+    """
+
+    def __init__(self, preferred: str, providers: List[str]):
+        self.preferred = preferred
+        self.providers = providers
+        self.health: Dict[str, ProviderHealth] = {name: ProviderHealth(name) for name in providers}
+        self.decisions: Dict[str, int] = {name: 0 for name in providers}
+        self.failovers = 0
+        self.probes = 0
+
+    def alternates(self, provider: str) -> List[str]:
+        return [name for name in self.providers if name != provider]
+
+    def choose(self) -> str:
+        preferred = self.health[self.preferred]
+        choice = self.preferred
+
+        if not preferred.healthy:
+            if preferred.probe_due():
+                # Reinicia el cooldown: solo una prueba por periodo
+                preferred.unhealthy_since = time.monotonic()
+                self.probes += 1
+            else:
+                healthy = [name for name in self.alternates(self.preferred) if self.health[name].healthy]
+                if healthy:
+                    choice = healthy[0]
+                    self.failovers += 1
+                    print(f"🔀 Portada enrutada a {choice} ({self.preferred} no disponible)")
+
+        self.decisions[choice] += 1
+        return choice
+
+    def backup_for(self, provider: str) -> str:
+        """Proveedor para una petición de respaldo (hedging): otro sano si lo hay"""
+        for name in self.alternates(provider):
+            if self.health[name].healthy:
+                return name
+        return provider
+
+    def record(self, provider: str, success: bool, seconds: float):
+        self.health[provider].record(success, seconds)
+
+    def stats(self) -> dict:
+        return {
+            'preferred': self.preferred,
+            'decisions': dict(self.decisions),
+            'failovers': self.failovers,
+            'probes': self.probes,
+            'providers': {name: health.stats() for name, health in self.health.items()},
+        }
+
+
+# Router de portadas compartido por todo el proceso
+_cover_router = None
+
+def get_cover_router(preferred: str) -> CoverRouter:
+    """Router de portadas (con failover solo si está activado)"""
+    global _cover_router
+    if _cover_router is None:
+        providers = [preferred]
+        if settings.cover_failover_enabled:
+            providers += [name for name in ('gemini', 'ideogram') if name != preferred]
+        _cover_router = CoverRouter(preferred, providers)
+    return _cover_router
+
+
+def get_cover_routing_stats() -> dict:
+    """Decisiones de enrutado y salud de cada proveedor de portadas"""
+    return _cover_router.stats() if _cover_router else {}
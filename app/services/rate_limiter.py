@@ -0,0 +1,87 @@
+"""
+Rate limiter compartido (token bucket) para todos los clientes de proveedores
+"""
+
+import asyncio
+import time
+from typing import Dict, Tuple
+
+from ..config import settings
+
+
+class TokenBucket:
+    """
+    Token bucket asíncrono. Cada petición reserva un token al llamar a
+    acquire(); si no hay, espera lo justo para que se regenere. La reserva
+    es atómica (no hay await entre leer y descontar), así que coroutines
+    concurrentes se reparten el cupo en vez de salir todas a la vez.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float, burst: int):
+        self.name = name
+        self.rate = max(requests_per_minute, 0.001) / 60.0  # tokens por segundo
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+        # Métricas
+        self.requests = 0
+        self.waits = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> float:
+        """Esperar turno; devuelve los segundos esperados"""
+        self._refill()
+        self.tokens -= 1
+        self.requests += 1
+
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.waits += 1
+            self.total_wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            await asyncio.sleep(wait)
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            'requests_per_minute': round(self.rate * 60, 2),
+            'burst': self.capacity,
+            'requests': self.requests,
+            'waits': self.waits,
+            'avg_wait_seconds': round(self.total_wait_seconds / self.requests, 3) if self.requests else 0.0,
+            'max_wait_seconds': round(self.max_wait_seconds, 3),
+        }
+
+
+def _limits_for(provider: str) -> Tuple[float, int]:
+    """(RPM, burst) configurados para un proveedor"""
+    limits = {
+        'gemini_text': (settings.gemini_text_rpm, settings.gemini_text_burst),
+        'gemini_image': (settings.gemini_image_rpm, settings.gemini_image_burst),
+        'ideogram': (settings.ideogram_rpm, settings.ideogram_burst),
+    }
+    return limits.get(provider, (60, 1))
+
+
+# Un bucket por (proveedor, modelo), compartido por todo el proceso
+_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+def get_rate_limiter(provider: str, model: str) -> TokenBucket:
+    """Obtener el bucket de un proveedor/modelo"""
+    key = (provider, model)
+    if key not in _buckets:
+        rpm, burst = _limits_for(provider)
+        _buckets[key] = TokenBucket(f"{provider}:{model}", rpm, burst)
+    return _buckets[key]
+
+
+def get_rate_limiter_stats() -> dict:
+    """Métricas de espera de todos los buckets"""
+    return {bucket.name: bucket.stats() for bucket in _buckets.values()}
@@ -0,0 +1,104 @@
+"""
+Pre-generación especulativa: historia completa + scene sheet mientras el
+usuario está en el checkout, para reutilizarlos si acaba pagando
+"""
+
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+import json
+
+from sqlalchemy.orm import Session
+
+from .job_queue import enqueue_job
+from ..config import settings
+from ..models import Book, SpeculativeResult
+
+
+def schedule_speculation(db: Session, book: Book) -> bool:
+    """
+    Encolar la especulación de un libro en preview_ready si está activada,
+    no hay una ya en curso/lista y queda presupuesto diario.
+    """
+    if not settings.speculative_generation_enabled or book.status != 'preview_ready':
+        return False
+
+    cleanup_expired_speculations(db)
+
+    if db.query(SpeculativeResult).filter(SpeculativeResult.book_id == book.id).first():
+        return False
+
+    since = datetime.utcnow() - timedelta(days=1)
+    used_today = db.query(SpeculativeResult).filter(SpeculativeResult.created_at >= since).count()
+    if used_today >= settings.speculative_daily_budget:
+        print(f"💸 Presupuesto especulativo agotado ({used_today}/{settings.speculative_daily_budget})")
+        return False
+
+    # La fila reserva presupuesto y evita encolar dos veces el mismo libro
+    db.add(SpeculativeResult(
+        book_id=book.id,
+        status='pending',
+        expires_at=datetime.utcnow() + timedelta(hours=settings.speculative_ttl_hours)
+    ))
+    db.commit()
+
+    enqueue_job(db, book.id, 'speculate')  # Clase de prioridad más baja
+    return True
+
+
+def consume_speculation(db: Session, book_id: str) -> Optional[Tuple[dict, Optional[str]]]:
+    """
+    Tomar el resultado especulativo listo y no caducado de un libro.
+    Devuelve (historia_completa, scene_sheet) o None.
+    """
+    result = db.query(SpeculativeResult).filter(
+        SpeculativeResult.book_id == book_id,
+        SpeculativeResult.status == 'ready'
+    ).first()
+
+    if not result or not result.full_story_json:
+        return None
+
+    if result.expires_at and result.expires_at < datetime.utcnow():
+        return None
+
+    scene_sheet = result.scene_sheet_filename
+    if scene_sheet and not (settings.assets_dir / scene_sheet).exists():
+        scene_sheet = None
+
+    result.status = 'consumed'
+    db.commit()
+
+    return json.loads(result.full_story_json), scene_sheet
+
+
+def discard_speculation(db: Session, book_id: str):
+    """Borrar la especulación de un libro (y su scene sheet si no se usó)"""
+    result = db.query(SpeculativeResult).filter(SpeculativeResult.book_id == book_id).first()
+    if not result:
+        return
+
+    if result.status != 'consumed' and result.scene_sheet_filename:
+        (settings.assets_dir / result.scene_sheet_filename).unlink(missing_ok=True)
+
+    db.delete(result)
+    db.commit()
+
+
+def cleanup_expired_speculations(db: Session) -> int:
+    """Liberar los scene sheets de especulaciones caducadas que nadie pagó"""
+    expired = db.query(SpeculativeResult).filter(
+        SpeculativeResult.status.in_(['ready', 'failed']),
+        SpeculativeResult.expires_at < datetime.utcnow()
+    ).all()
+
+    for result in expired:
+        if result.scene_sheet_filename:
+            (settings.assets_dir / result.scene_sheet_filename).unlink(missing_ok=True)
+            result.scene_sheet_filename = None
+        # La fila se conserva como 'expired' para seguir contando en el presupuesto diario
+        result.status = 'expired'
+
+    if expired:
+        db.commit()
+        print(f"🗑️ {len(expired)} especulaciones caducadas liberadas")
+    return len(expired)
@@ -0,0 +1,159 @@
+"""
+Caché persistente de historias: la misma foto con el mismo nombre, edad,
+descripción y modelo devuelve la historia ya generada (reintentos, libros
+borrados y vueltos a crear, pruebas) sin repetir la llamada a Gemini
+"""
+
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from ..config import settings
+from ..database import SessionLocal
+from ..models import StoryCacheEntry
+
+
+class StoryCacheStats:
+    """Contadores del proceso (se reinician al arrancar)"""
+
+    def __init__(self):
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self.stores = 0
+        self.evictions = 0
+
+    def count(self, counter: Dict[str, int], kind: str):
+        counter[kind] = counter.get(kind, 0) + 1
+
+    def as_dict(self) -> dict:
+        kinds = sorted(set(self.hits) | set(self.misses))
+        return {
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+            'hit_rate': {
+                kind: round(self.hits.get(kind, 0) / (self.hits.get(kind, 0) + self.misses.get(kind, 0)), 3)
+                for kind in kinds
+            },
+            'stores': self.stores,
+            'evictions': self.evictions,
+        }
+
+
+_stats = StoryCacheStats()
+
+
+def _normalize_text(text: Optional[str]) -> str:
+    return " ".join((text or "").split())
+
+
+def minimal_story_key(photo: bytes, child_name: str, age: int, description: Optional[str], model: str) -> str:
+    """`photo` son los bytes de la foto de referencia ya normalizada (orientada, recortada y reducida)"""
+    inputs = json.dumps({
+        'photo': hashlib.sha256(photo).hexdigest(),
+        'name': _normalize_text(child_name),
+        'age': age,
+        'description': _normalize_text(description).lower(),
+        'model': model,
+    }, sort_keys=True)
+    return hashlib.sha256(f"minimal:{inputs}".encode()).hexdigest()
+
+
+def full_story_key(minimal_story: Dict, num_pages: int, model: str) -> str:
+    inputs = json.dumps({
+        'minimal_story': minimal_story,
+        'pages': num_pages,
+        'model': model,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(f"full:{inputs}".encode()).hexdigest()
+
+
+def get_cached_story(key: str, kind: str) -> Optional[Dict]:
+    """Historia guardada para esa clave (None si no hay o caducó)"""
+    if not settings.story_cache_enabled:
+        return None
+
+    db = SessionLocal()
+    try:
+        cutoff = datetime.utcnow() - timedelta(hours=settings.story_cache_ttl_hours)
+        entry = db.query(StoryCacheEntry).filter(
+            StoryCacheEntry.key == key,
+            StoryCacheEntry.created_at >= cutoff
+        ).first()
+        if entry is None:
+            _stats.count(_stats.misses, kind)
+            return None
+
+        entry.hits = (entry.hits or 0) + 1
+        entry.last_used_at = datetime.utcnow()
+        db.commit()
+        _stats.count(_stats.hits, kind)
+        print(f"🗃️ Historia {kind} servida desde caché ({key[:12]})")
+        return json.loads(entry.story_json)
+    except Exception as e:
+        # La caché nunca debe impedir generar la historia
+        print(f"⚠️ Error leyendo caché de historias: {e}")
+        db.rollback()
+        return None
+    finally:
+        db.close()
+
+
+def store_story(key: str, kind: str, story: Dict, model: str):
+    """Guardar una historia generada (nunca las de respaldo) y desalojar si hace falta"""
+    if not settings.story_cache_enabled:
+        return
+
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        db.merge(StoryCacheEntry(
+            key=key,
+            kind=kind,
+            model=model,
+            story_json=json.dumps(story, ensure_ascii=False),
+            hits=0,
+            created_at=now,
+            last_used_at=now
+        ))
+        db.commit()
+        _stats.stores += 1
+        _evict(db)
+    except Exception as e:
+        print(f"⚠️ Error guardando en caché de historias: {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+
+def _evict(db):
+    """Borrar las caducadas y, si se pasa del máximo, las menos usadas recientemente"""
+    cutoff = datetime.utcnow() - timedelta(hours=settings.story_cache_ttl_hours)
+    evicted = db.query(StoryCacheEntry).filter(
+        StoryCacheEntry.created_at < cutoff
+    ).delete(synchronize_session=False)
+
+    excess = db.query(StoryCacheEntry).count() - settings.story_cache_max_entries
+    if excess > 0:
+        oldest = [key for (key,) in db.query(StoryCacheEntry.key).order_by(
+            StoryCacheEntry.last_used_at
+        ).limit(excess).all()]
+        evicted += db.query(StoryCacheEntry).filter(
+            StoryCacheEntry.key.in_(oldest)
+        ).delete(synchronize_session=False)
+
+    db.commit()
+    if evicted:
+        _stats.evictions += evicted
+        print(f"🗃️ Caché de historias: {evicted} entradas desalojadas")
+
+
+def get_story_cache_stats() -> dict:
+    """Aciertos/fallos del proceso y tamaño actual de la caché"""
+    stats = _stats.as_dict()
+    db = SessionLocal()
+    try:
+        stats['entries'] = db.query(StoryCacheEntry).count()
+    finally:
+        db.close()
+    return stats
@@ -0,0 +1,98 @@
+"""
+Esquemas de las historias que devuelve Gemini (salida JSON restringida al
+esquema) y métricas de respuestas que no lo cumplen
+"""
+
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, model_validator
+
+
+class Protagonista(BaseModel):
+    nombre: str
+    descripcion_fisica: str
+
+
+class MinimalStory(BaseModel):
+    """Historia mínima del preview"""
+    titulo: str
+    tema: str
+    resumen: str
+    mundo_descripcion: str
+    protagonista: Protagonista
+
+
+class Elemento(BaseModel):
+    """Personaje, objeto o escenario con su ID numérico (el que aparece en los sheets)"""
+    id: int
+    nombre: str
+    descripcion: str
+
+
+class Pagina(BaseModel):
+    numero: int
+    texto: str
+    escena_detallada: str
+    personajes_ids: List[int]
+    objetos_ids: List[int]
+    escenario_id: Optional[int]
+
+
+class FullStory(BaseModel):
+    """Historia completa: en este orden, para que el streaming dé los sheets antes que las páginas"""
+    titulo: str
+    tema: str
+    resumen: str
+    leccion: str
+    personajes_principales: List[Elemento]
+    objetos_importantes: List[Elemento]
+    escenarios: List[Elemento]
+    paginas: List[Pagina]
+
+    @model_validator(mode='after')
+    def check_references(self):
+        """Las páginas solo pueden usar IDs declarados (si no, el sheet no los tendría)"""
+        personajes = {p.id for p in self.personajes_principales}
+        objetos = {o.id for o in self.objetos_importantes}
+        escenarios = {e.id for e in self.escenarios}
+        if not personajes:
+            raise ValueError("personajes_principales no puede estar vacío")
+        if not self.paginas:
+            raise ValueError("paginas no puede estar vacío")
+
+        errors = []
+        for pagina in self.paginas:
+            unknown = [i for i in pagina.personajes_ids if i not in personajes]
+            if unknown:
+                errors.append(f"página {pagina.numero}: personajes_ids inexistentes {unknown}")
+            unknown = [i for i in pagina.objetos_ids if i not in objetos]
+            if unknown:
+                errors.append(f"página {pagina.numero}: objetos_ids inexistentes {unknown}")
+            if pagina.escenario_id is not None and pagina.escenario_id not in escenarios:
+                errors.append(f"página {pagina.numero}: escenario_id inexistente {pagina.escenario_id}")
+        if errors:
+            raise ValueError("; ".join(errors))
+        return self
+
+
+# Resultado de validar cada respuesta, por tipo de historia:
+# ok (a la primera), repaired (tras la petición de reparación), failed (historia de respaldo)
+_parse_outcomes: Dict[str, Dict[str, int]] = {}
+
+
+def record_parse_outcome(kind: str, outcome: str):
+    counters = _parse_outcomes.setdefault(kind, {'ok': 0, 'repaired': 0, 'failed': 0})
+    counters[outcome] += 1
+
+
+def get_story_parse_stats() -> Dict[str, Dict]:
+    """Respuestas por resultado y tasa de las que no cumplían el esquema"""
+    stats = {}
+    for kind, counters in _parse_outcomes.items():
+        total = sum(counters.values())
+        stats[kind] = {
+            **counters,
+            'total': total,
+            'parse_failure_rate': round((counters['repaired'] + counters['failed']) / total, 3) if total else 0.0,
+        }
+    return stats
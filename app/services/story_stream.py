@@ -0,0 +1,181 @@
+"""
+Historia completa en streaming: parser incremental del JSON que va llegando
+y "feed" con futuros para que sheets y páginas arranquen antes de que
+termine la generación del texto
+"""
+
+import asyncio
+import json
+from typing import Any, Callable, Dict, List, Optional
+
+
+# Secciones que necesitan los sheets (en el prompt van antes de las páginas)
+OUTLINE_SECTIONS = ('personajes_principales', 'objetos_importantes', 'escenarios')
+
+
+class StoryStreamParser:
+    """
+    Recorre el JSON de la historia según llega y avisa en cuanto se cierra:
+    - una sección de primer nivel que sea lista u objeto -> on_section(clave, valor)
+    - cada página de "paginas" -> on_page(índice, página)
+    Ignora lo que haya antes del primer '{' (p.ej. un bloque ```json).
+    """
+
+    def __init__(
+        self,
+        on_section: Callable[[str, Any], None],
+        on_page: Callable[[int, Dict], None]
+    ):
+        self.on_section = on_section
+        self.on_page = on_page
+        self.buffer = ""
+        self.position = 0
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.string_start = 0
+        self.last_string: Optional[str] = None  # Posible clave de primer nivel
+        self.key: Optional[str] = None  # Clave cuyo valor se está leyendo
+        self.value_start: Optional[int] = None
+        self.item_start: Optional[int] = None  # Inicio de la página en curso
+        self.pages = 0
+
+    def feed(self, text: str):
+        self.buffer += text
+        buffer = self.buffer
+
+        while self.position < len(buffer):
+            i = self.position
+            char = buffer[i]
+            self.position += 1
+
+            if not self.started:
+                if char == '{':
+                    self.started = True
+                    self.depth = 1
+                continue
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.last_string = buffer[self.string_start + 1:i]
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string_start = i
+            elif char == ':' and self.depth == 1:
+                self.key = self.last_string
+            elif char in '{[':
+                self.depth += 1
+                if self.depth == 2:
+                    self.value_start = i
+                elif self.depth == 3 and self.key == 'paginas' and char == '{':
+                    self.item_start = i
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 2 and self.item_start is not None:
+                    self._emit_page(buffer[self.item_start:i + 1])
+                    self.item_start = None
+                elif self.depth == 1 and self.value_start is not None:
+                    self._emit_section(buffer[self.value_start:i + 1])
+                    self.value_start = None
+
+    def _emit_section(self, raw: str):
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            return  # La respuesta completa se valida al final
+        self.on_section(self.key, value)
+
+    def _emit_page(self, raw: str):
+        try:
+            page = json.loads(raw)
+        except json.JSONDecodeError:
+            page = None
+        index = self.pages
+        self.pages += 1
+        if isinstance(page, dict):
+            self.on_page(index, page)
+
+
+class StoryFeed:
+    """
+    Partes de la historia completa a medida que están disponibles. El esquema
+    (personajes, objetos, escenarios) y cada página se resuelven en cuanto
+    llegan; al terminar, `complete` resuelve lo que falte con la historia
+    definitiva y `fail` propaga el error a quien esté esperando.
+    Lo emitido puede no coincidir con la historia definitiva (reparación del
+    JSON, reintento del stage): `outline_changed` y `stale_pages` lo detectan.
+    """
+
+    def __init__(self, num_pages: int):
+        loop = asyncio.get_running_loop()
+        self.num_pages = num_pages
+        self.sections: Dict[str, Any] = {}
+        self._outline = loop.create_future()
+        self._story = loop.create_future()
+        self._pages: List[asyncio.Future] = [loop.create_future() for _ in range(num_pages)]
+        self.streamed_pages = 0
+
+    def add_section(self, key: str, value: Any):
+        if key in OUTLINE_SECTIONS and not self._outline.done():
+            self.sections[key] = value
+            if all(section in self.sections for section in OUTLINE_SECTIONS):
+                self._outline.set_result(dict(self.sections))
+
+    def add_page(self, index: int, page: Dict):
+        if index < self.num_pages and not self._pages[index].done():
+            self._pages[index].set_result(page)
+            self.streamed_pages += 1
+
+    def complete(self, full_story: Dict):
+        """Historia definitiva: resuelve esquema y páginas que no llegaron por el stream"""
+        if not self._story.done():
+            self._story.set_result(full_story)
+        if not self._outline.done():
+            self._outline.set_result(self._story_outline(full_story))
+        for index, page in enumerate(full_story['paginas'][:self.num_pages]):
+            if not self._pages[index].done():
+                self._pages[index].set_result(page)
+
+    def fail(self, error: BaseException):
+        if isinstance(error, asyncio.CancelledError):
+            error = Exception("Generación de la historia cancelada")
+        for future in [self._outline, self._story, *self._pages]:
+            if not future.done():
+                future.set_exception(error)
+                future.exception()  # Evita el aviso de excepción no recuperada si nadie lo espera
+
+    async def outline(self) -> Dict:
+        """Personajes, objetos y escenarios (lo que necesitan los sheets)"""
+        return await asyncio.shield(self._outline)
+
+    async def page(self, index: int) -> Dict:
+        """Página `index` (desde 0) en cuanto esté completa"""
+        return await asyncio.shield(self._pages[index])
+
+    async def story(self) -> Dict:
+        """Historia definitiva (la que se guarda en el libro)"""
+        return await asyncio.shield(self._story)
+
+    @staticmethod
+    def _story_outline(full_story: Dict) -> Dict:
+        return {section: full_story.get(section, []) for section in OUTLINE_SECTIONS}
+
+    def outline_changed(self, full_story: Dict) -> bool:
+        """Si el esquema que usaron los sheets no es el de la historia definitiva"""
+        return self._outline.result() != self._story_outline(full_story)
+
+    def stale_pages(self, full_story: Dict) -> List[int]:
+        """Índices de las páginas emitidas que no coinciden con la historia definitiva"""
+        return [
+            index for index, (future, page) in enumerate(zip(self._pages, full_story['paginas']))
+            if future.result() != page
+        ]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Worker de generación independiente del servidor web
+Ejecutar: python -m app.worker --concurrency 4
+
+Procesa la misma cola de trabajos (BD) que los workers en proceso de la web,
+así que se pueden escalar por separado. Para que la web no genere nada,
+arrancarla con JOB_WORKERS=0.
+"""
+
+import argparse
+import asyncio
+import signal
+
+from .config import settings, setup_directories
+from .database import create_tables
+from .services.job_queue import start_worker_pool, stop_worker_pool
+from .services.gemini_client import close_gemini_client
+
+
+async def run_worker(concurrency: int):
+    """Procesar trabajos hasta recibir SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    await start_worker_pool(concurrency)
+    try:
+        await stop_event.wait()
+    finally:
+        # Devuelve a la cola lo que estuviera en curso para otro worker
+        await stop_worker_pool()
+        # Cada proceso cierra su propio cliente de Gemini (sesiones HTTP)
+        await close_gemini_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker de generación de libros")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=max(1, settings.job_workers),
+        help="Trabajos simultáneos en este proceso"
+    )
+    args = parser.parse_args()
+
+    print("👷 Iniciando worker de generación...")
+    if not settings.gemini_api_key:
+        print("⚠️  ADVERTENCIA: GEMINI_API_KEY no configurada")
+
+    setup_directories(settings)
+    create_tables()
+
+    try:
+        asyncio.run(run_worker(args.concurrency))
+    except KeyboardInterrupt:
+        pass
+    print("👋 Worker detenido")
+
+
+if __name__ == "__main__":
+    main()